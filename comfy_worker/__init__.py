@@ -0,0 +1 @@
+"""ComfyUI RunPod worker; handler.py is the entrypoint."""
@@ -0,0 +1,574 @@
+"""Result and render caches, and locating the PLYs a prompt wrote."""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .config import (RENDER_CACHE_DIR, RENDER_CACHE_ENABLED, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_PLY,
+                     RENDER_NODE_TYPES, RESULT_CACHE_DIR, RESULT_CACHE_ENABLED, RESULT_CACHE_MAX_BYTES,
+                     RESULT_CACHE_WRITE_WAIT, SPLAT_NODE_TYPES, VOLATILE_INPUTS)
+from .client import AsyncComfyClient, ComfyClient, _comfy_dir, _local_file, _local_input_dir
+from .inputs import InputCache, input_cache, write_input_atomic
+from .graph import _is_link, _node_sort_key, reachable_nodes
+
+logger = logging.getLogger(__name__)
+
+
+_file_digests: Dict[Any, str] = {}
+
+
+def _input_digest(filename: str) -> Optional[str]:
+    """SHA-256 of an input image, from the input cache or by hashing the file."""
+    if input_cache is not None:
+        digest = input_cache.digest_for(filename)
+        if digest is not None:
+            return digest
+
+    path = _local_file("input", filename)
+    try:
+        st = path.stat()
+    except (OSError, AttributeError):
+        return None
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    if key not in _file_digests:
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        _file_digests[key] = hasher.hexdigest()
+    return _file_digests[key]
+
+
+def workflow_fingerprint(workflow: Dict[str, Any]) -> Optional[str]:
+    """
+    Canonical hash of a workflow for result caching.
+
+    `_meta` and volatile UI widget values are ignored and LoadImage filenames
+    are replaced by the hash of their content. Returns None when an input's
+    content cannot be determined, in which case the result is not cacheable.
+    """
+    canonical = {}
+    for node_id, node in workflow.items():
+        inputs = {k: v for k, v in node.get("inputs", {}).items() if k not in VOLATILE_INPUTS}
+        if node.get("class_type") == "LoadImage" and isinstance(inputs.get("image"), str):
+            digest = _input_digest(inputs["image"])
+            if digest is None:
+                return None
+            inputs["image"] = f"sha256:{digest}"
+        canonical[node_id] = {"class_type": node.get("class_type"), "inputs": inputs}
+    blob = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of finished jobs keyed by workflow_fingerprint().
+
+    Each entry is a directory holding a manifest and copies of the output
+    images (and PLYs, for splat jobs), so hits survive ComfyUI cleaning its
+    output folder. Entries are
+    evicted least recently used first once the cache exceeds `max_bytes`.
+
+    The directory may sit on a volume shared by several workers, so an
+    entry only counts as a hit while every file its manifest lists is
+    present at the recorded size. Writes happen after the job responds;
+    keys reserved by reserve() make a lookup of the same key wait for the
+    write (up to RESULT_CACHE_WRITE_WAIT) instead of missing.
+    """
+
+    def __init__(self, root: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes: Dict[str, threading.Event] = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def reserve(self, key: str) -> None:
+        """Mark `key` as about to be written; call release() when done."""
+        with self._lock:
+            self._writes.setdefault(key, threading.Event())
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            written = self._writes.pop(key, None)
+        if written is not None:
+            written.set()
+
+    @staticmethod
+    def _complete(entry_dir: Path, entry: Dict[str, Any]) -> bool:
+        """Whether every file of a manifest is on disk at its recorded size."""
+        try:
+            sizes = entry.get("sizes", {})
+            for ref in entry["images"] + entry.get("ply_files", []):
+                size = (entry_dir / ref["cached_file"]).stat().st_size
+                if size != sizes.get(ref["cached_file"], size):
+                    return False
+        except (OSError, KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            writing = self._writes.get(key)
+        if writing is not None:
+            writing.wait(RESULT_CACHE_WRITE_WAIT)
+        manifest = self._entry(key) / "manifest.json"
+        try:
+            with open(manifest, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and not self._complete(manifest.parent, entry):
+            logger.warning("Ignoring incomplete cached result %s", key[:12])
+            entry = None
+        if entry is None:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        try:
+            os.utime(manifest)
+        except OSError:
+            pass
+        with self._lock:
+            self.stats["hits"] += 1
+        return entry
+
+    def read(self, key: str, image: Dict[str, Any]) -> bytes:
+        """Bytes of a cached output image from a manifest returned by get()."""
+        return (self._entry(key) / image["cached_file"]).read_bytes()
+
+    def put(self, key: str, prompt_id: str, images: List[Dict[str, Any]], blobs: List[bytes],
+            plys: Sequence[Dict[str, Any]] = (), ply_blobs: Sequence[bytes] = ()) -> None:
+        """
+        Store a finished job; `blobs` holds the bytes of each entry of
+        `images` and `ply_blobs` those of each entry of `plys`.
+        """
+        entry_dir = self._entry(key)
+        tmp_dir = entry_dir.with_name(f".{key}.{uuid.uuid4().hex[:8]}")
+        try:
+            tmp_dir.mkdir(parents=True)
+            manifest: Dict[str, Any] = {"prompt_id": prompt_id, "created": time.time(), "sizes": {}}
+            for field, refs, data in (("images", images, blobs), ("ply_files", plys, ply_blobs)):
+                stored = []
+                for i, (ref, blob) in enumerate(zip(refs, data)):
+                    cached_file = f"{field[0]}{i}_{Path(ref['filename']).name}"
+                    (tmp_dir / cached_file).write_bytes(blob)
+                    manifest["sizes"][cached_file] = len(blob)
+                    stored.append({**{k: v for k, v in ref.items() if k != "key"}, "cached_file": cached_file})
+                manifest[field] = stored
+            with open(tmp_dir / "manifest.json", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            logger.warning("Could not store result %s: %s", key[:12], e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for manifest in self.root.glob("*/*/manifest.json"):
+            try:
+                size = sum(p.stat().st_size for p in manifest.parent.iterdir())
+                entries.append((manifest.stat().st_mtime, size, manifest.parent))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self) -> None:
+        """Delete least recently used entries until under max_bytes."""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logger.info("Evicted cached result %s", path.name[:12])
+
+    def summary(self, hit: bool, key: str) -> Dict[str, Any]:
+        """Cache section of a job response."""
+        with self._lock:
+            return {"hit": hit, "key": key, **self.stats}
+
+
+result_cache: Optional[ResultCache] = ResultCache() if RESULT_CACHE_ENABLED else None
+
+
+def _cache_key(fingerprint: Optional[str], inp: Dict[str, Any]) -> Optional[str]:
+    if result_cache is None or not inp.get("cache", True) or fingerprint is None:
+        return None
+    # Splat jobs need the PLYs too, so they get entries of their own
+    return f"{fingerprint}-splat" if inp.get("splat") else fingerprint
+
+
+def _cached_result(key: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+    logger.info("Result cache hit %s (prompt %s)", key[:12], entry["prompt_id"][:12])
+    return {
+        "prompt_id": entry["prompt_id"],
+        "images": [{k: v for k, v in i.items() if k != "cached_file"} for i in entry["images"]],
+        "ply_files": [{**p, "type": "result_cache", "key": key} for p in entry.get("ply_files", [])],
+        "cache": result_cache.summary(True, key),
+    }
+
+
+#======================================================================
+render_cache: Optional[ResultCache] = (
+    ResultCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES) if RENDER_CACHE_ENABLED else None
+)
+
+
+def _render_key(workflow: Dict[str, Any], node_id: str) -> Optional[str]:
+    """Fingerprint of the subgraph a render node depends on (input image + SHARP settings)."""
+    subgraph = {n: workflow[n] for n in reachable_nodes(workflow, [node_id])}
+    return workflow_fingerprint(subgraph)
+
+
+def plan_render_cache(workflow: Dict[str, Any],
+                      need_plys: bool = False) -> Tuple[Dict[str, Tuple[str, Dict]], Dict[str, str]]:
+    """
+    Look up every render node of a workflow in the render cache.
+
+    Only renders whose consumers read the image output (slot 0) are
+    considered, since that is all a cached image can stand in for. A hit
+    removes the SHARP prediction, so when the job wants the splats
+    (`need_plys`) an entry stored without its PLYs counts as a miss.
+
+    Returns:
+        (hits: node id -> (key, cache entry), misses: node id -> key)
+    """
+    hits: Dict[str, Tuple[str, Dict]] = {}
+    misses: Dict[str, str] = {}
+    if render_cache is None:
+        return hits, misses
+    for node_id, node in workflow.items():
+        if node.get("class_type") not in RENDER_NODE_TYPES:
+            continue
+        slots = {value[1] for other in workflow.values() for value in other.get("inputs", {}).values()
+                 if _is_link(value) and str(value[0]) == node_id}
+        if slots - {0}:
+            continue
+        key = _render_key(workflow, node_id)
+        if key is None:
+            continue
+        entry = render_cache.get(key)
+        if entry is not None and (not need_plys or _cached_ply_refs(key, entry)):
+            hits[node_id] = (key, entry)
+        else:
+            misses[node_id] = key
+    return hits, misses
+
+
+def _touch_input(path: Path) -> bool:
+    """Mark an input file as just used, so eviction keeps it; False if it is missing."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def _render_image(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return next(i for i in entry["images"] if not i["filename"].lower().endswith(".ply"))
+
+
+def _cached_ply_refs(key: str, entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{**i, "type": "render_cache", "key": key} for i in entry["images"] if i["filename"].lower().endswith(".ply")]
+
+
+def _replace_with_render(workflow: Dict[str, Any], node_id: str, filename: str) -> List[str]:
+    """
+    Swap a render node for a LoadImage of its cached image, keeping the node
+    id so consumers stay wired, and drop the upstream nodes only it used.
+
+    Returns:
+        Sorted ids of the removed upstream nodes
+    """
+    upstream = reachable_nodes(workflow, [node_id]) - {node_id}
+    workflow[node_id] = {
+        "inputs": {"image": filename},
+        "class_type": "LoadImage",
+        "_meta": {"title": f"{workflow[node_id].get('_meta', {}).get('title', 'Render')} (cached)"},
+    }
+    keep = reachable_nodes(workflow, [n for n in workflow if n not in upstream])
+    removed = sorted((n for n in upstream if n not in keep), key=_node_sort_key)
+    for n in removed:
+        del workflow[n]
+    return removed
+
+
+def _capture_node_id(node_id: str) -> str:
+    return f"render_cache_{node_id}"
+
+
+def _add_capture(workflow: Dict[str, Any], node_id: str, key: str) -> None:
+    """Save a render node's image so it can be stored in the render cache after the run."""
+    workflow[_capture_node_id(node_id)] = {
+        "inputs": {"filename_prefix": f"render_cache/{key[:16]}", "images": [node_id, 0]},
+        "class_type": "SaveImage",
+        "_meta": {"title": "Render cache capture"},
+    }
+
+
+def _add_preview(workflow: Dict[str, Any], node_id: str) -> None:
+    """Preview a render node's image so a stream can relay it when it is not being cached."""
+    workflow[_capture_node_id(node_id)] = {
+        "inputs": {"images": [node_id, 0]},
+        "class_type": "PreviewImage",
+        "_meta": {"title": "Render preview"},
+    }
+
+
+def add_render_previews(workflow: Dict[str, Any], captures: Dict[str, Optional[str]]) -> None:
+    """
+    Give every render node without a render-cache capture a preview,
+    recorded in `captures` without a key. Only renders whose image is used
+    are previewed, so no render runs just for the stream.
+    """
+    used = {str(value[0]) for node in workflow.values() for value in node.get("inputs", {}).values()
+            if _is_link(value) and value[1] == 0}
+    for node_id in [n for n, node in workflow.items() if node.get("class_type") in RENDER_NODE_TYPES]:
+        if node_id in used and node_id not in captures:
+            _add_preview(workflow, node_id)
+            captures[node_id] = None
+
+
+def apply_render_cache(client: ComfyClient, workflow: Dict[str, Any],
+                       need_plys: bool = False) -> Tuple[Dict[str, Any], Dict[str, str], List[Dict[str, Any]]]:
+    """
+    Serve cached renders and prepare capture of the others.
+
+    Each cached GaussianViewer render is made available to ComfyUI as an
+    input image and its node is rewritten to load it, which skips SHARP
+    prediction and rendering for the job. Uncached render nodes get a
+    SaveImage attached so their output can be stored once the prompt ends.
+
+    Returns:
+        (report for the response, captures: render node id -> cache key,
+         PLY references of the cache hits)
+    """
+    hits, misses = plan_render_cache(workflow, need_plys)
+    report: Dict[str, Any] = {"hits": [], "skipped": []}
+    plys: List[Dict[str, Any]] = []
+    input_dir = _local_input_dir() if client.transport == "local" else None
+    for node_id, (key, entry) in hits.items():
+        image = _render_image(entry)
+        filename = f"{InputCache.RENDER_PREFIX}{key[:16]}{Path(image['filename']).suffix}"
+        if input_dir is None:
+            blob = render_cache.read(key, image)
+            filename = client.upload_stream([blob], filename, mimetypes.guess_type(filename)[0] or "image/png")
+        elif not _touch_input(input_dir / filename):
+            write_input_atomic(input_dir, [render_cache.read(key, image)], filename)
+        plys.extend(_cached_ply_refs(key, entry))
+        report["skipped"].extend(_replace_with_render(workflow, node_id, filename))
+        report["hits"].append(node_id)
+        logger.info("Render cache hit for node %s (%s)", node_id, key[:12])
+    for node_id, key in misses.items():
+        _add_capture(workflow, node_id, key)
+    report["misses"] = sorted(misses, key=_node_sort_key)
+    if hits and input_cache is not None:
+        input_cache.evict()
+    return report, misses, plys
+
+
+async def apply_render_cache_async(
+        client: AsyncComfyClient, workflow: Dict[str, Any], need_plys: bool = False,
+) -> Tuple[Dict[str, Any], Dict[str, str], List[Dict[str, Any]]]:
+    """Async counterpart of apply_render_cache."""
+    hits, misses = await asyncio.to_thread(plan_render_cache, workflow, need_plys)
+    report: Dict[str, Any] = {"hits": [], "skipped": []}
+    plys: List[Dict[str, Any]] = []
+    input_dir = await asyncio.to_thread(_local_input_dir) if client.transport == "local" else None
+    for node_id, (key, entry) in hits.items():
+        image = _render_image(entry)
+        filename = f"{InputCache.RENDER_PREFIX}{key[:16]}{Path(image['filename']).suffix}"
+        if input_dir is None:
+            blob = await asyncio.to_thread(render_cache.read, key, image)
+            filename = await client.upload_image_bytes(
+                blob, filename, mimetypes.guess_type(filename)[0] or "image/png",
+            )
+        elif not await asyncio.to_thread(_touch_input, input_dir / filename):
+            blob = await asyncio.to_thread(render_cache.read, key, image)
+            await asyncio.to_thread(write_input_atomic, input_dir, [blob], filename)
+        plys.extend(_cached_ply_refs(key, entry))
+        report["skipped"].extend(_replace_with_render(workflow, node_id, filename))
+        report["hits"].append(node_id)
+        logger.info("Render cache hit for node %s (%s)", node_id, key[:12])
+    for node_id, key in misses.items():
+        _add_capture(workflow, node_id, key)
+    report["misses"] = sorted(misses, key=_node_sort_key)
+    if hits and input_cache is not None:
+        await asyncio.to_thread(input_cache.evict)
+    return report, misses, plys
+
+
+def _split_captures(images: List[Dict[str, Any]],
+                    captures: Dict[str, Optional[str]]) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Separate capture and preview outputs from the job's own images; only captures are returned."""
+    by_node = {_capture_node_id(n): n for n in captures}
+    captured = {by_node[i["node_id"]]: i for i in images
+                if i["node_id"] in by_node and captures[by_node[i["node_id"]]] is not None}
+    return [i for i in images if i["node_id"] not in by_node], captured
+
+
+def _render_plys(history: Dict, workflow: Dict[str, Any], node_id: str, since: float) -> List[Dict[str, str]]:
+    """PLY files produced upstream of a render node, when PLY caching is on."""
+    if not RENDER_CACHE_PLY:
+        return []
+    subgraph = {n: workflow[n] for n in reachable_nodes(workflow, [node_id])}
+    outputs = {n: o for n, o in history.get("outputs", {}).items() if n in subgraph}
+    return find_ply_outputs({"outputs": outputs}, subgraph, since)
+
+
+def store_renders(client: ComfyClient, history: Dict, workflow: Dict[str, Any], prompt_id: str,
+                  captured: Dict[str, Dict[str, Any]], captures: Dict[str, str], since: float) -> List[str]:
+    """Store captured renders (and their PLYs, found per find_ply_outputs) in the render cache."""
+    stored = []
+    for node_id, image in captured.items():
+        files = [image] + _render_plys(history, workflow, node_id, since)
+        render_cache.put(captures[node_id], prompt_id, files, [client.fetch_output(f) for f in files])
+        stored.append(node_id)
+    return sorted(stored, key=_node_sort_key)
+
+
+async def store_renders_async(client: AsyncComfyClient, history: Dict, workflow: Dict[str, Any],
+                              prompt_id: str, captured: Dict[str, Dict[str, Any]],
+                              captures: Dict[str, str], since: float) -> List[str]:
+    """Async counterpart of store_renders."""
+    stored = []
+    for node_id, image in captured.items():
+        files = [image] + await asyncio.to_thread(_render_plys, history, workflow, node_id, since)
+        blobs = await asyncio.gather(*(client.fetch_output(f) for f in files))
+        await asyncio.to_thread(render_cache.put, captures[node_id], prompt_id, files, blobs)
+        stored.append(node_id)
+    return sorted(stored, key=_node_sort_key)
+
+
+def _ply_source(client: ComfyClient):
+    """Fetch a PLY reference, reading render- and result-cache entries from disk."""
+    def fetch(ply: Dict[str, Any]) -> bytes:
+        if ply.get("type") == "render_cache":
+            return render_cache.read(ply["key"], ply)
+        if ply.get("type") == "result_cache":
+            return result_cache.read(ply["key"], ply)
+        return client.fetch_output(ply)
+    return fetch
+
+
+def _ply_source_async(client: AsyncComfyClient):
+    """Async counterpart of _ply_source."""
+    async def fetch(ply: Dict[str, Any]) -> bytes:
+        if ply.get("type") == "render_cache":
+            return await asyncio.to_thread(render_cache.read, ply["key"], ply)
+        if ply.get("type") == "result_cache":
+            return await asyncio.to_thread(result_cache.read, ply["key"], ply)
+        return await client.fetch_output(ply)
+    return fetch
+
+
+#======================================================================
+# PLYs written by splat nodes, located for the render cache and splat delivery
+def _ply_file_info(value: str) -> Optional[Dict[str, str]]:
+    """Turn a PLY path reported by a node into a ComfyUI output file reference."""
+    output_dir = _comfy_dir("output").resolve()
+    path = Path(value)
+    if path.is_absolute():
+        try:
+            path = path.resolve().relative_to(output_dir)
+        except ValueError:
+            return None
+    return {"filename": path.name, "subfolder": str(path.parent) if str(path.parent) != "." else "",
+            "type": "output"}
+
+
+def tag_splat_outputs(workflow: Dict[str, Any]) -> None:
+    """
+    Move each splat node's output under a subfolder named after its inputs
+    (`sharp` -> `sharp/<fingerprint>`), so that find_ply_outputs can tell
+    its PLYs from those of other prompts. Identical inputs keep the same
+    prefix, so ComfyUI's execution cache still covers SHARP and everything
+    after it. The subfolder is created when the output folder is local.
+    """
+    output_dir = _comfy_dir("output")
+    for node_id, node in workflow.items():
+        if node.get("class_type") not in SPLAT_NODE_TYPES:
+            continue
+        inputs = node.setdefault("inputs", {})
+        prefix = inputs.get("output_prefix") or "sharp"
+        if not isinstance(prefix, str):
+            continue
+        tag = _render_key(workflow, node_id) or uuid.uuid4().hex
+        inputs["output_prefix"] = f"{prefix}/{tag[:32]}"
+        if output_dir.is_dir():
+            with contextlib.suppress(OSError):
+                (output_dir / inputs["output_prefix"]).mkdir(parents=True, exist_ok=True)
+
+
+def find_ply_outputs(history: Dict, workflow: Dict[str, Any], since: float = 0.0) -> List[Dict[str, str]]:
+    """
+    Locate the Gaussian-splat PLY files written by a prompt.
+
+    PLY paths reported in the prompt's history outputs are used when present;
+    otherwise the output folder is searched for files under each splat
+    node's output_prefix, made unique per input by tag_splat_outputs. A
+    folder may hold the files of an earlier run with the same inputs; those
+    written since `since` win, and the older ones stand in when ComfyUI
+    served the node from its cache and wrote nothing.
+    """
+    found: Dict[Tuple[str, str], Dict[str, str]] = {}
+
+    def scan(value: Any) -> None:
+        if isinstance(value, str) and value.lower().endswith(".ply"):
+            info = _ply_file_info(value)
+            if info is not None:
+                found[(info["subfolder"], info["filename"])] = info
+        elif isinstance(value, dict):
+            if str(value.get("filename", "")).lower().endswith(".ply"):
+                info = {"filename": value["filename"], "subfolder": value.get("subfolder", ""),
+                        "type": value.get("type", "output")}
+                found[(info["subfolder"], info["filename"])] = info
+            else:
+                for item in value.values():
+                    scan(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                scan(item)
+
+    scan(history.get("outputs", {}))
+    if found:
+        return list(found.values())
+
+    output_dir = _comfy_dir("output")
+    for node in workflow.values():
+        if node.get("class_type") not in SPLAT_NODE_TYPES:
+            continue
+        prefix = node.get("inputs", {}).get("output_prefix")
+        # Untagged prefixes are shared by every prompt, so their files cannot be attributed
+        if not isinstance(prefix, str) or "/" not in prefix:
+            continue
+        try:
+            candidates = list(output_dir.glob(f"{prefix}*.ply")) + list(output_dir.glob(f"{prefix}/*.ply"))
+            fresh = [path for path in candidates if path.stat().st_mtime >= since]
+        except (OSError, ValueError):
+            continue
+        for path in fresh or candidates:
+            info = _ply_file_info(str(path))
+            if info is not None:
+                found[(info["subfolder"], info["filename"])] = info
+    return list(found.values())
@@ -0,0 +1,977 @@
+"""Sync and async ComfyUI clients: HTTP with retries, websocket events, local file transport."""
+
+import asyncio
+import collections
+import json
+import logging
+import mmap
+import os
+import random
+import signal
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .config import (CANCEL_GRACE, CANCEL_TIMEOUT, COMFYUI_INPUT_FOLDER, COMFYUI_LOCAL_MMAP, COMFYUI_OUTPUT_FOLDER,
+                     COMFYUI_PATH, COMFYUI_TRANSPORT, COMFYUI_URL, COMFYUI_USE_WEBSOCKET, HTTP_BACKOFF_BASE,
+                     HTTP_BACKOFF_MAX, HTTP_CONNECT_TIMEOUT, HTTP_IDEMPOTENT_METHODS, HTTP_KEEPALIVE_TIMEOUT,
+                     HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_RETRY_STATUSES, POLL_BACKOFF, POLL_INTERVAL_MAX,
+                     POLL_INTERVAL_MIN, WAIT_ABORT_CHECK_INTERVAL, WS_CONNECT_TIMEOUT, WS_HISTORY_CHECK_INTERVAL,
+                     WS_UNCLAIMED_EVENTS, WS_UNCLAIMED_PROMPTS)
+from .metrics import _record_status_event, _record_vram, metrics
+
+logger = logging.getLogger(__name__)
+
+
+if websocket is not None:
+    _WS_ERRORS = (ConnectionError, OSError, websocket.WebSocketException)
+else:
+    _WS_ERRORS = (ConnectionError, OSError)
+
+class PromptAbandoned(Exception):
+    """Raised by ComfyClient.wait_for_completion when its abort signal is set."""
+
+
+# Waiting for a prompt was given up on (as opposed to the prompt failing), so
+# it may still be queued or running and is cancelled
+_ABANDON_ERRORS = (
+    (TimeoutError, asyncio.TimeoutError, asyncio.CancelledError, PromptAbandoned, requests.RequestException,
+     *_WS_ERRORS)
+    + ((aiohttp.ClientError,) if aiohttp is not None else ())
+)
+
+
+#======================================================================
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Return the pooled keep-alive HTTP session shared by the whole worker process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Connection"] = "keep-alive"
+            _session = session
+        return _session
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Capped exponential backoff with jitter for retry number `attempt` (0-based)."""
+    return min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def _is_final_event(event: Dict[str, Any]) -> bool:
+    """True for the websocket message that ends a prompt's execution."""
+    event_type = event.get("type")
+    if event_type == "executing":
+        return (event.get("data") or {}).get("node") is None
+    return event_type in ("execution_error", "execution_interrupted")
+
+
+def _queue_state(queue_info: Dict[str, Any], prompt_id: str) -> str:
+    """Where a prompt is in a /queue response: "running", "pending" or "done"."""
+    for state in ("running", "pending"):
+        if any(len(item) > 1 and item[1] == prompt_id for item in queue_info.get(f"queue_{state}", [])):
+            return state
+    return "done"
+
+
+def _check_history_status(history: Dict) -> None:
+    status = history.get("status", {})
+    if status.get("status_str") == "error":
+        msg = json.dumps(status, indent=2, ensure_ascii=False)
+        raise RuntimeError(f"Execution failed:\n{msg}")
+
+
+def request_with_retry(
+    method: str,
+    url: str,
+    timeout: float,
+    retry: Optional[bool] = None,
+    session: Optional[requests.Session] = None,
+    **kwargs,
+) -> requests.Response:
+    """
+    Issue an HTTP request on the pooled session.
+
+    Idempotent methods are retried on connection errors, timeouts and
+    gateway statuses with capped, jittered exponential backoff. Pass
+    retry=True/False to override the method-based default.
+
+    Args:
+        method: HTTP method
+        url: Absolute URL
+        timeout: Read timeout in seconds (connect timeout is HTTP_CONNECT_TIMEOUT)
+        retry: Force retries on or off
+        session: Session to use instead of the shared one
+    """
+    session = session or get_session()
+    method = method.upper()
+    if retry is None:
+        retry = method in HTTP_IDEMPOTENT_METHODS
+    attempts = HTTP_RETRIES + 1 if retry else 1
+
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        try:
+            response = session.request(method, url, timeout=(HTTP_CONNECT_TIMEOUT, timeout), **kwargs)
+            if response.status_code not in HTTP_RETRY_STATUSES or last_attempt:
+                return response
+            reason = f"HTTP {response.status_code}"
+            response.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if last_attempt:
+                raise
+            reason = str(e)
+
+        delay = _backoff_delay(attempt)
+        logger.warning("%s %s failed (%s), retry %d/%d in %.2fs",
+                       method, url, reason, attempt + 1, attempts - 1, delay)
+        time.sleep(delay)
+
+
+#======================================================================
+class ComfyClient:
+    """Synchronous client for the ComfyUI REST API."""
+
+    def __init__(
+        self,
+        server_url: str,
+        timeout: int = 600,
+        use_websocket: bool = COMFYUI_USE_WEBSOCKET,
+        session: Optional[requests.Session] = None,
+        transport: str = COMFYUI_TRANSPORT,
+    ):
+        self.server_url = server_url.rstrip("/")
+        self.timeout = timeout
+        self.session = session or get_session()
+        self.transport = transport
+        self.client_id = str(uuid.uuid4())
+        self.use_websocket = use_websocket and websocket is not None
+        self._ws = None
+        # Prompts seen finishing while waiting on another one (batched submissions)
+        self._finished: collections.deque = collections.deque(maxlen=256)
+
+    def _url(self, path: str) -> str:
+        return f"{self.server_url}/{path.lstrip('/')}"
+
+    def _request(self, method: str, path: str, timeout: Optional[float] = None,
+                 retry: Optional[bool] = None, **kwargs) -> requests.Response:
+        return request_with_retry(
+            method, self._url(path), timeout=timeout or self.timeout,
+            retry=retry, session=self.session, **kwargs,
+        )
+
+    def _ws_url(self) -> str:
+        scheme, rest = self.server_url.split("://", 1)
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        return f"{ws_scheme}://{rest}/ws?clientId={self.client_id}"
+
+    def _connect_ws(self):
+        """Return (socket, freshly_connected); socket is None when unavailable."""
+        if not self.use_websocket:
+            return None, False
+        if self._ws is not None:
+            return self._ws, False
+        try:
+            self._ws = websocket.create_connection(self._ws_url(), timeout=WS_CONNECT_TIMEOUT)
+        except Exception as e:
+            logger.warning("WebSocket unavailable (%s), using polling", e)
+            self._ws = None
+            return None, False
+        return self._ws, True
+
+    def _close_ws(self) -> None:
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+
+    def close(self) -> None:
+        self._close_ws()
+
+    def check_connection(self) -> bool:
+        try:
+            response = self._request("GET", "/system_stats", timeout=10)
+            response.raise_for_status()
+            stats = response.json()
+            _record_vram(stats)
+            devices = stats.get("devices", [])
+            if devices:
+                dev = devices[0]
+                vram = dev.get("vram_total", 0) / (1024 ** 3)
+                logger.info(
+                    "Client connected | GPU: %s | VRAM: %.1f GB",
+                    dev.get("name", "unknown"), vram,
+                )
+            return True
+        except Exception as e:
+            logger.error("Connect failed: %s", e)
+            metrics.counter("connect_failures", "Failed ComfyUI connection checks").inc()
+            return False
+
+    def upload_image(self, image_path: str, subfolder: str = "", overwrite: bool = True) -> str:
+        path = Path(image_path)
+        if not path.exists():
+            raise FileNotFoundError(f"Image not found: {path}")
+
+        data = {"overwrite": str(overwrite).lower()}
+        if subfolder:
+            data["subfolder"] = subfolder
+
+        # Overwriting uploads are idempotent, so they may be retried safely
+        files = {"image": (path.name, path.read_bytes(), "image/png")}
+        response = self._request("POST", "/upload/image", files=files, data=data, retry=overwrite)
+        response.raise_for_status()
+        result = response.json()
+
+        filename = result.get("name", path.name)
+        logger.info("Uploaded %s -> %s", path.name, filename)
+        return filename
+
+    def upload_stream(self, chunks: Iterable[bytes], filename: str, content_type: str = "image/png",
+                      subfolder: str = "", overwrite: bool = True) -> str:
+        """
+        Upload an image from an iterable of byte chunks without buffering it.
+
+        The multipart body is sent with chunked transfer encoding, so memory
+        use is bounded by the chunk size. A consumed stream cannot be
+        replayed, so the upload is never retried.
+        """
+        fields = {"overwrite": str(overwrite).lower()}
+        if subfolder:
+            fields["subfolder"] = subfolder
+
+        boundary = uuid.uuid4().hex
+        body = _multipart_stream(boundary, fields, "image", filename, content_type, chunks)
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        response = self._request("POST", "/upload/image", data=body, headers=headers, retry=False)
+        response.raise_for_status()
+        result = response.json()
+
+        uploaded = result.get("name", filename)
+        logger.info("Uploaded %s -> %s", filename, uploaded)
+        return uploaded
+
+    def queue_prompt(self, workflow: Dict[str, Any]) -> str:
+        payload = {"prompt": workflow, "client_id": self.client_id}
+
+        # Subscribe before queueing so no execution event can be missed
+        self._connect_ws()
+
+        response = self._request("POST", "/prompt", json=payload)
+        if response.status_code != 200:
+            logger.error("ComfyUI /prompt error %s: %s", response.status_code, response.text)
+        response.raise_for_status()
+        result = response.json()
+
+        if "error" in result:
+            raise RuntimeError(f"ComfyUI queue error: {result['error']}")
+
+        prompt_id = result["prompt_id"]
+        logger.info("Queued prompt %s", prompt_id)
+        return prompt_id
+
+    def get_history(self, prompt_id: str) -> Optional[Dict]:
+        response = self._request("GET", f"/history/{prompt_id}")
+        response.raise_for_status()
+        data = response.json()
+        return data.get(prompt_id)
+
+    def iter_events(self, prompt_id: str, deadline: float,
+                    abort: Optional[threading.Event] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield ComfyUI websocket messages for a prompt until it stops executing.
+
+        The last message is either `executing` with `node: null` or an
+        execution error/interrupt. Raises ConnectionError when the socket
+        is unavailable so callers can fall back to polling, and
+        PromptAbandoned soon after `abort` is set.
+        """
+        ws, fresh = self._connect_ws()
+        if ws is None:
+            raise ConnectionError("ComfyUI websocket unavailable")
+
+        # A socket opened after queueing may have missed the final event
+        if prompt_id in self._finished or (fresh and self.get_history(prompt_id) is not None):
+            return
+
+        checked = time.time()
+        while True:
+            if abort is not None and abort.is_set():
+                raise PromptAbandoned(prompt_id)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Prompt {prompt_id} timed out after {self.timeout}s")
+
+            wait = WAIT_ABORT_CHECK_INTERVAL if abort is not None else WS_HISTORY_CHECK_INTERVAL
+            ws.settimeout(min(wait, remaining))
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                # Safety net for events lost across a reconnect
+                if time.time() - checked >= WS_HISTORY_CHECK_INTERVAL:
+                    checked = time.time()
+                    if self.get_history(prompt_id) is not None:
+                        return
+                continue
+
+            if not isinstance(message, str):
+                continue  # binary preview frames
+            event = json.loads(message)
+            _record_status_event(event)
+            data = event.get("data") or {}
+            if data.get("prompt_id") != prompt_id:
+                if _is_final_event(event):
+                    self._finished.append(data.get("prompt_id"))
+                continue
+
+            yield event
+            if _is_final_event(event):
+                return
+
+    def _poll_history(self, prompt_id: str, start: float, max_interval: float,
+                      abort: Optional[threading.Event] = None) -> Dict:
+        """Poll /history starting fast and backing off towards max_interval."""
+        interval = min(POLL_INTERVAL_MIN, max_interval)
+        while True:
+            if time.time() - start > self.timeout:
+                raise TimeoutError(f"Prompt {prompt_id} timed out after {self.timeout}s")
+
+            history = self.get_history(prompt_id)
+            if history is not None:
+                return history
+
+            if abort is None:
+                time.sleep(interval)
+            elif abort.wait(interval):
+                raise PromptAbandoned(prompt_id)
+            interval = min(interval * POLL_BACKOFF, max_interval)
+
+    def wait_for_completion(
+        self,
+        prompt_id: str,
+        poll_interval: float = POLL_INTERVAL_MAX,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+        abort: Optional[threading.Event] = None,
+    ) -> Dict:
+        """
+        Wait for a prompt and return its history entry. Setting `abort`
+        (from another thread) makes the wait raise PromptAbandoned, so a
+        waiter nobody needs stops reading the shared websocket.
+        """
+        start = time.time()
+        logger.info("Waiting for prompt %s …", prompt_id[:12])
+
+        history = None
+        if self.use_websocket:
+            try:
+                for event in self.iter_events(prompt_id, start + self.timeout, abort):
+                    if on_event is not None:
+                        on_event(event)
+                history = self.get_history(prompt_id)
+            except TimeoutError:
+                raise
+            except _WS_ERRORS as e:
+                logger.warning("WebSocket wait failed (%s), falling back to polling", e)
+                self._close_ws()
+
+        if history is None:
+            history = self._poll_history(prompt_id, start, poll_interval, abort)
+
+        _check_history_status(history)
+        logger.info("Prompt %s completed in %.1fs", prompt_id[:12], time.time() - start)
+        return history
+
+    def get_queue(self) -> Dict[str, Any]:
+        """ComfyUI's /queue: the running and pending prompts."""
+        response = self._request("GET", "/queue", timeout=CANCEL_TIMEOUT, retry=False)
+        response.raise_for_status()
+        return response.json()
+
+    def free(self, unload_models: bool = True, free_memory: bool = False) -> None:
+        """Ask ComfyUI to unload models and/or drop cached memory after the running prompt."""
+        body = {"unload_models": unload_models, "free_memory": free_memory}
+        self._request("POST", "/free", json=body, timeout=CANCEL_TIMEOUT).raise_for_status()
+
+    def cancel_prompt(self, prompt_id: str, grace: float = CANCEL_GRACE) -> str:
+        """
+        Stop a prompt nobody will collect so it frees the GPU: delete it from
+        the queue when pending, interrupt it when running, then delete its
+        /history entry. A prompt that already finished is left as it is.
+        Best effort; never raises.
+
+        Returns:
+            The state the prompt was found in ("pending", "running" or
+            "done"), or "failed" when ComfyUI could not be reached
+        """
+        def post(path: str, body: Dict[str, Any]) -> None:
+            self._request("POST", path, json=body, timeout=CANCEL_TIMEOUT, retry=False).raise_for_status()
+
+        try:
+            response = self._request("GET", "/queue", timeout=CANCEL_TIMEOUT, retry=False)
+            response.raise_for_status()
+            state = _queue_state(response.json(), prompt_id)
+            if state == "pending":
+                post("/queue", {"delete": [prompt_id]})
+            elif state == "running":
+                # Scoped to the prompt so a newer prompt is never interrupted instead
+                post("/interrupt", {"prompt_id": prompt_id})
+                deadline = time.time() + grace
+                while time.time() < deadline and self.get_history(prompt_id) is None:
+                    time.sleep(POLL_INTERVAL_MIN)
+            if state != "done":
+                post("/history", {"delete": [prompt_id]})
+        except Exception as e:
+            logger.warning("Could not cancel prompt %s: %s", prompt_id[:12], e)
+            state = "failed"
+        logger.info("Cancelled prompt %s (%s)", prompt_id[:12], state)
+        metrics.counter("prompts_cancelled", "Abandoned prompts removed from ComfyUI").inc(state=state)
+        return state
+
+    def download_image(self, filename: str, subfolder: str = "", img_type: str = "output") -> bytes:
+        """Download image from ComfyUI."""
+        params = {"filename": filename, "type": img_type, "subfolder": subfolder}
+        response = self._request("GET", "/view", params=params)
+        response.raise_for_status()
+        return response.content
+
+    def fetch_output(self, img_info: Dict[str, Any]) -> Union[bytes, mmap.mmap]:
+        """
+        Return the bytes of an image listed by get_output_images.
+
+        With the local transport the file is read straight from the ComfyUI
+        output folder (memory-mapped when COMFYUI_LOCAL_MMAP is set); /view is
+        used otherwise or when the file is not reachable on disk.
+        """
+        if self.transport == "local":
+            data = _read_local_output(img_info)
+            if data is not None:
+                return data
+        return self.download_image(img_info["filename"], img_info.get("subfolder", ""),
+                                   img_info.get("type", "output"))
+
+    @staticmethod
+    def get_output_images(history: Dict) -> Dict[str, List[Dict]]:
+        """Extract output image info from history."""
+        outputs: Dict[str, List[Dict]] = {}
+        for node_id, node_out in history.get("outputs", {}).items():
+            if "images" in node_out:
+                outputs[node_id] = node_out["images"]
+        return outputs
+
+_client: Optional[ComfyClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ComfyClient:
+    """Return the ComfyClient reused across all jobs handled by this worker."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ComfyClient(COMFYUI_URL)
+        return _client
+
+#======================================================================
+class AsyncComfyClient:
+    """Asyncio client for the ComfyUI REST API, built on aiohttp."""
+
+    def __init__(self, server_url: str, timeout: int = 600, use_websocket: bool = COMFYUI_USE_WEBSOCKET,
+                 transport: str = COMFYUI_TRANSPORT):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for AsyncComfyClient")
+        self.server_url = server_url.rstrip("/")
+        self.timeout = timeout
+        self.transport = transport
+        self.client_id = str(uuid.uuid4())
+        self.use_websocket = use_websocket
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._ws: Optional["aiohttp.ClientWebSocketResponse"] = None
+        self._finished: collections.deque = collections.deque(maxlen=256)
+        # One reader task per socket routes events to the waiter of each prompt
+        self._reader: Optional[asyncio.Task] = None
+        self._ws_lock: Optional[asyncio.Lock] = None
+        self._listeners: Dict[str, asyncio.Queue] = {}
+        self._unclaimed: "collections.OrderedDict[str, collections.deque]" = collections.OrderedDict()
+
+    _url = ComfyClient._url
+    _ws_url = ComfyClient._ws_url
+    get_output_images = staticmethod(ComfyClient.get_output_images)
+
+    async def _get_session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+            # Requests pass their own timeouts; the session's bounds the websocket handshake
+            handshake = aiohttp.ClientTimeout(total=WS_CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=handshake)
+        return self._session
+
+    async def close(self) -> None:
+        await self._close_ws()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        timeout: Optional[float] = None,
+        retry: Optional[bool] = None,
+        data: Any = None,
+        **kwargs,
+    ) -> "aiohttp.ClientResponse":
+        """
+        Issue a request with the same retry policy as request_with_retry.
+
+        `url` may be absolute or a ComfyUI path. `data` may be a zero-argument
+        callable so that single-use bodies (FormData) are rebuilt per attempt.
+        The caller owns the returned response and must release it.
+        """
+        session = await self._get_session()
+        if "://" not in url:
+            url = self._url(url)
+        method = method.upper()
+        if retry is None:
+            retry = method in HTTP_IDEMPOTENT_METHODS
+        attempts = HTTP_RETRIES + 1 if retry else 1
+        client_timeout = aiohttp.ClientTimeout(
+            total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=timeout or self.timeout,
+        )
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            body = data() if callable(data) else data
+            try:
+                response = await session.request(method, url, data=body, timeout=client_timeout, **kwargs)
+                if response.status not in HTTP_RETRY_STATUSES or last_attempt:
+                    return response
+                reason = f"HTTP {response.status}"
+                response.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                reason = str(e) or type(e).__name__
+
+            delay = _backoff_delay(attempt)
+            logger.warning("%s %s failed (%s), retry %d/%d in %.2fs",
+                           method, url, reason, attempt + 1, attempts - 1, delay)
+            await asyncio.sleep(delay)
+
+    async def _connect_ws(self):
+        """Return (socket, freshly_connected); socket is None when unavailable."""
+        if not self.use_websocket:
+            return None, False
+        if self._ws is not None and not self._ws.closed:
+            return self._ws, False
+        if self._ws_lock is None:
+            self._ws_lock = asyncio.Lock()
+        # Concurrent jobs share one socket; only the first opens it
+        async with self._ws_lock:
+            if self._ws is not None and not self._ws.closed:
+                return self._ws, False
+            try:
+                session = await self._get_session()
+                self._ws = await session.ws_connect(
+                    self._ws_url(), heartbeat=30,
+                    timeout=aiohttp.ClientWSTimeout(ws_receive=None, ws_close=WS_CONNECT_TIMEOUT),
+                )
+            except Exception as e:
+                logger.warning("WebSocket unavailable (%s), using polling", e)
+                self._ws = None
+                return None, False
+            self._reader = asyncio.ensure_future(self._read_ws(self._ws))
+            return self._ws, True
+
+    async def _close_ws(self) -> None:
+        if self._ws is not None:
+            try:
+                await self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+    async def _read_ws(self, ws: "aiohttp.ClientWebSocketResponse") -> None:
+        """
+        Sole reader of a socket: concurrent jobs cannot each call receive(),
+        so events are dispatched by prompt_id to the queue of whoever waits
+        on that prompt. Waiters get a ConnectionError when the socket ends.
+        """
+        error = ConnectionError("ComfyUI websocket closed")
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    self._dispatch(json.loads(message.data))
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = ConnectionError(f"ComfyUI websocket failed: {e}")
+        finally:
+            if self._ws is ws:
+                self._ws = None
+            for listener in self._listeners.values():
+                listener.put_nowait(error)
+
+    def _dispatch(self, event: Dict[str, Any]) -> None:
+        _record_status_event(event)
+        prompt_id = (event.get("data") or {}).get("prompt_id")
+        if prompt_id is None:
+            return
+        if _is_final_event(event):
+            self._finished.append(prompt_id)
+        listener = self._listeners.get(prompt_id)
+        if listener is not None:
+            listener.put_nowait(event)
+            return
+        # Events can arrive before the job that queued the prompt starts waiting
+        if prompt_id not in self._unclaimed:
+            self._unclaimed[prompt_id] = collections.deque(maxlen=WS_UNCLAIMED_EVENTS)
+            while len(self._unclaimed) > WS_UNCLAIMED_PROMPTS:
+                self._unclaimed.popitem(last=False)
+        self._unclaimed[prompt_id].append(event)
+
+    def _subscribe(self, prompt_id: str) -> asyncio.Queue:
+        listener: asyncio.Queue = asyncio.Queue()
+        for event in self._unclaimed.pop(prompt_id, ()):
+            listener.put_nowait(event)
+        self._listeners[prompt_id] = listener
+        return listener
+
+    async def check_connection(self) -> bool:
+        try:
+            async with await self.request("GET", "/system_stats", timeout=10) as response:
+                response.raise_for_status()
+                stats = await response.json()
+            _record_vram(stats)
+            devices = stats.get("devices", [])
+            if devices:
+                dev = devices[0]
+                vram = dev.get("vram_total", 0) / (1024 ** 3)
+                logger.info(
+                    "Client connected | GPU: %s | VRAM: %.1f GB",
+                    dev.get("name", "unknown"), vram,
+                )
+            return True
+        except Exception as e:
+            logger.error("Connect failed: %s", e)
+            metrics.counter("connect_failures", "Failed ComfyUI connection checks").inc()
+            return False
+
+    async def upload_image_bytes(self, data: Union[bytes, AsyncIterable[bytes]], filename: str,
+                                 content_type: str = "image/png", subfolder: str = "",
+                                 overwrite: bool = True) -> str:
+        """
+        Upload an image given as bytes or as an async iterable of chunks.
+
+        Chunked sources are streamed straight into the multipart body and,
+        being single-use, are never retried.
+        """
+        def form():
+            fd = aiohttp.FormData()
+            fd.add_field("image", data, filename=filename, content_type=content_type)
+            fd.add_field("overwrite", str(overwrite).lower())
+            if subfolder:
+                fd.add_field("subfolder", subfolder)
+            return fd
+
+        retry = overwrite and isinstance(data, bytes)
+        async with await self.request("POST", "/upload/image", data=form, retry=retry) as response:
+            response.raise_for_status()
+            result = await response.json()
+
+        uploaded = result.get("name", filename)
+        logger.info("Uploaded %s -> %s", filename, uploaded)
+        return uploaded
+
+    async def queue_prompt(self, workflow: Dict[str, Any]) -> str:
+        payload = {"prompt": workflow, "client_id": self.client_id}
+
+        # Subscribe before queueing so no execution event can be missed
+        await self._connect_ws()
+
+        async with await self.request("POST", "/prompt", json=payload) as response:
+            if response.status != 200:
+                logger.error("ComfyUI /prompt error %s: %s", response.status, await response.text())
+            response.raise_for_status()
+            result = await response.json()
+
+        if "error" in result:
+            raise RuntimeError(f"ComfyUI queue error: {result['error']}")
+
+        prompt_id = result["prompt_id"]
+        logger.info("Queued prompt %s", prompt_id)
+        return prompt_id
+
+    async def get_history(self, prompt_id: str) -> Optional[Dict]:
+        async with await self.request("GET", f"/history/{prompt_id}") as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data.get(prompt_id)
+
+    async def iter_events(self, prompt_id: str, deadline: float) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async counterpart of ComfyClient.iter_events. Several jobs may wait
+        at once; each reads its prompt's events from the dispatcher.
+        """
+        ws, fresh = await self._connect_ws()
+        if ws is None:
+            raise ConnectionError("ComfyUI websocket unavailable")
+
+        events = self._subscribe(prompt_id)
+        try:
+            if events.empty() and (
+                prompt_id in self._finished or (fresh and await self.get_history(prompt_id) is not None)
+            ):
+                return
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"Prompt {prompt_id} timed out after {self.timeout}s")
+
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=min(WS_HISTORY_CHECK_INTERVAL, remaining))
+                except asyncio.TimeoutError:
+                    if await self.get_history(prompt_id) is not None:
+                        return
+                    continue
+                if isinstance(event, Exception):
+                    raise event
+
+                yield event
+                if _is_final_event(event):
+                    return
+        finally:
+            self._listeners.pop(prompt_id, None)
+
+    async def _poll_history(self, prompt_id: str, start: float, max_interval: float) -> Dict:
+        interval = min(POLL_INTERVAL_MIN, max_interval)
+        while True:
+            if time.time() - start > self.timeout:
+                raise TimeoutError(f"Prompt {prompt_id} timed out after {self.timeout}s")
+
+            history = await self.get_history(prompt_id)
+            if history is not None:
+                return history
+
+            await asyncio.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, max_interval)
+
+    async def wait_for_completion(
+        self,
+        prompt_id: str,
+        poll_interval: float = POLL_INTERVAL_MAX,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict:
+        start = time.time()
+        logger.info("Waiting for prompt %s …", prompt_id[:12])
+
+        history = None
+        if self.use_websocket:
+            try:
+                async for event in self.iter_events(prompt_id, start + self.timeout):
+                    if on_event is not None:
+                        on_event(event)
+                history = await self.get_history(prompt_id)
+            except (TimeoutError, asyncio.TimeoutError):
+                raise
+            except (aiohttp.ClientError, ConnectionError, OSError) as e:
+                logger.warning("WebSocket wait failed (%s), falling back to polling", e)
+                await self._close_ws()
+
+        if history is None:
+            history = await self._poll_history(prompt_id, start, poll_interval)
+
+        _check_history_status(history)
+        logger.info("Prompt %s completed in %.1fs", prompt_id[:12], time.time() - start)
+        return history
+
+    async def get_queue(self) -> Dict[str, Any]:
+        """Async counterpart of ComfyClient.get_queue."""
+        async with await self.request("GET", "/queue", timeout=CANCEL_TIMEOUT, retry=False) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def free(self, unload_models: bool = True, free_memory: bool = False) -> None:
+        """Async counterpart of ComfyClient.free."""
+        body = {"unload_models": unload_models, "free_memory": free_memory}
+        async with await self.request("POST", "/free", json=body, timeout=CANCEL_TIMEOUT) as response:
+            response.raise_for_status()
+
+    async def cancel_prompt(self, prompt_id: str, grace: float = CANCEL_GRACE) -> str:
+        """Async counterpart of ComfyClient.cancel_prompt."""
+        async def post(path: str, body: Dict[str, Any]) -> None:
+            async with await self.request("POST", path, json=body, timeout=CANCEL_TIMEOUT, retry=False) as response:
+                response.raise_for_status()
+
+        try:
+            async with await self.request("GET", "/queue", timeout=CANCEL_TIMEOUT, retry=False) as response:
+                response.raise_for_status()
+                state = _queue_state(await response.json(), prompt_id)
+            if state == "pending":
+                await post("/queue", {"delete": [prompt_id]})
+            elif state == "running":
+                await post("/interrupt", {"prompt_id": prompt_id})
+                deadline = time.time() + grace
+                while time.time() < deadline and await self.get_history(prompt_id) is None:
+                    await asyncio.sleep(POLL_INTERVAL_MIN)
+            if state != "done":
+                await post("/history", {"delete": [prompt_id]})
+        except Exception as e:
+            logger.warning("Could not cancel prompt %s: %s", prompt_id[:12], e)
+            state = "failed"
+        logger.info("Cancelled prompt %s (%s)", prompt_id[:12], state)
+        metrics.counter("prompts_cancelled", "Abandoned prompts removed from ComfyUI").inc(state=state)
+        return state
+
+    async def download_image(self, filename: str, subfolder: str = "", img_type: str = "output") -> bytes:
+        """Download image from ComfyUI."""
+        params = {"filename": filename, "type": img_type, "subfolder": subfolder}
+        async with await self.request("GET", "/view", params=params) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def fetch_output(self, img_info: Dict[str, Any]) -> Union[bytes, mmap.mmap]:
+        """Async counterpart of ComfyClient.fetch_output."""
+        if self.transport == "local":
+            data = await asyncio.to_thread(_read_local_output, img_info)
+            if data is not None:
+                return data
+        return await self.download_image(img_info["filename"], img_info.get("subfolder", ""),
+                                         img_info.get("type", "output"))
+
+
+_async_client: Optional[AsyncComfyClient] = None
+
+
+def get_async_client() -> AsyncComfyClient:
+    """Return the AsyncComfyClient reused across all jobs handled by this worker."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncComfyClient(COMFYUI_URL)
+    return _async_client
+
+
+#======================================================================
+
+def _comfy_dir(img_type: str) -> Path:
+    folder = {"input": COMFYUI_INPUT_FOLDER, "output": COMFYUI_OUTPUT_FOLDER}.get(img_type, img_type)
+    return Path(COMFYUI_PATH) / folder
+
+
+def _local_file(img_type: str, filename: str, subfolder: str = "") -> Optional[Path]:
+    """Resolve a ComfyUI file reference, refusing paths that escape its folder."""
+    base = _comfy_dir(img_type).resolve()
+    path = (base / subfolder / filename).resolve()
+    if base != path and base not in path.parents:
+        return None
+    return path
+
+
+def _read_local_output(img_info: Dict[str, Any]) -> Union[bytes, mmap.mmap, None]:
+    """Read an output file from disk, or return None so the caller can use HTTP."""
+    path = _local_file(img_info.get("type", "output"), img_info["filename"], img_info.get("subfolder", ""))
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            if COMFYUI_LOCAL_MMAP and os.fstat(f.fileno()).st_size > 0:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
+    except OSError as e:
+        logger.warning("Local read of %s failed (%s), falling back to /view", path, e)
+        return None
+
+
+def _local_input_dir() -> Optional[Path]:
+    """The ComfyUI input folder when it is writable from this process."""
+    input_dir = _comfy_dir("input")
+    try:
+        input_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    return input_dir if os.access(input_dir, os.W_OK) else None
+
+
+def _multipart_stream(boundary: str, fields: Dict[str, str], file_field: str, filename: str,
+                      content_type: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield a multipart/form-data body whose file part is streamed from `chunks`."""
+    for name, value in fields.items():
+        yield (f"--{boundary}\r\n"
+               f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+               f"{value}\r\n").encode()
+    yield (f"--{boundary}\r\n"
+           f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+           f"Content-Type: {content_type}\r\n\r\n").encode()
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def _build_image_results(output_images: Dict[str, List[Dict]]) -> List[Dict[str, Any]]:
+    results = []
+    for node_id, images in output_images.items():
+        for img_info in images:
+            results.append({
+                "node_id": node_id,
+                "filename": img_info["filename"],
+                "subfolder": img_info.get("subfolder", ""),
+                "type": img_info.get("type", "output"),
+            })
+    return results
+
+
+# Prompts this worker queued and has not collected yet; abandoned ones are
+# cancelled so they stop holding the GPU
+active_prompts: Set[str] = set()
+
+
+def cancel_active_prompts(grace: float = 0) -> None:
+    """Cancel every prompt still in active_prompts (used on shutdown)."""
+    if not active_prompts:
+        return
+    client = ComfyClient(COMFYUI_URL, timeout=CANCEL_TIMEOUT, use_websocket=False)
+    for prompt_id in list(active_prompts):
+        client.cancel_prompt(prompt_id, grace=grace)
+        active_prompts.discard(prompt_id)
+
+
+def install_sigterm_handler() -> None:
+    """Cancel active prompts on SIGTERM, then defer to the previous handler."""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm(signum, frame):
+        logger.warning("SIGTERM received, cancelling %d active prompt(s)", len(active_prompts))
+        cancel_active_prompts()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
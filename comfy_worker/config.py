@@ -0,0 +1,163 @@
+"""Worker settings, read from the environment once at import."""
+
+import os
+
+
+# ── Configuration ────────────────────────────────────────────────────
+COMFYUI_PORT = int(os.environ.get("COMFYUI_PORT", "8188"))
+COMFYUI_URL = f"http://127.0.0.1:{COMFYUI_PORT}"
+COMFYUI_PATH = '/workspace/ComfyUI/'
+COMFYUI_INPUT_FOLDER = os.environ.get("COMFYUI_INPUT_FOLDER", "input")
+COMFYUI_OUTPUT_FOLDER = os.environ.get("COMFYUI_OUTPUT_FOLDER", "output")
+
+# Completion tracking: websocket events first, adaptive /history polling as fallback
+COMFYUI_USE_WEBSOCKET = os.environ.get("COMFYUI_USE_WEBSOCKET", "1") == "1"
+WS_CONNECT_TIMEOUT = float(os.environ.get("WS_CONNECT_TIMEOUT", "5"))
+WS_HISTORY_CHECK_INTERVAL = float(os.environ.get("WS_HISTORY_CHECK_INTERVAL", "5"))
+POLL_INTERVAL_MIN = float(os.environ.get("POLL_INTERVAL_MIN", "0.1"))
+POLL_INTERVAL_MAX = float(os.environ.get("POLL_INTERVAL_MAX", "2.0"))
+POLL_BACKOFF = float(os.environ.get("POLL_BACKOFF", "1.5"))
+# Cancelling abandoned prompts: per-request timeout, and how long to wait for
+# an interrupted prompt to land in /history so its entry can be deleted
+CANCEL_TIMEOUT = float(os.environ.get("CANCEL_TIMEOUT", "10"))
+CANCEL_GRACE = float(os.environ.get("CANCEL_GRACE", "5"))
+
+# Handler mode: "sync", "async", "stream"/"async_stream" (generator handlers
+# yielding progress and outputs as they are produced) or "concurrent" (async
+# handler admitting JOB_CONCURRENCY jobs at once, see SCHEDULER_LOOKAHEAD)
+HANDLER_MODE = os.environ.get("HANDLER_MODE", "sync")
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "3"))
+# Concurrent mode: prompts are handed to ComfyUI SCHEDULER_DEPTH at a time,
+# jobs needing the models already loaded first; a job passed over
+# SCHEDULER_MAX_SKIPS times goes next regardless. The scheduler only has a
+# choice while jobs are waiting, so with it on the worker admits at least
+# SCHEDULER_DEPTH + SCHEDULER_LOOKAHEAD jobs (more if JOB_CONCURRENCY is higher)
+AFFINITY_SCHEDULING = os.environ.get("AFFINITY_SCHEDULING", "1") == "1"
+SCHEDULER_DEPTH = int(os.environ.get("SCHEDULER_DEPTH", "2"))
+SCHEDULER_MAX_SKIPS = int(os.environ.get("SCHEDULER_MAX_SKIPS", "3"))
+SCHEDULER_LOOKAHEAD = int(os.environ.get("SCHEDULER_LOOKAHEAD", "3"))
+# Events kept for prompts nobody is waiting on yet (async websocket dispatcher)
+WS_UNCLAIMED_PROMPTS = 64
+WS_UNCLAIMED_EVENTS = 1000
+# How often a waiter given an abort signal checks it
+WAIT_ABORT_CHECK_INTERVAL = 0.25
+
+# Workflow optimisation passes applied before queue_prompt
+WORKFLOW_OPTIMIZE = os.environ.get("WORKFLOW_OPTIMIZE", "1") == "1"
+OUTPUT_NODE_TYPES = {"SaveImage"}
+# Pipeline variants, matched against the model names of each output's loaders
+PIPELINE_VARIANTS = os.environ.get("PIPELINE_VARIANTS", "2511,2509").split(",")
+VARIANT_LOADER_INPUTS = {"UNETLoader": "unet_name", "CheckpointLoaderSimple": "ckpt_name"}
+# Node types whose output depends only on class_type and inputs, so
+# structurally identical instances can be merged into one
+MERGEABLE_NODE_TYPES = set(filter(None, os.environ.get("MERGEABLE_NODE_TYPES", ",".join([
+    "CheckpointLoaderSimple", "CLIPLoader", "CLIPVisionLoader", "DualCLIPLoader", "LoraLoader",
+    "LoraLoaderModelOnly", "UNETLoader", "VAELoader", "LoadSharpModel", "LoadImage",
+    "ImageScale", "ImageScaleBy", "ImageScaleToTotalPixels", "GetImageSize+",
+])).split(",")))
+# Sweeps: inputs a seed/prompt variant overrides; nodes depending on them are
+# fanned out per variant while everything upstream is shared
+SWEEP_SEED_INPUTS = {"KSampler": "seed", "KSamplerAdvanced": "noise_seed", "QwenImageIntegratedKSampler": "seed"}
+SWEEP_PROMPT_INPUTS = {"QwenImageIntegratedKSampler": "positive_prompt"}
+SWEEP_ENCODER_INPUTS = {"TextEncodeQwenImageEditPlus": "prompt", "CLIPTextEncode": "text"}
+SWEEP_MAX_VARIANTS = int(os.environ.get("SWEEP_MAX_VARIANTS", "16"))
+
+# Deterministic result cache keyed on the canonical workflow
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(COMFYUI_PATH, "cache", "results"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# How long a lookup waits for a write of the same key still in progress
+RESULT_CACHE_WRITE_WAIT = float(os.environ.get("RESULT_CACHE_WRITE_WAIT", "30"))
+# Cross-request cache of SHARP splat renders (GaussianViewer images, optionally PLYs)
+RENDER_CACHE_ENABLED = os.environ.get("RENDER_CACHE_ENABLED", "1") == "1"
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(COMFYUI_PATH, "cache", "renders"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(1024 ** 3)))
+RENDER_CACHE_PLY = os.environ.get("RENDER_CACHE_PLY", "0") == "1"
+RENDER_NODE_TYPES = {"GaussianViewer"}
+# Widget state stored by UI-only nodes that never affects results
+VOLATILE_INPUTS = {"rgthree_comparer"}
+
+# Output delivery: fetch, re-encode and return/store images produced by a job
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "4"))
+DELIVERY_DEFAULT_QUALITY = int(os.environ.get("DELIVERY_DEFAULT_QUALITY", "85"))
+DELIVERY_MIN_QUALITY = int(os.environ.get("DELIVERY_MIN_QUALITY", "40"))
+DELIVERY_QUALITY_STEP = int(os.environ.get("DELIVERY_QUALITY_STEP", "15"))
+OUTPUT_STORE_DIR = os.environ.get("OUTPUT_STORE_DIR", os.path.join(COMFYUI_PATH, "cache", "store"))
+OUTPUT_STORE_BUCKET = os.environ.get("OUTPUT_STORE_BUCKET", "outputs")
+
+# Gaussian-splat (PLY) outputs of SharpPredict
+SPLAT_NODE_TYPES = {"SharpPredict"}
+SPLAT_DEFAULT_SH_DEGREE = int(os.environ.get("SPLAT_DEFAULT_SH_DEGREE", "0"))
+
+# Batch jobs: one prompt per input image, queued back to back
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+
+# Health monitor: background polling of /system_stats and /queue; jobs read
+# the cached snapshot and only check directly when it is older than
+# HEALTH_STALE_AFTER seconds
+HEALTH_MONITOR_ENABLED = os.environ.get("HEALTH_MONITOR_ENABLED", "1") == "1"
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "2"))
+HEALTH_STALE_AFTER = float(os.environ.get("HEALTH_STALE_AFTER", "10"))
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", "5"))
+
+# Admission control: a job whose prompt would be queue position >=
+# ADMISSION_MAX_QUEUE waits up to ADMISSION_MAX_DELAY seconds for room; one
+# whose estimated wait (queue depth x average recent execution time) exceeds
+# ADMISSION_MAX_WAIT seconds is rejected straight away
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "8"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "300"))
+ADMISSION_MAX_DELAY = float(os.environ.get("ADMISSION_MAX_DELAY", "60"))
+ADMISSION_WINDOW = int(os.environ.get("ADMISSION_WINDOW", "20"))
+ADMISSION_DEFAULT_EXECUTION = float(os.environ.get("ADMISSION_DEFAULT_EXECUTION", "30"))
+
+# VRAM policy: before queueing a prompt, ask ComfyUI to unload models (/free)
+# only when the models it needs and does not hold would not fit in free VRAM
+# plus VRAM_HEADROOM_BYTES for activations
+VRAM_POLICY_ENABLED = os.environ.get("VRAM_POLICY_ENABLED", "1") == "1"
+VRAM_HEADROOM_BYTES = int(os.environ.get("VRAM_HEADROOM_BYTES", str(2 * 1024 ** 3)))
+# Model loaders: the input naming the weights file and the folders under
+# models/ it is looked up in to size it
+MODEL_LOADERS = {
+    "UNETLoader": ("unet_name", ("diffusion_models", "unet")),
+    "CLIPLoader": ("clip_name", ("text_encoders", "clip")),
+    "VAELoader": ("vae_name", ("vae",)),
+    "LoraLoaderModelOnly": ("lora_name", ("loras",)),
+    "LoraLoader": ("lora_name", ("loras",)),
+    "CheckpointLoaderSimple": ("ckpt_name", ("checkpoints",)),
+    "CLIPVisionLoader": ("clip_name", ("clip_vision",)),
+}
+
+# Metrics: in-process registry exposed in OpenMetrics text format on a local
+# port (0 = off) and/or rewritten to a file every METRICS_FILE_INTERVAL seconds
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.environ.get("METRICS_FILE_INTERVAL", "15"))
+METRICS_PREFIX = "comfy_worker"
+
+# Transport: "http" goes through /upload/image and /view; "local" reads and
+# writes the ComfyUI input/output folders directly (same box), HTTP as fallback
+COMFYUI_TRANSPORT = os.environ.get("COMFYUI_TRANSPORT", "http")
+COMFYUI_LOCAL_MMAP = os.environ.get("COMFYUI_LOCAL_MMAP", "0") == "1"
+
+# Input ingestion
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", "4"))
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", str(256 * 1024)))
+INGEST_MAX_BYTES = int(os.environ.get("INGEST_MAX_BYTES", str(64 * 1024 ** 2)))
+
+# Content-addressed input cache (needs the input folder visible to this process)
+INPUT_CACHE_ENABLED = os.environ.get("INPUT_CACHE_ENABLED", "1") == "1"
+INPUT_CACHE_TTL = float(os.environ.get("INPUT_CACHE_TTL", "3600"))
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+INPUT_CACHE_MIN_AGE = float(os.environ.get("INPUT_CACHE_MIN_AGE", "900"))
+
+# Process-lifetime HTTP transport
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_DOWNLOAD_TIMEOUT = float(os.environ.get("HTTP_DOWNLOAD_TIMEOUT", "120"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.2"))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "5"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_RETRY_STATUSES = {502, 503, 504}
+HTTP_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
@@ -0,0 +1,545 @@
+"""Output delivery: image re-encoding, object storage, splat packaging and job responses."""
+
+import asyncio
+import base64
+import concurrent.futures
+import contextvars
+import io
+import json
+import logging
+import mimetypes
+import mmap
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Collection, Dict, List, Optional, Set, Tuple, Union
+
+from .config import (DELIVERY_DEFAULT_QUALITY, DELIVERY_MIN_QUALITY, DELIVERY_QUALITY_STEP, DELIVERY_WORKERS,
+                     OUTPUT_STORE_BUCKET, OUTPUT_STORE_DIR, SPLAT_DEFAULT_SH_DEGREE)
+from .metrics import metrics
+from .client import AsyncComfyClient, ComfyClient
+from .caches import _ply_source, _ply_source_async, result_cache
+
+logger = logging.getLogger(__name__)
+
+
+IMAGE_FORMATS = {
+    # name: (Pillow format, MIME type, extension, lossy)
+    "png": ("PNG", "image/png", ".png", False),
+    "webp": ("WEBP", "image/webp", ".webp", True),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg", True),
+    "avif": ("AVIF", "image/avif", ".avif", True),
+}
+
+_delivery_pool = concurrent.futures.ThreadPoolExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix="delivery")
+
+
+class LocalObjectStore:
+    """
+    Filesystem stand-in for an S3-compatible bucket: objects are written
+    atomically to root/bucket/key and addressed as s3://bucket/key.
+    """
+
+    def __init__(self, root: str = OUTPUT_STORE_DIR, bucket: str = OUTPUT_STORE_BUCKET):
+        self.root = Path(root)
+        self.bucket = bucket
+
+    def put_object(self, key: str, body: bytes, content_type: str) -> Dict[str, Any]:
+        path = self.root / self.bucket / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}")
+        tmp.write_bytes(body)
+        os.replace(tmp, path)
+        return {"bucket": self.bucket, "key": key, "url": f"s3://{self.bucket}/{key}",
+                "content_type": content_type, "size": len(body)}
+
+
+output_store = LocalObjectStore()
+
+
+def _delivery_options(options: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Validate a job's "output" options; None means filenames only.
+
+    Keys:
+        delivery: "base64" (inline), "store" (object store) or "none"
+        format: "original", "png", "webp", "jpeg" or "avif"
+        quality: 1-100 for lossy formats
+        max_bytes: Budget for all encoded images of the job
+    """
+    if not options or options.get("delivery", "base64") == "none":
+        return None
+    opts = {
+        "delivery": options.get("delivery", "base64"),
+        "format": str(options.get("format", "original")).lower(),
+        "quality": int(options.get("quality", DELIVERY_DEFAULT_QUALITY)),
+        "max_bytes": options.get("max_bytes"),
+    }
+    if opts["delivery"] not in ("base64", "store"):
+        raise ValueError(f"Unknown output delivery: {opts['delivery']}")
+    if opts["format"] != "original" and opts["format"] not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown output format: {opts['format']}")
+    if opts["format"] == "avif":
+        from PIL import features
+        if not features.check("avif"):
+            raise ValueError("AVIF encoding is not available in this Pillow build")
+    return opts
+
+
+def encode_image(data: Union[bytes, mmap.mmap], fmt: str, quality: int,
+                 filename: str = "") -> Tuple[bytes, str]:
+    """Re-encode image bytes to `fmt`; returns (bytes, MIME type)."""
+    if fmt == "original":
+        return bytes(data), mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    from PIL import Image
+
+    pil_format, mime, _, lossy = IMAGE_FORMATS[fmt]
+    with Image.open(io.BytesIO(data)) as img:
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        if lossy:
+            img.save(buf, format=pil_format, quality=quality)
+        else:
+            img.save(buf, format=pil_format, optimize=True)
+    return buf.getvalue(), mime
+
+
+def _finish_delivery(images: List[Dict[str, Any]], blobs: List[Union[bytes, mmap.mmap]],
+                     encoded: List[Tuple[bytes, str]], opts: Dict[str, Any],
+                     prompt_id: str) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Apply the size budget and attach each image inline or as a store
+    reference. Images over budget are re-encoded at lower quality, then
+    skipped if they still do not fit.
+    """
+    fmt = opts["format"]
+    lossy = fmt in IMAGE_FORMATS and IMAGE_FORMATS[fmt][3]
+    budget = opts["max_bytes"]
+    total = 0
+    delivered = []
+    for image, blob, (body, mime) in zip(images, blobs, encoded):
+        quality = opts["quality"]
+        while budget is not None and total + len(body) > budget and lossy and quality > DELIVERY_MIN_QUALITY:
+            quality = max(DELIVERY_MIN_QUALITY, quality - DELIVERY_QUALITY_STEP)
+            body, mime = encode_image(blob, fmt, quality, image["filename"])
+
+        out = {**image, "format": fmt, "content_type": mime, "size": len(body)}
+        if lossy:
+            out["quality"] = quality
+        if budget is not None and total + len(body) > budget:
+            out["skipped"] = "size_budget"
+        elif opts["delivery"] == "base64":
+            out["data"] = base64.b64encode(body).decode("ascii")
+            total += len(body)
+        else:
+            ext = IMAGE_FORMATS[fmt][2] if fmt in IMAGE_FORMATS else Path(image["filename"]).suffix
+            key = f"{prompt_id}/{image['node_id']}_{Path(image['filename']).stem}{ext}"
+            out["store"] = output_store.put_object(key, body, mime)
+            total += len(body)
+        delivered.append(out)
+    metrics.counter("emitted_bytes", "Output bytes delivered inline or to the store").inc(total, kind="image")
+    return delivered, total
+
+
+def deliver_outputs(images: List[Dict[str, Any]], opts: Optional[Dict[str, Any]],
+                    fetch: Callable[[Dict[str, Any]], Union[bytes, mmap.mmap]],
+                    prompt_id: str) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Fetch every output image concurrently, re-encode them in the delivery
+    thread pool and return them inline (base64) or via the object store.
+    `opts` comes from _delivery_options(); None returns the images as-is.
+
+    Returns:
+        (images with delivery fields, delivery summary or None)
+    """
+    if opts is None or not images:
+        return images, None
+    blobs = list(_delivery_pool.map(fetch, images))
+    encoded = list(_delivery_pool.map(
+        lambda b, i: encode_image(b, opts["format"], opts["quality"], i["filename"]), blobs, images,
+    ))
+    delivered, total = _finish_delivery(images, blobs, encoded, opts, prompt_id)
+    return delivered, {**opts, "total_bytes": total}
+
+
+async def deliver_outputs_async(images: List[Dict[str, Any]], opts: Optional[Dict[str, Any]],
+                                fetch: Callable[[Dict[str, Any]], Awaitable[Union[bytes, mmap.mmap]]],
+                                prompt_id: str) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Async counterpart of deliver_outputs."""
+    if opts is None or not images:
+        return images, None
+    loop = asyncio.get_running_loop()
+    blobs = await asyncio.gather(*(fetch(i) for i in images))
+    encoded = await asyncio.gather(*(
+        loop.run_in_executor(_delivery_pool, encode_image, b, opts["format"], opts["quality"], i["filename"])
+        for b, i in zip(blobs, images)
+    ))
+    delivered, total = await loop.run_in_executor(
+        _delivery_pool, _finish_delivery, images, blobs, encoded, opts, prompt_id,
+    )
+    return delivered, {**opts, "total_bytes": total}
+
+
+def _image_source(client: ComfyClient, cache_key: Optional[str], entry: Optional[Dict[str, Any]]):
+    """Fetch function for a job's outputs: the result cache on a hit, ComfyUI otherwise."""
+    if entry is None:
+        return client.fetch_output
+    cached = {(i["node_id"], i["filename"]): i for i in entry["images"]}
+    return lambda image: result_cache.read(cache_key, cached[(image["node_id"], image["filename"])])
+
+
+def _image_source_async(client: AsyncComfyClient, cache_key: Optional[str], entry: Optional[Dict[str, Any]]):
+    """Async counterpart of _image_source."""
+    if entry is None:
+        return client.fetch_output
+    read = _image_source(client, cache_key, entry)
+    return lambda image: asyncio.to_thread(read, image)
+
+
+#======================================================================
+_PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+_SH_C0 = 0.28209479177387814
+SPLAT_MAGIC = b"CSPL"
+SPLAT_VERSION = 1
+
+
+def read_ply_vertices(data: Union[bytes, mmap.mmap]):
+    """Parse the vertex element of a binary little-endian PLY into a NumPy structured array."""
+    import numpy as np
+
+    end = data.find(b"end_header")
+    if not bytes(data[:4]).startswith(b"ply") or end < 0:
+        raise ValueError("Not a PLY file")
+    body_start = data.find(b"\n", end) + 1
+    header = bytes(data[:end]).decode("ascii").splitlines()
+
+    elements: List[Tuple[str, int, List[Tuple[str, str]]]] = []
+    for line in header:
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == "format" and parts[1] != "binary_little_endian":
+            raise ValueError(f"Unsupported PLY format: {parts[1]}")
+        if parts[0] == "element":
+            elements.append((parts[1], int(parts[2]), []))
+        elif parts[0] == "property":
+            if parts[1] == "list":
+                raise ValueError("PLY list properties are not supported")
+            elements[-1][2].append((parts[2], "<" + _PLY_TYPES[parts[1]]))
+
+    offset = body_start
+    for name, count, props in elements:
+        dtype = np.dtype(props)
+        if name == "vertex":
+            return np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += dtype.itemsize * count
+    raise ValueError("PLY has no vertex element")
+
+
+def _morton3(q):
+    """Interleave the low 10 bits of three uint32 columns into Morton codes."""
+    import numpy as np
+
+    def spread(x):
+        x = x.astype(np.uint32) & 0x3FF
+        x = (x | (x << 16)) & 0x030000FF
+        x = (x | (x << 8)) & 0x0300F00F
+        x = (x | (x << 4)) & 0x030C30C3
+        x = (x | (x << 2)) & 0x09249249
+        return x
+
+    return spread(q[:, 0]) | (spread(q[:, 1]) << 1) | (spread(q[:, 2]) << 2)
+
+
+def compact_splat(data: Union[bytes, mmap.mmap], sh_degree: int = SPLAT_DEFAULT_SH_DEGREE) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Convert a 3D Gaussian-splat PLY to the compact CSPL layout.
+
+    Per Gaussian: uint16 positions quantised to the bounding box, uint8
+    log-scales, a uint8 sign-canonical unit quaternion, uint8 RGB + opacity
+    from the DC term, and int8 higher-order SH coefficients truncated to
+    `sh_degree`. Gaussians are sorted by Morton code of their position for
+    locality. All arrays are stored struct-of-arrays after a JSON header
+    that carries the dequantisation ranges.
+
+    Returns:
+        (encoded bytes, header dict)
+    """
+    import numpy as np
+
+    v = read_ply_vertices(data)
+    names = set(v.dtype.names)
+    required = ["x", "y", "z", "f_dc_0", "f_dc_1", "f_dc_2", "opacity",
+                "scale_0", "scale_1", "scale_2", "rot_0", "rot_1", "rot_2", "rot_3"]
+    missing = [n for n in required if n not in names]
+    if missing:
+        raise ValueError(f"PLY is missing Gaussian properties: {', '.join(missing)}")
+
+    def cols(*keys):
+        return np.stack([v[k].astype(np.float32) for k in keys], axis=1)
+
+    count = len(v)
+    xyz = cols("x", "y", "z")
+    # A PLY with no Gaussians encodes to a header and an empty body
+    if count:
+        lo, hi = xyz.min(axis=0), xyz.max(axis=0)
+    else:
+        lo = hi = np.zeros(3, dtype=np.float32)
+    span = np.where(hi > lo, hi - lo, 1.0)
+    q_xyz = np.round((xyz - lo) / span * 65535).astype(np.uint16)
+    order = np.argsort(_morton3(q_xyz >> 6), kind="stable")
+
+    scales = cols("scale_0", "scale_1", "scale_2")
+    s_lo, s_hi = (float(scales.min()), float(scales.max())) if count else (0.0, 0.0)
+    s_span = s_hi - s_lo if s_hi > s_lo else 1.0
+    q_scales = np.round((scales - s_lo) / s_span * 255).astype(np.uint8)
+
+    rot = cols("rot_0", "rot_1", "rot_2", "rot_3")
+    rot /= np.maximum(np.linalg.norm(rot, axis=1, keepdims=True), 1e-12)
+    rot *= np.where(rot[:, :1] < 0, -1.0, 1.0)
+    q_rot = np.round((rot + 1.0) * 127.5).astype(np.uint8)
+
+    rgb = 0.5 + _SH_C0 * cols("f_dc_0", "f_dc_1", "f_dc_2")
+    alpha = 1.0 / (1.0 + np.exp(-v["opacity"].astype(np.float32)))
+    q_color = np.round(np.clip(np.concatenate([rgb, alpha[:, None]], axis=1), 0, 1) * 255).astype(np.uint8)
+
+    rest = sorted((n for n in names if n.startswith("f_rest_")), key=lambda n: int(n.rsplit("_", 1)[1]))
+    per_channel = len(rest) // 3
+    file_degree = int(round((per_channel + 1) ** 0.5)) - 1
+    degree = max(0, min(sh_degree, file_degree))
+    keep = (degree + 1) ** 2 - 1
+    sh_scale = 1.0
+    q_sh = np.zeros((count, 0), dtype=np.int8)
+    if keep:
+        # PLY stores f_rest channel-major: all R coefficients, then G, then B
+        sh = cols(*rest).reshape(count, 3, per_channel)[:, :, :keep].reshape(count, 3 * keep)
+        sh_scale = float(np.abs(sh).max(initial=0.0)) or 1.0
+        q_sh = np.round(sh / sh_scale * 127).astype(np.int8)
+
+    header = {
+        "count": count,
+        "sh_degree": degree,
+        "bbox_min": lo.tolist(),
+        "bbox_max": hi.tolist(),
+        "log_scale_range": [s_lo, s_hi],
+        "sh_scale": sh_scale,
+        "layout": ["position:u16x3", "log_scale:u8x3", "rotation:u8x4", "rgba:u8x4", f"sh_rest:i8x{3 * keep}"],
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    arrays = [q_xyz, q_scales, q_rot, q_color, q_sh]
+    body = b"".join(np.ascontiguousarray(a[order]).tobytes() for a in arrays)
+    encoded = SPLAT_MAGIC + struct.pack("<BBHI", SPLAT_VERSION, degree, 0, len(header_bytes)) + header_bytes + body
+    return encoded, header
+
+
+def _splat_options(options: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Validate a job's "splat" options; None means no splat delivery.
+
+    Keys:
+        delivery: "base64" (inline) or "store" (object store)
+        sh_degree: Spherical-harmonics degree to keep (0-3)
+    """
+    if not options:
+        return None
+    opts = {
+        "delivery": options.get("delivery", "base64"),
+        "sh_degree": int(options.get("sh_degree", SPLAT_DEFAULT_SH_DEGREE)),
+    }
+    if opts["delivery"] not in ("base64", "store"):
+        raise ValueError(f"Unknown splat delivery: {opts['delivery']}")
+    if not 0 <= opts["sh_degree"] <= 3:
+        raise ValueError("splat.sh_degree must be between 0 and 3")
+    return opts
+
+
+def _package_splat(ply: Dict[str, str], data: Union[bytes, mmap.mmap], opts: Dict[str, Any],
+                   prompt_id: str) -> Dict[str, Any]:
+    encoded, header = compact_splat(data, opts["sh_degree"])
+    out = {
+        "filename": ply["filename"],
+        "format": "cspl",
+        "count": header["count"],
+        "sh_degree": header["sh_degree"],
+        "original_size": len(data),
+        "size": len(encoded),
+    }
+    if opts["delivery"] == "base64":
+        out["data"] = base64.b64encode(encoded).decode("ascii")
+    else:
+        key = f"{prompt_id}/{Path(ply['filename']).stem}.cspl"
+        out["store"] = output_store.put_object(key, encoded, "application/octet-stream")
+    metrics.counter("emitted_bytes", "Output bytes delivered inline or to the store").inc(len(encoded), kind="splat")
+    logger.info("Compacted splat %s: %d Gaussians, %d -> %d bytes",
+                ply["filename"], header["count"], len(data), len(encoded))
+    return out
+
+
+def deliver_splats(ply_files: List[Dict[str, str]], opts: Optional[Dict[str, Any]],
+                   fetch: Callable[[Dict[str, Any]], Union[bytes, mmap.mmap]],
+                   prompt_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Fetch and compact every PLY of a job in the delivery thread pool."""
+    if opts is None:
+        return None
+    return list(_delivery_pool.map(lambda ply: _package_splat(ply, fetch(ply), opts, prompt_id), ply_files))
+
+
+async def deliver_splats_async(ply_files: List[Dict[str, str]], opts: Optional[Dict[str, Any]],
+                               fetch: Callable[[Dict[str, Any]], Awaitable[Union[bytes, mmap.mmap]]],
+                               prompt_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Async counterpart of deliver_splats."""
+    if opts is None:
+        return None
+    loop = asyncio.get_running_loop()
+    blobs = await asyncio.gather(*(fetch(ply) for ply in ply_files))
+    return list(await asyncio.gather(*(
+        loop.run_in_executor(_delivery_pool, _package_splat, ply, blob, opts, prompt_id)
+        for ply, blob in zip(ply_files, blobs)
+    )))
+
+
+#======================================================================
+# Result-cache writes run after the response is built, off the job's path
+_cache_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+_cache_writes: Set["asyncio.Future[None]"] = set()
+
+
+def _output_id(ref: Dict[str, Any]) -> Tuple:
+    return ref.get("type"), ref.get("key"), ref.get("subfolder", ""), ref["filename"]
+
+
+def _recorded(fetch: Callable, fetched: Dict[Tuple, Any]) -> Callable:
+    """Wrap a fetch function so the bytes it returns are kept for the result cache."""
+    def record(ref: Dict[str, Any]):
+        fetched[_output_id(ref)] = blob = fetch(ref)
+        return blob
+    return record
+
+
+def _recorded_async(fetch: Callable, fetched: Dict[Tuple, Any]) -> Callable:
+    """Async counterpart of _recorded."""
+    async def record(ref: Dict[str, Any]):
+        fetched[_output_id(ref)] = blob = await fetch(ref)
+        return blob
+    return record
+
+
+def store_result(client: ComfyClient, cache_key: str, result: Dict[str, Any], with_plys: bool,
+                 fetched: Dict[Tuple, Any]) -> None:
+    """
+    Write a finished job to the result cache, reusing the bytes fetched for
+    its delivery and fetching only the rest. Splat jobs keep their PLYs.
+    """
+    def get(ref: Dict[str, Any], fetch: Callable):
+        blob = fetched.get(_output_id(ref))
+        return blob if blob is not None else fetch(ref)
+
+    try:
+        fetch_ply = _ply_source(client)
+        plys = result.get("ply_files", []) if with_plys else []
+        blobs = [get(i, client.fetch_output) for i in result["images"]]
+        ply_blobs = [get(p, fetch_ply) for p in plys]
+        result_cache.put(cache_key, result["prompt_id"], result["images"], blobs, plys, ply_blobs)
+    finally:
+        result_cache.release(cache_key)
+
+
+async def store_result_async(client: AsyncComfyClient, cache_key: str, result: Dict[str, Any], with_plys: bool,
+                             fetched: Dict[Tuple, Any]) -> None:
+    """Async counterpart of store_result."""
+    async def get(ref: Dict[str, Any], fetch: Callable):
+        blob = fetched.get(_output_id(ref))
+        return blob if blob is not None else await fetch(ref)
+
+    try:
+        fetch_ply = _ply_source_async(client)
+        plys = result.get("ply_files", []) if with_plys else []
+        blobs = await asyncio.gather(*(get(i, client.fetch_output) for i in result["images"]))
+        ply_blobs = await asyncio.gather(*(get(p, fetch_ply) for p in plys))
+        await asyncio.to_thread(result_cache.put, cache_key, result["prompt_id"], result["images"], blobs, plys,
+                                ply_blobs)
+    finally:
+        result_cache.release(cache_key)
+
+
+def _merge_delivered(images: List[Dict[str, Any]], pending: List[Dict[str, Any]],
+                     delivered: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The job's images in order, with those that were delivered now replaced by their delivered form."""
+    by_id = {_output_id(i): d for i, d in zip(pending, delivered)}
+    return [by_id.get(_output_id(i), i) for i in images]
+
+
+def _log_store_failure(future: "concurrent.futures.Future[None]") -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Could not store result: %s", future.exception())
+
+
+def _job_response(client: ComfyClient, result: Dict[str, Any], cache_key: Optional[str],
+                  entry: Optional[Dict[str, Any]], delivery_opts: Optional[Dict[str, Any]],
+                  splat_opts: Optional[Dict[str, Any]], store: bool = False,
+                  streamed: Collection[Tuple] = ()) -> Dict[str, Any]:
+    """
+    Deliver a finished job's images and splats and build its success
+    response. Images in `streamed` (ids per _output_id) were delivered
+    as stream messages already and are only referenced. With `store`, the
+    job is then written to the result cache in the background.
+    """
+    store = store and cache_key is not None and entry is None
+    fetched: Dict[Tuple, Any] = {}
+    fetch_image, fetch_ply = _image_source(client, cache_key, entry), _ply_source(client)
+    if store:
+        fetch_image, fetch_ply = _recorded(fetch_image, fetched), _recorded(fetch_ply, fetched)
+    pending = [i for i in result["images"] if _output_id(i) not in streamed]
+    delivered, delivery = deliver_outputs(pending, delivery_opts, fetch_image, result["prompt_id"])
+    images = _merge_delivered(result["images"], pending, delivered)
+    splats = deliver_splats(result.get("ply_files", []), splat_opts, fetch_ply, result["prompt_id"])
+    if store:
+        # Reserved before the response goes out, so an identical job waits for the entry
+        result_cache.reserve(cache_key)
+        _cache_pool.submit(
+            contextvars.copy_context().run, store_result, client, cache_key, result, splat_opts is not None, fetched,
+        ).add_done_callback(_log_store_failure)
+
+    response = {"status": "success", **result, "images": images}
+    if delivery is not None:
+        response["delivery"] = delivery
+    if splats is not None:
+        response["splats"] = splats
+    return response
+
+
+async def _job_response_async(client: AsyncComfyClient, result: Dict[str, Any], cache_key: Optional[str],
+                              entry: Optional[Dict[str, Any]], delivery_opts: Optional[Dict[str, Any]],
+                              splat_opts: Optional[Dict[str, Any]], store: bool = False,
+                              streamed: Collection[Tuple] = ()) -> Dict[str, Any]:
+    """Async counterpart of _job_response."""
+    store = store and cache_key is not None and entry is None
+    fetched: Dict[Tuple, Any] = {}
+    fetch_image, fetch_ply = _image_source_async(client, cache_key, entry), _ply_source_async(client)
+    if store:
+        fetch_image, fetch_ply = _recorded_async(fetch_image, fetched), _recorded_async(fetch_ply, fetched)
+    pending = [i for i in result["images"] if _output_id(i) not in streamed]
+    delivered, delivery = await deliver_outputs_async(pending, delivery_opts, fetch_image, result["prompt_id"])
+    images = _merge_delivered(result["images"], pending, delivered)
+    splats = await deliver_splats_async(result.get("ply_files", []), splat_opts, fetch_ply, result["prompt_id"])
+    if store:
+        result_cache.reserve(cache_key)
+        task = asyncio.ensure_future(store_result_async(client, cache_key, result, splat_opts is not None, fetched))
+        _cache_writes.add(task)
+        task.add_done_callback(_cache_writes.discard)
+        task.add_done_callback(_log_store_failure)
+
+    response = {"status": "success", **result, "images": images}
+    if delivery is not None:
+        response["delivery"] = delivery
+    if splats is not None:
+        response["splats"] = splats
+    return response
@@ -0,0 +1,302 @@
+"""Queueing prompts, collecting their results, and coalescing identical jobs."""
+
+import asyncio
+import concurrent.futures
+import copy
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .config import RENDER_CACHE_PLY
+from .metrics import MetricsRegistry, metrics
+from .client import _ABANDON_ERRORS, AsyncComfyClient, ComfyClient, _build_image_results, active_prompts
+from .telemetry import ExecutionTracker, _timings, span
+from .scheduling import admission, health_monitor, scheduler, vram_policy
+from .inputs import input_cache
+from .caches import (_split_captures, add_render_previews, apply_render_cache, apply_render_cache_async,
+                     find_ply_outputs, render_cache, result_cache, store_renders, store_renders_async,
+                     tag_splat_outputs)
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaderCancelled(Exception):
+    """Set on a SingleFlight future whose leader was cancelled rather than failing."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent executions of the same workflow fingerprint.
+
+    The first caller for a key becomes the leader and runs the job; callers
+    arriving while it is in flight wait on the leader's future and receive a
+    copy of its result (or its error) instead of queueing the same prompt
+    again. A leader that is cancelled (task cancellation, shutdown) fails
+    nobody: its followers join again and one of them takes over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """Return (future, is_leader) for `key`."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            self.stats["leaders"] += 1
+            return future, True
+
+    def finish(self, key: str, future: concurrent.futures.Future,
+               result: Any = None, error: Optional[BaseException] = None) -> None:
+        """Publish the leader's outcome to every waiter and release the key."""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error if isinstance(error, Exception) else _LeaderCancelled())
+        else:
+            future.set_result(result)
+
+
+inflight = SingleFlight()
+
+
+def _collect_cache_metrics(registry: MetricsRegistry) -> None:
+    """Mirror cache and coalescing statistics into the registry at render time."""
+    events = registry.counter("cache_events", "Cache lookups by cache and outcome")
+    for name, cache in (("result", result_cache), ("render", render_cache), ("input", input_cache)):
+        if cache is not None:
+            for event, count in list(cache.stats.items()):
+                events.set_total(count, cache=name, event=event)
+    for event, count in list(inflight.stats.items()):
+        events.set_total(count, cache="inflight", event=event)
+
+
+metrics.add_collector(_collect_cache_metrics)
+
+
+def _coalesced(result: Dict[str, Any], key: str) -> Dict[str, Any]:
+    logger.info("Coalesced onto in-flight prompt %s (%s)", result.get("prompt_id", "?")[:12], key[:12])
+    return {**copy.deepcopy(result), "coalesced": True}
+
+
+def run_coalesced(key: Optional[str], fn: Callable[[], Dict[str, Any]], timeout: float) -> Dict[str, Any]:
+    """Run `fn` once per in-flight `key`; identical concurrent callers share its result."""
+    if key is None:
+        return fn()
+    while True:
+        future, leader = inflight.join(key)
+        if leader:
+            break
+        try:
+            with span("coalesced_wait"):
+                result = future.result(timeout=timeout)
+        except _LeaderCancelled:
+            logger.info("In-flight leader for %s was cancelled, taking over", key[:12])
+            continue
+        return _coalesced(result, key)
+    try:
+        result = fn()
+    except BaseException as e:
+        inflight.finish(key, future, error=e)
+        raise
+    inflight.finish(key, future, result=result)
+    return result
+
+
+async def run_coalesced_async(key: Optional[str], fn: Callable[[], Awaitable[Dict[str, Any]]],
+                              timeout: float) -> Dict[str, Any]:
+    """Async counterpart of run_coalesced."""
+    if key is None:
+        return await fn()
+    while True:
+        future, leader = inflight.join(key)
+        if leader:
+            break
+        try:
+            with span("coalesced_wait"):
+                result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except _LeaderCancelled:
+            logger.info("In-flight leader for %s was cancelled, taking over", key[:12])
+            continue
+        return _coalesced(result, key)
+    try:
+        result = await fn()
+    except BaseException as e:
+        inflight.finish(key, future, error=e)
+        raise
+    inflight.finish(key, future, result=result)
+    return result
+
+
+def _submit(client: ComfyClient, workflow: Dict[str, Any], use_render_cache: bool = True,
+            need_plys: bool = False, preview_renders: bool = False) -> Dict[str, Any]:
+    """
+    Queue a prepared workflow without waiting; returns the state _collect()
+    needs. `need_plys` marks jobs that return splats (see plan_render_cache);
+    `preview_renders` makes every render node report its image (streaming).
+    """
+    with span("render_cache"):
+        render_report, captures, ply_files = (
+            apply_render_cache(client, workflow, need_plys) if use_render_cache else ({}, {}, [])
+        )
+    if preview_renders:
+        add_render_previews(workflow, captures)
+    # Only jobs whose PLYs are read need them attributed
+    if need_plys or (RENDER_CACHE_PLY and render_report.get("misses")):
+        tag_splat_outputs(workflow)
+    if vram_policy is not None:
+        with span("vram") as attrs:
+            attrs["action"] = vram_policy.prepare(client, workflow)["action"]
+    started = time.time()
+    with span("queue"):
+        try:
+            prompt_id = client.queue_prompt(workflow)
+        finally:
+            # The queue grew, or ComfyUI could not be reached: either way the snapshot is out of date
+            if health_monitor is not None:
+                health_monitor.refresh()
+    active_prompts.add(prompt_id)
+    return {"prompt_id": prompt_id, "workflow": workflow, "started": started,
+            "render_report": render_report, "captures": captures, "ply_files": ply_files}
+
+
+def _collect(client: ComfyClient, job: Dict[str, Any], cache_key: Optional[str],
+             on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+             abort: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """
+    Wait for a submitted prompt and collect its outputs. If waiting is
+    abandoned (timeout, cancellation, lost connection) the prompt is
+    cancelled in ComfyUI rather than left running for nobody; a prompt that
+    failed on its own keeps its /history entry.
+    """
+    prompt_id, workflow, started = job["prompt_id"], job["workflow"], job["started"]
+    render_report, captures = job["render_report"], job["captures"]
+    tracker = ExecutionTracker(workflow, prompt_id, started)
+
+    def observe(event: Dict[str, Any]) -> None:
+        tracker.observe(event)
+        if on_event is not None:
+            on_event(event)
+
+    try:
+        history = client.wait_for_completion(prompt_id, on_event=observe, abort=abort)
+    except _ABANDON_ERRORS:
+        client.cancel_prompt(prompt_id)
+        raise
+    finally:
+        active_prompts.discard(prompt_id)
+    execution = tracker.finish(history)
+    if admission is not None and execution is not None:
+        admission.record(execution)
+    collect_started = time.time()
+    output_images = client.get_output_images(history)
+
+    images, captured = _split_captures(_build_image_results(output_images), captures)
+    ply_files = job["ply_files"] + find_ply_outputs(history, workflow, started)
+    result = {"prompt_id": prompt_id, "images": images, "ply_files": ply_files}
+    if captured:
+        render_report["stored"] = store_renders(client, history, workflow, prompt_id, captured, captures, started)
+    if render_report.get("hits") or render_report.get("misses"):
+        result["render_cache"] = render_report
+    if cache_key is not None:
+        result["cache"] = result_cache.summary(False, cache_key)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add("collect", collect_started, time.time(), prompt_id=prompt_id)
+    return result
+
+
+def _execute(client: ComfyClient, workflow: Dict[str, Any], cache_key: Optional[str],
+             use_render_cache: bool = True, need_plys: bool = False) -> Dict[str, Any]:
+    """Queue a prepared workflow, wait for it and collect its outputs."""
+    return _collect(client, _submit(client, workflow, use_render_cache, need_plys), cache_key)
+
+
+async def _submit_async(client: AsyncComfyClient, workflow: Dict[str, Any], use_render_cache: bool = True,
+                        need_plys: bool = False, preview_renders: bool = False) -> Dict[str, Any]:
+    """Async counterpart of _submit."""
+    with span("render_cache"):
+        render_report, captures, ply_files = (
+            await apply_render_cache_async(client, workflow, need_plys) if use_render_cache else ({}, {}, [])
+        )
+    if preview_renders:
+        add_render_previews(workflow, captures)
+    # Only jobs whose PLYs are read need them attributed
+    if need_plys or (RENDER_CACHE_PLY and render_report.get("misses")):
+        tag_splat_outputs(workflow)
+    if vram_policy is not None:
+        with span("vram") as attrs:
+            attrs["action"] = (await vram_policy.prepare_async(client, workflow))["action"]
+    started = time.time()
+    with span("queue"):
+        try:
+            prompt_id = await client.queue_prompt(workflow)
+        finally:
+            # The queue grew, or ComfyUI could not be reached: either way the snapshot is out of date
+            if health_monitor is not None:
+                health_monitor.refresh()
+    active_prompts.add(prompt_id)
+    return {"prompt_id": prompt_id, "workflow": workflow, "started": started,
+            "render_report": render_report, "captures": captures, "ply_files": ply_files}
+
+
+async def _collect_async(client: AsyncComfyClient, job: Dict[str, Any], cache_key: Optional[str],
+                         on_event: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """Async counterpart of _collect."""
+    prompt_id, workflow, started = job["prompt_id"], job["workflow"], job["started"]
+    render_report, captures = job["render_report"], job["captures"]
+    tracker = ExecutionTracker(workflow, prompt_id, started)
+
+    def observe(event: Dict[str, Any]) -> None:
+        tracker.observe(event)
+        if on_event is not None:
+            on_event(event)
+
+    try:
+        history = await client.wait_for_completion(prompt_id, on_event=observe)
+    except _ABANDON_ERRORS:
+        await client.cancel_prompt(prompt_id)
+        raise
+    finally:
+        active_prompts.discard(prompt_id)
+    execution = tracker.finish(history)
+    if admission is not None and execution is not None:
+        admission.record(execution)
+    collect_started = time.time()
+    output_images = client.get_output_images(history)
+
+    images, captured = _split_captures(_build_image_results(output_images), captures)
+    ply_files = job["ply_files"] + await asyncio.to_thread(find_ply_outputs, history, workflow, started)
+    result = {"prompt_id": prompt_id, "images": images, "ply_files": ply_files}
+    if captured:
+        render_report["stored"] = await store_renders_async(
+            client, history, workflow, prompt_id, captured, captures, started,
+        )
+    if render_report.get("hits") or render_report.get("misses"):
+        result["render_cache"] = render_report
+    if cache_key is not None:
+        result["cache"] = result_cache.summary(False, cache_key)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add("collect", collect_started, time.time(), prompt_id=prompt_id)
+    return result
+
+
+async def _execute_async(client: AsyncComfyClient, workflow: Dict[str, Any],
+                         cache_key: Optional[str], use_render_cache: bool = True,
+                         need_plys: bool = False) -> Dict[str, Any]:
+    """Async counterpart of _execute; in concurrent mode the prompt waits for its scheduler turn."""
+    if scheduler is None:
+        return await _collect_async(client, await _submit_async(client, workflow, use_render_cache, need_plys),
+                                    cache_key)
+    async with scheduler.turn(workflow):
+        return await _collect_async(client, await _submit_async(client, workflow, use_render_cache, need_plys),
+                                    cache_key)
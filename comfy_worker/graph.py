@@ -0,0 +1,330 @@
+"""Workflow graph passes: pruning, deduplication, variant selection and sweeps."""
+
+import copy
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .config import (MERGEABLE_NODE_TYPES, OUTPUT_NODE_TYPES, PIPELINE_VARIANTS, SWEEP_ENCODER_INPUTS,
+                     SWEEP_MAX_VARIANTS, SWEEP_PROMPT_INPUTS, SWEEP_SEED_INPUTS, VARIANT_LOADER_INPUTS,
+                     WORKFLOW_OPTIMIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def _is_link(value: Any) -> bool:
+    """True for an API-format input link: [source_node_id, output_index]."""
+    return (isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], (str, int)) and isinstance(value[1], int))
+
+
+def _upstream_ids(node: Dict[str, Any]) -> Iterator[str]:
+    for value in node.get("inputs", {}).values():
+        if _is_link(value):
+            yield str(value[0])
+
+
+def find_output_nodes(workflow: Dict[str, Any]) -> List[str]:
+    """Node ids whose outputs the handler returns (SaveImage by default)."""
+    return [node_id for node_id, node in workflow.items() if node.get("class_type") in OUTPUT_NODE_TYPES]
+
+
+def reachable_nodes(workflow: Dict[str, Any], targets: Iterable[str]) -> Set[str]:
+    """All nodes that `targets` depend on, including the targets themselves."""
+    seen: Set[str] = set()
+    stack = [str(t) for t in targets]
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or node_id not in workflow:
+            continue
+        seen.add(node_id)
+        stack.extend(_upstream_ids(workflow[node_id]))
+    return seen
+
+
+def prune_workflow(workflow: Dict[str, Any], output_nodes: Optional[List[str]] = None) -> List[str]:
+    """
+    Remove every node that does not feed one of the output nodes, such as
+    PreviewImage, image comparers and reel composites that only serve the UI.
+
+    Args:
+        workflow: API-format workflow, modified in place
+        output_nodes: Node ids to keep results for (default: all SaveImage nodes)
+
+    Returns:
+        Sorted ids of the removed nodes
+    """
+    targets = [str(n) for n in output_nodes] if output_nodes else find_output_nodes(workflow)
+    missing = [n for n in targets if n not in workflow]
+    if missing:
+        raise ValueError(f"Unknown output node(s): {', '.join(missing)}")
+    if not targets:
+        logger.warning("No output nodes found, skipping pruning")
+        return []
+
+    keep = reachable_nodes(workflow, targets)
+    removed = sorted((n for n in workflow if n not in keep), key=str)
+    for node_id in removed:
+        logger.info("Pruned node %s (%s)", node_id, workflow[node_id].get("class_type"))
+        del workflow[node_id]
+    return removed
+
+
+def _node_sort_key(node_id: str):
+    return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+
+
+def topological_order(workflow: Dict[str, Any]) -> List[str]:
+    """Node ids with every node after its inputs; ties broken by node id."""
+    pending = {
+        node_id: {u for u in _upstream_ids(node) if u in workflow}
+        for node_id, node in workflow.items()
+    }
+    order: List[str] = []
+    ready = sorted((n for n, deps in pending.items() if not deps), key=_node_sort_key)
+    while ready:
+        node_id = ready.pop(0)
+        order.append(node_id)
+        del pending[node_id]
+        released = [n for n, deps in pending.items() if node_id in deps and len(deps) == 1]
+        for deps in pending.values():
+            deps.discard(node_id)
+        ready = sorted(ready + released, key=_node_sort_key)
+    if pending:
+        raise ValueError(f"Workflow has a cycle through node(s): {', '.join(sorted(pending))}")
+    return order
+
+
+def _rewire(workflow: Dict[str, Any], mapping: Dict[str, str]) -> None:
+    """Point every link whose source is a key of `mapping` at its value."""
+    for node in workflow.values():
+        inputs = node.get("inputs", {})
+        for name, value in inputs.items():
+            if _is_link(value) and str(value[0]) in mapping:
+                inputs[name] = [mapping[str(value[0])], value[1]]
+
+
+def merge_duplicate_nodes(workflow: Dict[str, Any],
+                          mergeable: Optional[Set[str]] = None) -> Dict[str, str]:
+    """
+    Merge structurally identical nodes (same class_type and same inputs
+    after upstream merges) whose type is in `mergeable`, rewiring every
+    consumer to the surviving node. This removes duplicate model loads,
+    such as two VAELoaders for one file, and repeated preprocessing of the
+    same image.
+
+    Returns:
+        Mapping of removed node id -> node id it was merged into
+    """
+    mergeable = MERGEABLE_NODE_TYPES if mergeable is None else mergeable
+    canonical: Dict[str, str] = {}
+    seen: Dict[str, str] = {}
+    merged: Dict[str, str] = {}
+
+    for node_id in topological_order(workflow):
+        node = workflow[node_id]
+        canonical[node_id] = node_id
+        if node.get("class_type") not in mergeable:
+            continue
+        inputs = {
+            name: [canonical.get(str(value[0]), str(value[0])), value[1]] if _is_link(value) else value
+            for name, value in node.get("inputs", {}).items()
+        }
+        key = json.dumps([node["class_type"], inputs], sort_keys=True, ensure_ascii=False)
+        if key in seen:
+            canonical[node_id] = seen[key]
+            merged[node_id] = seen[key]
+        else:
+            seen[key] = node_id
+
+    _rewire(workflow, merged)
+    for node_id, target in merged.items():
+        logger.info("Merged node %s (%s) into %s", node_id, workflow[node_id].get("class_type"), target)
+        del workflow[node_id]
+    return merged
+
+
+def output_variants(workflow: Dict[str, Any]) -> Dict[str, List[str]]:
+    """
+    Map each pipeline variant tag (e.g. "2511") to the output nodes of its
+    branch, identified by the model names loaded upstream of each output.
+    """
+    variants: Dict[str, List[str]] = {tag: [] for tag in PIPELINE_VARIANTS}
+    for output_id in find_output_nodes(workflow):
+        model_names = [
+            str(workflow[n]["inputs"].get(VARIANT_LOADER_INPUTS[workflow[n].get("class_type")], "")).lower()
+            for n in reachable_nodes(workflow, [output_id])
+            if workflow[n].get("class_type") in VARIANT_LOADER_INPUTS
+        ]
+        for tag in PIPELINE_VARIANTS:
+            if any(tag.lower() in name for name in model_names):
+                variants[tag].append(output_id)
+    return variants
+
+
+def select_variant_outputs(workflow: Dict[str, Any], variants: List[str],
+                           output_nodes: Optional[List[str]] = None) -> List[str]:
+    """
+    Output nodes belonging to the requested variants, optionally narrowed to
+    `output_nodes`. Pruning to these drops the other branches together with
+    the loaders only they use.
+    """
+    available = output_variants(workflow)
+    unknown = [v for v in variants if not available.get(str(v))]
+    if unknown:
+        known = ", ".join(tag for tag, outputs in available.items() if outputs)
+        raise ValueError(f"Unknown pipeline variant(s) {', '.join(map(str, unknown))}; available: {known}")
+
+    selected = sorted({n for v in variants for n in available[str(v)]}, key=_node_sort_key)
+    if output_nodes:
+        wanted = {str(n) for n in output_nodes}
+        selected = [n for n in selected if n in wanted]
+    if not selected:
+        raise ValueError(f"None of output_nodes {output_nodes} belong to variant(s) {variants}")
+    return selected
+
+
+def downstream_nodes(workflow: Dict[str, Any], sources: Iterable[str]) -> Set[str]:
+    """All nodes that depend on `sources`, including the sources themselves."""
+    consumers: Dict[str, List[str]] = {}
+    for node_id, node in workflow.items():
+        for upstream in _upstream_ids(node):
+            consumers.setdefault(upstream, []).append(node_id)
+    seen: Set[str] = set()
+    stack = [str(s) for s in sources]
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or node_id not in workflow:
+            continue
+        seen.add(node_id)
+        stack.extend(consumers.get(node_id, []))
+    return seen
+
+
+def positive_prompt_nodes(workflow: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Map each node holding a positive prompt to the input carrying its text:
+    text encoders feeding a sampler's `positive` input, and samplers that
+    take the prompt as a widget.
+    """
+    found = {n: SWEEP_PROMPT_INPUTS[node["class_type"]] for n, node in workflow.items()
+             if node.get("class_type") in SWEEP_PROMPT_INPUTS}
+    stack = [str(node["inputs"]["positive"][0]) for node in workflow.values()
+             if _is_link(node.get("inputs", {}).get("positive"))]
+    seen: Set[str] = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or node_id not in workflow:
+            continue
+        seen.add(node_id)
+        class_type = workflow[node_id].get("class_type")
+        if class_type in SWEEP_ENCODER_INPUTS:
+            found[node_id] = SWEEP_ENCODER_INPUTS[class_type]
+        else:
+            stack.extend(_upstream_ids(workflow[node_id]))
+    return found
+
+
+def expand_sweep(workflow: Dict[str, Any], sweep: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Fan a workflow out into one branch per seed/prompt combination.
+
+    Nodes that take a swept seed or positive prompt, and everything
+    downstream of them (sampling, decoding, saving), are copied per variant
+    with ids "<id>_<n>"; variant 0 keeps the original ids. Shared
+    upstream work such as image scaling, SHARP prediction and model
+    loading stays a single node, so ComfyUI runs it once per scene.
+
+    Args:
+        workflow: API-format workflow, modified in place
+        sweep: {"seeds": [...], "prompts": [...]}; either may be omitted
+
+    Returns:
+        One entry per variant with its seed, prompt and output node ids
+    """
+    seeds = sweep.get("seeds") or [None]
+    prompts = sweep.get("prompts") or [None]
+    variants = [(seed, prompt) for prompt in prompts for seed in seeds]
+    if variants == [(None, None)]:
+        raise ValueError("sweep needs seeds and/or prompts")
+    if len(variants) > SWEEP_MAX_VARIANTS:
+        raise ValueError(f"sweep has {len(variants)} variants, the limit is {SWEEP_MAX_VARIANTS}")
+
+    seed_nodes = {n: SWEEP_SEED_INPUTS[node["class_type"]] for n, node in workflow.items()
+                  if node.get("class_type") in SWEEP_SEED_INPUTS} if sweep.get("seeds") else {}
+    prompt_nodes = positive_prompt_nodes(workflow) if sweep.get("prompts") else {}
+    if sweep.get("seeds") and not seed_nodes:
+        raise ValueError("sweep.seeds given but the workflow has no sampler with a seed")
+    if sweep.get("prompts") and not prompt_nodes:
+        raise ValueError("sweep.prompts given but the workflow has no positive prompt")
+
+    seed_scope = downstream_nodes(workflow, seed_nodes)
+    prompt_scope = downstream_nodes(workflow, prompt_nodes)
+    fanned = seed_scope | prompt_scope
+    template = {n: copy.deepcopy(workflow[n]) for n in fanned}
+    outputs = [n for n in find_output_nodes(workflow) if n in fanned]
+    # A node is copied once per distinct value of the overrides it depends
+    # on, so a prompt encoder is shared by all seeds of that prompt
+    copies: Dict[Tuple[str, Any, Any], str] = {}
+    created: Set[str] = set()
+    report = []
+    for index, (seed, prompt) in enumerate(variants):
+        ids = {
+            n: copies.setdefault(
+                (n, seed if n in seed_scope else None, prompt if n in prompt_scope else None),
+                n if index == 0 else f"{n}_{index}",
+            )
+            for n in fanned
+        }
+        for node_id in fanned:
+            if ids[node_id] in created:
+                continue
+            created.add(ids[node_id])
+            node = copy.deepcopy(template[node_id])
+            inputs = node.get("inputs", {})
+            for name, value in inputs.items():
+                if _is_link(value) and str(value[0]) in ids:
+                    inputs[name] = [ids[str(value[0])], value[1]]
+            if seed is not None and node_id in seed_nodes:
+                inputs[seed_nodes[node_id]] = seed
+            if prompt is not None and node_id in prompt_nodes:
+                inputs[prompt_nodes[node_id]] = prompt
+            workflow[ids[node_id]] = node
+        report.append({"index": index, "seed": seed, "prompt": prompt,
+                       "output_nodes": sorted((ids[n] for n in outputs), key=_node_sort_key)})
+
+    logger.info("Sweep: %d variants, %d nodes from %d fanned out, %d shared",
+                len(variants), len(created), len(fanned), len(workflow) - len(created))
+    return report
+
+
+def optimize_workflow(workflow: Dict[str, Any], inp: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run the optimisation passes requested for a job on its workflow.
+
+    Job input keys:
+        optimize: Enable/disable pruning and merging (default WORKFLOW_OPTIMIZE)
+        output_nodes: Restrict results to these node ids
+        variants: Run only these pipeline branches, e.g. ["2511"]
+
+    Returns:
+        Report of what each pass changed, included in the response
+    """
+    report: Dict[str, Any] = {}
+    optimize = inp.get("optimize", WORKFLOW_OPTIMIZE)
+    output_nodes = inp.get("output_nodes")
+    variants = inp.get("variants")
+    if variants:
+        output_nodes = select_variant_outputs(workflow, variants, output_nodes)
+        report["variants"] = {"selected": list(variants), "output_nodes": output_nodes}
+    if not (optimize or variants):
+        return report
+
+    before = len(workflow)
+    report["pruned"] = prune_workflow(workflow, output_nodes)
+    if optimize:
+        report["merged"] = merge_duplicate_nodes(workflow)
+    report["nodes_before"] = before
+    report["nodes_after"] = len(workflow)
+    logger.info("Workflow optimised: %d -> %d nodes", before, len(workflow))
+    return report
@@ -0,0 +1,426 @@
+"""Input image ingestion into ComfyUI and the content-addressed input cache."""
+
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlparse
+
+from .config import (HTTP_DOWNLOAD_TIMEOUT, INGEST_CHUNK_SIZE, INGEST_CONCURRENCY, INGEST_MAX_BYTES,
+                     INPUT_CACHE_ENABLED, INPUT_CACHE_MAX_BYTES, INPUT_CACHE_MIN_AGE, INPUT_CACHE_TTL)
+from .metrics import metrics
+from .client import AsyncComfyClient, ComfyClient, _comfy_dir, _local_file, _local_input_dir, request_with_retry
+from .telemetry import span
+
+logger = logging.getLogger(__name__)
+
+
+def _atomic_target(input_dir: Path, filename: str):
+    final = input_dir / filename
+    tmp = input_dir / f".{filename}.{uuid.uuid4().hex[:8]}.tmp"
+    return final, tmp
+
+
+def write_input_atomic(input_dir: Path, chunks: Iterable[bytes], filename: str) -> str:
+    """
+    Write an input image into the ComfyUI input folder via temp file + rename,
+    so LoadImage never observes a partially written file.
+    """
+    final, tmp = _atomic_target(input_dir, filename)
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, final)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    logger.info("Wrote %s directly to %s", filename, input_dir)
+    return filename
+
+
+async def write_input_atomic_async(input_dir: Path, chunks: AsyncIterable[bytes], filename: str) -> str:
+    """Async counterpart of write_input_atomic; disk writes run in a worker thread."""
+    final, tmp = _atomic_target(input_dir, filename)
+    try:
+        f = await asyncio.to_thread(open, tmp, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, tmp, final)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    logger.info("Wrote %s directly to %s", filename, input_dir)
+    return filename
+
+
+def _bounded_chunks(chunks: Iterable[bytes], url: str, max_bytes: int = INGEST_MAX_BYTES) -> Iterator[bytes]:
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes:
+            raise ValueError(f"Input image {url} exceeds {max_bytes} bytes")
+        yield chunk
+    logger.info("Streamed %d bytes from %s", total, url)
+    metrics.counter("ingested_bytes", "Input image bytes downloaded").inc(total)
+
+
+async def _bounded_chunks_async(chunks: AsyncIterable[bytes], url: str,
+                                max_bytes: int = INGEST_MAX_BYTES) -> AsyncIterator[bytes]:
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes:
+            raise ValueError(f"Input image {url} exceeds {max_bytes} bytes")
+        yield chunk
+    logger.info("Streamed %d bytes from %s", total, url)
+    metrics.counter("ingested_bytes", "Input image bytes downloaded").inc(total)
+
+
+def _ingest_filename(url: str, content_type: Optional[str]) -> str:
+    """
+    Unique upload name for a URL. Names are never reused, so a file the
+    input cache or a queued prompt refers to is not overwritten with other
+    bytes; local writes are renamed after their content once written.
+    """
+    ext = Path(urlparse(url).path).suffix.lower()
+    if not ext and content_type:
+        ext = mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return f"downloaded_{uuid.uuid4().hex}{ext or '.png'}"
+
+
+def _rename_by_content(input_dir: Path, filename: str, digest: str) -> str:
+    """
+    Rename an ingested file to the SHA-256 of its bytes. A file already there
+    holds the same bytes, so replacing it is harmless.
+    """
+    named = f"downloaded_{digest[:32]}{Path(filename).suffix}"
+    os.replace(input_dir / filename, input_dir / named)
+    return named
+
+
+class InputCache:
+    """
+    Content-addressed cache of ingested input images.
+
+    Entries are keyed by URL (revalidated with ETag/Last-Modified once older
+    than `ttl`) and by the SHA-256 of the body, so the same bytes served from
+    different URLs share one file. Cached files live in the ComfyUI input
+    folder under the `downloaded_` prefix and are evicted least recently used
+    first once they exceed `max_bytes`, together with the cached renders
+    copied there by the render cache (`render_` prefix). Files used within `min_age` seconds
+    are never evicted, since a queued prompt may still read them.
+    """
+
+    PREFIX = "downloaded_"
+    RENDER_PREFIX = "render_"
+
+    def __init__(self, ttl: float = INPUT_CACHE_TTL, max_bytes: int = INPUT_CACHE_MAX_BYTES,
+                 min_age: float = INPUT_CACHE_MIN_AGE):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._by_url: Dict[str, Dict[str, Any]] = {}
+        self._by_digest: Dict[str, str] = {}
+        self._digest_by_name: Dict[str, str] = {}
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "deduplicated": 0, "evicted": 0}
+
+    @staticmethod
+    def _path(filename: str) -> Optional[Path]:
+        return _local_file("input", filename)
+
+    def _touch(self, filename: str) -> bool:
+        path = self._path(filename)
+        try:
+            os.utime(path)
+            return True
+        except (OSError, TypeError):
+            return False
+
+    def lookup(self, url: str):
+        """
+        Returns (filename, conditional_headers). filename is set on a fresh
+        hit; otherwise headers carry the validators of a stale entry, if any.
+        """
+        with self._lock:
+            entry = self._by_url.get(url)
+            if entry is None or not self._touch(entry["filename"]):
+                self._by_url.pop(url, None)
+                self.stats["misses"] += 1
+                return None, {}
+            if time.time() - entry["validated_at"] < self.ttl:
+                self.stats["hits"] += 1
+                return entry["filename"], {}
+
+            self.stats["misses"] += 1
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return None, headers
+
+    def revalidated(self, url: str) -> Optional[str]:
+        """
+        Mark a stale entry fresh again after a 304 and return its filename,
+        or None if it was evicted meanwhile and must be downloaded again.
+        """
+        with self._lock:
+            entry = self._by_url.get(url)
+            if entry is None or not self._touch(entry["filename"]):
+                self._by_url.pop(url, None)
+                return None
+            entry["validated_at"] = time.time()
+            self.stats["revalidated"] += 1
+            return entry["filename"]
+
+    def store(self, url: str, filename: str, digest: str, headers: Dict[str, str]) -> str:
+        """
+        Record a freshly ingested body and return the filename LoadImage should
+        use; identical content already on disk wins over the new copy.
+        """
+        with self._lock:
+            existing = self._by_digest.get(digest)
+            if existing and existing != filename and self._touch(existing):
+                path = self._path(filename)
+                if path is not None:
+                    path.unlink(missing_ok=True)
+                self.stats["deduplicated"] += 1
+                filename = existing
+            self._by_digest[digest] = filename
+            self._digest_by_name[filename] = digest
+            self._by_url[url] = {
+                "filename": filename,
+                "digest": digest,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "validated_at": time.time(),
+            }
+        return filename
+
+    def digest_for(self, filename: str) -> Optional[str]:
+        """SHA-256 of a cached input file, if known."""
+        with self._lock:
+            return self._digest_by_name.get(filename)
+
+    def evict(self) -> None:
+        """Delete least recently used cached inputs until under max_bytes."""
+        input_dir = _comfy_dir("input")
+        try:
+            files = [(p.stat(), p) for prefix in (self.PREFIX, self.RENDER_PREFIX)
+                     for p in input_dir.glob(f"{prefix}*") if p.is_file()]
+        except OSError:
+            return
+        total = sum(st.st_size for st, _ in files)
+        if total <= self.max_bytes:
+            return
+
+        now = time.time()
+        files.sort(key=lambda item: item[0].st_mtime)
+        with self._lock:
+            for st, path in files:
+                if total <= self.max_bytes:
+                    break
+                if now - st.st_mtime < self.min_age:
+                    break
+                path.unlink(missing_ok=True)
+                total -= st.st_size
+                self.stats["evicted"] += 1
+                digest = self._digest_by_name.pop(path.name, None)
+                if digest is not None and self._by_digest.get(digest) == path.name:
+                    del self._by_digest[digest]
+                for url in [u for u, e in self._by_url.items() if e["filename"] == path.name]:
+                    del self._by_url[url]
+                logger.info("Evicted cached input %s", path.name)
+
+
+input_cache: Optional[InputCache] = InputCache() if INPUT_CACHE_ENABLED else None
+
+
+def _hashing_chunks(chunks: Iterable[bytes], hasher) -> Iterator[bytes]:
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+async def _hashing_chunks_async(chunks: AsyncIterable[bytes], hasher) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def stream_url_to_comfy(client: ComfyClient, url: str, transport: Optional[str] = None) -> str:
+    """
+    Pipe an image URL into ComfyUI in chunks, without a temp file or a full
+    in-memory copy. With the local transport the body is written atomically
+    into the input folder; otherwise, or if that fails, it is streamed into
+    /upload/image. URLs already in the input cache are not transferred.
+
+    Returns:
+        The ComfyUI filename to reference from LoadImage
+    """
+    headers: Dict[str, str] = {}
+    if input_cache is not None:
+        cached, headers = input_cache.lookup(url)
+        if cached is not None:
+            logger.info("Input cache hit for %s -> %s", url, cached)
+            return cached
+
+    transport = transport or client.transport
+    input_dir = _local_input_dir() if transport == "local" else None
+    hasher = hashlib.sha256()
+    with span("download", url=url) as attrs:
+        response = request_with_retry("GET", url, timeout=HTTP_DOWNLOAD_TIMEOUT, stream=True, headers=headers)
+        attrs["status"] = response.status_code
+    with response:
+        if response.status_code == 304 and input_cache is not None:
+            cached = input_cache.revalidated(url)
+            if cached is not None:
+                logger.info("Input cache revalidated %s", url)
+                return cached
+            # Evicted while revalidating: the lookup now finds nothing, so no conditional headers
+            logger.info("Input cache entry for %s evicted during revalidation, downloading again", url)
+            return stream_url_to_comfy(client, url, transport)
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "image/png")
+        filename = _ingest_filename(url, content_type)
+        chunks = _hashing_chunks(_bounded_chunks(response.iter_content(INGEST_CHUNK_SIZE), url), hasher)
+        try:
+            # The body is streamed through, so this span includes reading it
+            with span("upload", url=url, transport=transport if input_dir is not None else "http"):
+                if input_dir is None:
+                    filename = client.upload_stream(chunks, filename, content_type)
+                else:
+                    filename = write_input_atomic(input_dir, chunks, filename)
+                    filename = _rename_by_content(input_dir, filename, hasher.hexdigest())
+        except OSError as e:
+            if input_dir is None:
+                raise
+            logger.warning("Local write of %s failed (%s), falling back to HTTP upload", filename, e)
+            return stream_url_to_comfy(client, url, transport="http")
+
+    if input_cache is None:
+        return filename
+    filename = input_cache.store(url, filename, hasher.hexdigest(), response.headers)
+    input_cache.evict()
+    return filename
+
+
+async def stream_url_to_comfy_async(client: AsyncComfyClient, url: str,
+                                    transport: Optional[str] = None) -> str:
+    """Async counterpart of stream_url_to_comfy."""
+    headers: Dict[str, str] = {}
+    if input_cache is not None:
+        cached, headers = await asyncio.to_thread(input_cache.lookup, url)
+        if cached is not None:
+            logger.info("Input cache hit for %s -> %s", url, cached)
+            return cached
+
+    transport = transport or client.transport
+    input_dir = await asyncio.to_thread(_local_input_dir) if transport == "local" else None
+    hasher = hashlib.sha256()
+    with span("download", url=url) as attrs:
+        response = await client.request("GET", url, timeout=HTTP_DOWNLOAD_TIMEOUT, headers=headers)
+        attrs["status"] = response.status
+    async with response:
+        if response.status == 304 and input_cache is not None:
+            cached = input_cache.revalidated(url)
+            if cached is not None:
+                logger.info("Input cache revalidated %s", url)
+                return cached
+            logger.info("Input cache entry for %s evicted during revalidation, downloading again", url)
+            return await stream_url_to_comfy_async(client, url, transport)
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "image/png")
+        filename = _ingest_filename(url, content_type)
+        chunks = _hashing_chunks_async(
+            _bounded_chunks_async(response.content.iter_chunked(INGEST_CHUNK_SIZE), url), hasher,
+        )
+        try:
+            with span("upload", url=url, transport=transport if input_dir is not None else "http"):
+                if input_dir is None:
+                    filename = await client.upload_image_bytes(chunks, filename, content_type)
+                else:
+                    filename = await write_input_atomic_async(input_dir, chunks, filename)
+                    filename = await asyncio.to_thread(_rename_by_content, input_dir, filename,
+                                                       hasher.hexdigest())
+        except OSError as e:
+            if input_dir is None:
+                raise
+            logger.warning("Local write of %s failed (%s), falling back to HTTP upload", filename, e)
+            return await stream_url_to_comfy_async(client, url, transport="http")
+
+    if input_cache is None:
+        return filename
+    filename = await asyncio.to_thread(input_cache.store, url, filename, hasher.hexdigest(), response.headers)
+    await asyncio.to_thread(input_cache.evict)
+    return filename
+
+
+def _collect_url_inputs(workflow: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Map each URL-valued LoadImage input to the node ids that reference it."""
+    url_nodes: Dict[str, List[str]] = {}
+    for node_id, node in workflow.items():
+        if node.get("class_type") == "LoadImage":
+            image_value = node.get("inputs", {}).get("image", "")
+            if isinstance(image_value, str) and image_value.startswith("http"):
+                logger.info("LoadImage node %s has URL: %s", node_id, image_value)
+                url_nodes.setdefault(image_value, []).append(node_id)
+    return url_nodes
+
+
+def _apply_uploaded_names(workflow: Dict[str, Any], url_nodes: Dict[str, List[str]],
+                          uploaded: Dict[str, str]) -> None:
+    for url, node_ids in url_nodes.items():
+        for node_id in node_ids:
+            workflow[node_id]["inputs"]["image"] = uploaded[url]
+        logger.info("Replaced URL in node(s) %s with uploaded filename: %s",
+                    ", ".join(node_ids), uploaded[url])
+
+
+def ingest_url_inputs(client: ComfyClient, workflow: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Stream every URL-valued LoadImage input once into ComfyUI's upload
+    endpoint and rewrite the referencing nodes in place.
+
+    Returns:
+        Mapping of URL -> uploaded ComfyUI filename
+    """
+    url_nodes = _collect_url_inputs(workflow)
+    uploaded: Dict[str, str] = {}
+    for url in url_nodes:
+        uploaded[url] = stream_url_to_comfy(client, url)
+    _apply_uploaded_names(workflow, url_nodes, uploaded)
+    return uploaded
+
+
+async def ingest_url_inputs_async(client: AsyncComfyClient, workflow: Dict[str, Any],
+                                  concurrency: int = INGEST_CONCURRENCY) -> Dict[str, str]:
+    """
+    Async counterpart of ingest_url_inputs: all distinct URLs are fetched
+    and uploaded concurrently, bounded by `concurrency`.
+    """
+    url_nodes = _collect_url_inputs(workflow)
+    if not url_nodes:
+        return {}
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ingest(url: str) -> str:
+        async with semaphore:
+            return await stream_url_to_comfy_async(client, url)
+
+    names = await asyncio.gather(*(ingest(url) for url in url_nodes))
+    uploaded = dict(zip(url_nodes, names))
+    _apply_uploaded_names(workflow, url_nodes, uploaded)
+    return uploaded
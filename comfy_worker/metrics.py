@@ -0,0 +1,224 @@
+"""In-process metrics registry and its OpenMetrics exporters."""
+
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from .config import METRICS_FILE, METRICS_FILE_INTERVAL, METRICS_PORT, METRICS_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _label_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """A metric family: one value (or histogram) per label set."""
+
+    kind = "unknown"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Tuple[Tuple[str, str], ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# TYPE {self.name} {self.kind}", f"# HELP {self.name} {self.documentation}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels: Any) -> None:
+        """Mirror a count maintained elsewhere (used by collectors)."""
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}_total{_format_labels(key)} {value}"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Histogram(Metric):
+    """Fixed-bucket histogram; observe() is a bisect and three additions."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics, rendered in OpenMetrics text format.
+
+    Metrics are created on first use by name. Collectors are callables run
+    at render time to refresh values kept elsewhere, such as cache
+    statistics, so the hot path never pays for them.
+    """
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[["MetricsRegistry"], None]] = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, documentation: str, **kwargs: Any):
+        full_name = f"{self.prefix}_{name}"
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = self._metrics[full_name] = cls(full_name, documentation, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str = "") -> Counter:
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name: str, documentation: str = "") -> Gauge:
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name: str, documentation: str = "",
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, buckets=buckets)
+
+    def add_collector(self, collector: Callable[["MetricsRegistry"], None]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n# EOF\n"
+
+
+metrics = MetricsRegistry()
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _record_vram(stats: Dict[str, Any]) -> None:
+    """Publish the VRAM figures of a /system_stats response as gauges."""
+    for dev in stats.get("devices", []):
+        name = dev.get("name", "unknown")
+        for field in ("vram_total", "vram_free", "torch_vram_total", "torch_vram_free"):
+            if field in dev:
+                metrics.gauge(f"{field}_bytes", f"{field} reported by ComfyUI /system_stats").set(dev[field], device=name)
+
+
+def _record_status_event(event: Dict[str, Any]) -> None:
+    """Publish the queue depth carried by ComfyUI's websocket status messages."""
+    if event.get("type") == "status":
+        remaining = ((event.get("data") or {}).get("status") or {}).get("exec_info", {}).get("queue_remaining")
+        if remaining is not None:
+            metrics.gauge("queue_remaining", "Prompts pending or running in ComfyUI").set(remaining)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_metrics_file(path: str, interval: float) -> None:
+    target = Path(path)
+    while True:
+        tmp = target.with_name(f".{target.name}.tmp")
+        try:
+            tmp.write_text(metrics.render(), encoding="utf-8")
+            os.replace(tmp, target)
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %s", path, e)
+        time.sleep(interval)
+
+
+def start_metrics_exporters(port: int = METRICS_PORT, path: str = METRICS_FILE) -> None:
+    """Serve /metrics on 127.0.0.1:`port` and/or rewrite `path` periodically, in daemon threads."""
+    if port:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("Serving metrics on http://127.0.0.1:%d/metrics", port)
+    if path:
+        threading.Thread(target=_write_metrics_file, args=(path, METRICS_FILE_INTERVAL),
+                         name="metrics-file", daemon=True).start()
+        logger.info("Writing metrics to %s every %.0fs", path, METRICS_FILE_INTERVAL)
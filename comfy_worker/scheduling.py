@@ -0,0 +1,451 @@
+"""Health monitoring, admission control, VRAM policy and model-affinity scheduling."""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from .config import (ADMISSION_DEFAULT_EXECUTION, ADMISSION_ENABLED, ADMISSION_MAX_DELAY, ADMISSION_MAX_QUEUE,
+                     ADMISSION_MAX_WAIT, ADMISSION_WINDOW, AFFINITY_SCHEDULING, COMFYUI_PATH, COMFYUI_URL, HANDLER_MODE,
+                     HEALTH_INTERVAL, HEALTH_MONITOR_ENABLED, HEALTH_STALE_AFTER, HEALTH_TIMEOUT, MODEL_LOADERS,
+                     SCHEDULER_DEPTH, SCHEDULER_MAX_SKIPS, VRAM_HEADROOM_BYTES, VRAM_POLICY_ENABLED)
+from .metrics import _record_vram, metrics
+from .client import AsyncComfyClient, ComfyClient, active_prompts
+from .telemetry import span
+
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor:
+    """
+    Polls ComfyUI's /system_stats and /queue in a daemon thread and keeps
+    the latest result as a snapshot dict that is replaced, never mutated,
+    so readers need no lock. Each poll also updates the VRAM and queue
+    gauges.
+
+    Snapshot keys: healthy, checked_at, latency, error, device, vram_total,
+    vram_free, torch_vram_free, queue_running, queue_pending.
+    """
+
+    def __init__(self, server_url: str = COMFYUI_URL, interval: float = HEALTH_INTERVAL,
+                 stale_after: float = HEALTH_STALE_AFTER):
+        self.client = ComfyClient(server_url, timeout=HEALTH_TIMEOUT, use_websocket=False)
+        self.interval = interval
+        self.stale_after = stale_after
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+                self._thread.start()
+                logger.info("Health monitor polling %s every %.1fs", self.client.server_url, self.interval)
+
+    def _run(self) -> None:
+        while True:
+            self.poll()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self) -> None:
+        """
+        Poll again now instead of at the next interval; called whenever a
+        prompt is queued or fails to queue.
+        """
+        self._wake.set()
+
+    def poll(self) -> Dict[str, Any]:
+        """Check ComfyUI once and publish the result as the current snapshot."""
+        start = time.time()
+        snapshot: Dict[str, Any] = {"healthy": False, "checked_at": start}
+        try:
+            response = self.client._request("GET", "/system_stats", timeout=HEALTH_TIMEOUT, retry=False)
+            response.raise_for_status()
+            stats = response.json()
+            response = self.client._request("GET", "/queue", timeout=HEALTH_TIMEOUT, retry=False)
+            response.raise_for_status()
+            queue_state = response.json()
+        except Exception as e:
+            snapshot["error"] = str(e)
+        else:
+            dev = (stats.get("devices") or [{}])[0]
+            snapshot.update({
+                "healthy": True,
+                "device": dev.get("name"),
+                "vram_total": dev.get("vram_total"),
+                "vram_free": dev.get("vram_free"),
+                "torch_vram_free": dev.get("torch_vram_free"),
+                "queue_running": len(queue_state.get("queue_running", [])),
+                "queue_pending": len(queue_state.get("queue_pending", [])),
+            })
+            _record_vram(stats)
+            metrics.gauge("queue_running", "Prompts running in ComfyUI").set(snapshot["queue_running"])
+            metrics.gauge("queue_pending", "Prompts waiting in ComfyUI's queue").set(snapshot["queue_pending"])
+        snapshot["latency"] = round(time.time() - start, 4)
+        metrics.gauge("comfy_up", "1 if the last health check succeeded").set(int(snapshot["healthy"]))
+        metrics.histogram("health_check_seconds", "Duration of background health checks").observe(snapshot["latency"])
+
+        previous = self._snapshot
+        if previous is not None and previous["healthy"] != snapshot["healthy"]:
+            logger.warning("ComfyUI became %s%s", "healthy" if snapshot["healthy"] else "unhealthy",
+                           f": {snapshot['error']}" if "error" in snapshot else "")
+        self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        """The latest snapshot, or None before the first poll."""
+        return self._snapshot
+
+    def fresh_snapshot(self) -> Optional[Dict[str, Any]]:
+        """The latest snapshot if it is recent enough to act on."""
+        snapshot = self._snapshot
+        if snapshot is None or time.time() - snapshot["checked_at"] > self.stale_after:
+            return None
+        return snapshot
+
+
+health_monitor: Optional[HealthMonitor] = HealthMonitor() if HEALTH_MONITOR_ENABLED else None
+
+
+def comfy_ready(client: ComfyClient) -> bool:
+    """
+    Whether ComfyUI can take a job. Reads the monitor's snapshot when it is
+    fresh; otherwise (monitor not running yet, or stuck) checks directly,
+    which also refreshes the snapshot.
+    """
+    if health_monitor is None:
+        return client.check_connection()
+    health_monitor.start()
+    snapshot = health_monitor.fresh_snapshot() or health_monitor.poll()
+    if not snapshot["healthy"]:
+        logger.error("ComfyUI unhealthy: %s", snapshot.get("error"))
+    return snapshot["healthy"]
+
+
+async def comfy_ready_async(client: AsyncComfyClient) -> bool:
+    """Async counterpart of comfy_ready."""
+    if health_monitor is None:
+        return await client.check_connection()
+    health_monitor.start()
+    snapshot = health_monitor.fresh_snapshot() or await asyncio.to_thread(health_monitor.poll)
+    if not snapshot["healthy"]:
+        logger.error("ComfyUI unhealthy: %s", snapshot.get("error"))
+    return snapshot["healthy"]
+
+
+#======================================================================
+class AdmissionController:
+    """
+    Decides whether a job may queue its prompt now. The wait ahead of it is
+    estimated from ComfyUI's queue depth (running + pending, from the health
+    monitor) times the average execution time of the last few prompts, so
+    jobs under a burst are delayed or turned away with an estimate instead
+    of silently running into ComfyClient.timeout.
+    """
+
+    def __init__(self, max_queue: int = ADMISSION_MAX_QUEUE, max_wait: float = ADMISSION_MAX_WAIT,
+                 max_delay: float = ADMISSION_MAX_DELAY, window: int = ADMISSION_WINDOW):
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_delay = max_delay
+        self._executions: collections.deque = collections.deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        """Add the execution time of a finished prompt to the rolling window."""
+        self._executions.append(seconds)
+
+    def average_execution(self) -> float:
+        executions = list(self._executions)
+        return sum(executions) / len(executions) if executions else ADMISSION_DEFAULT_EXECUTION
+
+    def assess(self, snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        """Decision for one health snapshot: "accept", "delay" or "reject"."""
+        # Prompts queued here since the snapshot was taken are not in it yet
+        depth = max(snapshot.get("queue_running", 0) + snapshot.get("queue_pending", 0), len(active_prompts))
+        average = self.average_execution()
+        estimate = depth * average
+        if estimate > self.max_wait:
+            decision = "reject"
+        elif depth >= self.max_queue:
+            decision = "delay"
+        else:
+            decision = "accept"
+        return {"decision": decision, "queue_depth": depth,
+                "estimated_wait": round(estimate, 1), "average_execution": round(average, 2)}
+
+    def _finish(self, report: Dict[str, Any], started: float) -> Dict[str, Any]:
+        if report["decision"] == "delay":
+            report["decision"] = "reject"
+        report["delayed"] = round(time.time() - started, 3)
+        if report["decision"] == "reject":
+            report["reason"] = (f"ComfyUI is busy: {report['queue_depth']} prompts queued, "
+                                f"estimated wait {report['estimated_wait']:.0f}s")
+            logger.warning("Job rejected: %s", report["reason"])
+        metrics.counter("admission_decisions", "Admission decisions by outcome").inc(decision=report["decision"])
+        metrics.histogram("admission_delay_seconds", "Time jobs were held before queueing").observe(report["delayed"])
+        return report
+
+    def admit(self) -> Dict[str, Any]:
+        """
+        Block until the job may be queued, or give up.
+
+        Returns:
+            A report with the final "decision" ("accept" or "reject"), the
+            queue depth, the estimated wait and the time spent delayed;
+            rejections carry a "reason"
+        """
+        started = time.time()
+        while True:
+            report = self.assess(health_monitor.fresh_snapshot() or health_monitor.poll())
+            if report["decision"] != "delay" or time.time() - started >= self.max_delay:
+                return self._finish(report, started)
+            time.sleep(health_monitor.interval)
+
+    async def admit_async(self) -> Dict[str, Any]:
+        """Async counterpart of admit."""
+        started = time.time()
+        while True:
+            snapshot = health_monitor.fresh_snapshot() or await asyncio.to_thread(health_monitor.poll)
+            report = self.assess(snapshot)
+            if report["decision"] != "delay" or time.time() - started >= self.max_delay:
+                return self._finish(report, started)
+            await asyncio.sleep(health_monitor.interval)
+
+
+# Needs the health monitor for the queue depth
+admission: Optional[AdmissionController] = (
+    AdmissionController() if ADMISSION_ENABLED and health_monitor is not None else None
+)
+
+
+#======================================================================
+_model_sizes: Dict[Tuple[str, str], int] = {}
+
+
+def _model_size(class_type: str, name: str) -> int:
+    """Size of a loader's weights file in bytes, 0 when it cannot be found."""
+    key = (class_type, name)
+    if key not in _model_sizes:
+        size = 0
+        for folder in MODEL_LOADERS[class_type][1]:
+            path = Path(COMFYUI_PATH) / "models" / folder / name
+            if path.is_file():
+                size = path.stat().st_size
+                break
+        _model_sizes[key] = size
+    return _model_sizes[key]
+
+
+def workflow_models(workflow: Dict[str, Any]) -> Dict[Tuple, Dict[str, Any]]:
+    """
+    The models a workflow loads, keyed by signature: the loader class and
+    its literal inputs. The same file loaded with another CLIPLoader `type`
+    or LoRA strength is a different model in ComfyUI's memory, and so gets
+    a different signature.
+    """
+    models = {}
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        if class_type not in MODEL_LOADERS:
+            continue
+        inputs = node.get("inputs", {})
+        name = inputs.get(MODEL_LOADERS[class_type][0])
+        if not isinstance(name, str):
+            continue
+        signature = (class_type,) + tuple(sorted(
+            (key, str(value)) for key, value in inputs.items() if not isinstance(value, list)
+        ))
+        models[signature] = {"node_id": node_id, "class_type": class_type, "name": name,
+                             "bytes": _model_size(class_type, name)}
+    return models
+
+
+class VramPolicy:
+    """
+    Decides, per prompt about to be queued, whether ComfyUI should unload
+    its models first. The models ComfyUI holds are predicted from the
+    prompts queued before; free VRAM comes from the health monitor. The
+    outcome is one of:
+
+    - "keep": the models the job still has to load fit in free VRAM, or
+      the job reuses a model that is already loaded;
+    - "unload": they fit once every loaded model is unloaded (/free with
+      unload_models);
+    - "free": they do not fit even then, so ComfyUI's execution cache is
+      dropped as well (free_memory).
+
+    /free with unload_models unloads every model, including ones the job
+    would reuse, so it is only planned for a job that reuses none of the
+    loaded models; a job that does reuse one leaves eviction to ComfyUI.
+    After a /free the resident set starts empty and holds only what the
+    job loads.
+
+    ComfyUI applies /free after the prompt it is running, i.e. before
+    the next one starts, so only a prompt with nothing pending ahead of it
+    gets one. Behind pending prompts (a batch queued back to back, other
+    concurrent jobs) the job keeps what is loaded; its models are assumed
+    to join the resident set and ComfyUI evicts on its own if they do not
+    fit.
+    """
+
+    def __init__(self, headroom: int = VRAM_HEADROOM_BYTES):
+        self.headroom = headroom
+        self.resident: Dict[Tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def plan(self, workflow: Dict[str, Any], snapshot: Dict[str, Any], pending: int = 0) -> Dict[str, Any]:
+        """
+        Choose the action for `workflow`, queued behind `pending` prompts,
+        and update the resident set as if it ran.
+        """
+        needed = {signature: model["bytes"] for signature, model in workflow_models(workflow).items()}
+        vram_free = snapshot.get("vram_free")
+        with self._lock:
+            missing = sum(size for signature, size in needed.items() if signature not in self.resident)
+            loaded = sum(self.resident.values())
+            reused = any(signature in self.resident for signature in needed)
+            if pending or vram_free is None or missing + self.headroom <= vram_free:
+                action = "keep"
+                self.resident.update(needed)
+            elif reused:
+                # ComfyUI evicts to make room; only the job's models are sure to stay
+                action = "keep"
+                self.resident = dict(needed)
+            else:
+                action = "unload" if missing + self.headroom <= vram_free + loaded else "free"
+                self.resident = {}
+                self.resident.update(needed)
+        return {"action": action, "load_bytes": missing, "unload_bytes": loaded if action != "keep" else 0,
+                "vram_free": vram_free, "pending": pending}
+
+    @staticmethod
+    def _free_body(action: str) -> Dict[str, bool]:
+        return {"unload_models": True, "free_memory": action == "free"}
+
+    @staticmethod
+    def _pending(queue_info: Optional[Dict[str, Any]]) -> int:
+        # When the queue cannot be read, assume the prompt is not next
+        return len(queue_info.get("queue_pending", [])) if queue_info is not None else 1
+
+    def prepare(self, client: ComfyClient, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """Plan for `workflow` and call /free when the plan says so."""
+        try:
+            queue_info = client.get_queue()
+        except Exception as e:
+            logger.warning("VRAM: could not read the queue: %s", e)
+            queue_info = None
+        snapshot = health_monitor.fresh_snapshot() or health_monitor.poll()
+        decision = self.plan(workflow, snapshot, self._pending(queue_info))
+        if decision["action"] != "keep":
+            self._log(decision)
+            try:
+                client.free(**self._free_body(decision["action"]))
+            except Exception as e:
+                # ComfyUI still evicts models itself when a load does not fit
+                logger.warning("VRAM: /free failed: %s", e)
+        return decision
+
+    async def prepare_async(self, client: AsyncComfyClient, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """Async counterpart of prepare."""
+        try:
+            queue_info = await client.get_queue()
+        except Exception as e:
+            logger.warning("VRAM: could not read the queue: %s", e)
+            queue_info = None
+        snapshot = health_monitor.fresh_snapshot() or await asyncio.to_thread(health_monitor.poll)
+        decision = self.plan(workflow, snapshot, self._pending(queue_info))
+        if decision["action"] != "keep":
+            self._log(decision)
+            try:
+                await client.free(**self._free_body(decision["action"]))
+            except Exception as e:
+                logger.warning("VRAM: /free failed: %s", e)
+        return decision
+
+    @staticmethod
+    def _log(decision: Dict[str, Any]) -> None:
+        logger.info("VRAM: %s before next prompt (needs %.1f GB, %.1f GB free, unloading %.1f GB)",
+                    decision["action"], decision["load_bytes"] / 1024 ** 3,
+                    (decision["vram_free"] or 0) / 1024 ** 3, decision["unload_bytes"] / 1024 ** 3)
+        metrics.counter("vram_frees", "Calls to ComfyUI /free by the VRAM policy").inc(action=decision["action"])
+
+
+# Needs the health monitor for free VRAM
+vram_policy: Optional[VramPolicy] = VramPolicy() if VRAM_POLICY_ENABLED and health_monitor is not None else None
+
+
+#======================================================================
+class AffinityScheduler:
+    """
+    Orders the prompts of concurrent jobs to minimise model swaps.
+
+    Jobs wait for a turn before queueing their prompt; at most `depth`
+    prompts are in ComfyUI at once (one running, the next one queued, so
+    the GPU never idles). When a turn frees up, the waiting job whose
+    models cost the fewest bytes to load on top of those of the previous
+    prompt goes next, the oldest on ties. Each time a job is passed over
+    by a younger one it gains a skip; after `max_skips` it goes first.
+    """
+
+    def __init__(self, depth: int = SCHEDULER_DEPTH, max_skips: int = SCHEDULER_MAX_SKIPS):
+        self.depth = depth
+        self.max_skips = max_skips
+        self.running = 0
+        self.loaded: Dict[Tuple, int] = {}
+        self._waiting: List[Dict[str, Any]] = []
+
+    def _cost(self, ticket: Dict[str, Any]) -> Tuple[int, int]:
+        missing = [size for signature, size in ticket["models"].items() if signature not in self.loaded]
+        return sum(missing), len(missing)
+
+    def _dispatch(self) -> None:
+        while self._waiting and self.running < self.depth:
+            starved = [ticket for ticket in self._waiting if ticket["skips"] >= self.max_skips]
+            chosen = starved[0] if starved else min(self._waiting, key=self._cost)
+            position = self._waiting.index(chosen)
+            for ticket in self._waiting[:position]:
+                ticket["skips"] += 1
+            if position:
+                logger.info("Scheduler: running a job ahead of %d older one(s) to reuse loaded models", position)
+                metrics.counter("scheduler_reorders", "Jobs moved ahead to reuse loaded models").inc()
+            del self._waiting[position]
+            self.running += 1
+            self.loaded = chosen["models"]
+            chosen["ready"].set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def turn(self, workflow: Dict[str, Any]) -> AsyncIterator[None]:
+        """Wait for this workflow's turn and hold it until the block exits."""
+        ticket = {"models": {signature: model["bytes"] for signature, model in workflow_models(workflow).items()},
+                  "skips": 0, "ready": asyncio.get_running_loop().create_future()}
+        self._waiting.append(ticket)
+        self._dispatch()
+        try:
+            with span("schedule_wait") as attrs:
+                await ticket["ready"]
+                attrs["skips"] = ticket["skips"]
+        except BaseException:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+            else:
+                self.running -= 1
+                self._dispatch()
+            raise
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+
+# Only concurrent mode has several jobs to choose from
+scheduler: Optional[AffinityScheduler] = (
+    AffinityScheduler() if HANDLER_MODE == "concurrent" and AFFINITY_SCHEDULING else None
+)
@@ -0,0 +1,168 @@
+"""Per-job timings and execution tracking."""
+
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .metrics import metrics
+from .client import _is_final_event
+
+logger = logging.getLogger(__name__)
+
+
+class Timings:
+    """
+    Timing spans of one job, returned in its "timings" field and logged as
+    one JSON line. Code anywhere below the handler records into the current
+    job's Timings with span(); the job is tracked in a context variable,
+    which asyncio tasks and asyncio.to_thread inherit.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self.nodes: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float, **attrs: Any) -> None:
+        with self._lock:
+            self.spans.append({"name": name, "start": round(start - self.started, 4),
+                               "duration": round(end - start, 4), **attrs})
+
+    def add_node(self, node_id: str, class_type: Optional[str], start: float, end: float, **attrs: Any) -> None:
+        with self._lock:
+            self.nodes.append({"node_id": node_id, "class_type": class_type,
+                               "start": round(start - self.started, 4), "duration": round(end - start, 4), **attrs})
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages: Dict[str, float] = {}
+            for s in self.spans:
+                stages[s["name"]] = round(stages.get(s["name"], 0.0) + s["duration"], 4)
+            return {"total": round(time.time() - self.started, 4), "stages": stages,
+                    "spans": list(self.spans), "nodes": list(self.nodes)}
+
+
+_timings: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar("timings", default=None)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """Record the enclosed block as a span of the current job; the yielded dict adds attributes."""
+    timings = _timings.get()
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        if timings is not None:
+            timings.add(name, start, time.time(), **attrs)
+
+
+def _log_timings(timings: Timings, response: Dict[str, Any]) -> Dict[str, Any]:
+    """Attach a job's timings to its response, emit them as one JSON log line and record metrics."""
+    response["timings"] = timings.summary()
+    _record_job_metrics(response)
+    logger.info("Job timings %s", json.dumps(
+        {"status": response.get("status", "error"), "prompt_id": response.get("prompt_id"), **response["timings"]},
+        ensure_ascii=False, separators=(",", ":"),
+    ))
+    return response
+
+
+def _record_job_metrics(response: Dict[str, Any]) -> None:
+    summary = response["timings"]
+    status = "error" if "error" in response else "success"
+    metrics.counter("jobs", "Jobs handled, by outcome").inc(status=status)
+    metrics.histogram("job_duration_seconds", "Wall time of a job").observe(summary["total"], status=status)
+    stage_seconds = metrics.histogram("job_stage_seconds", "Time per job spent in each stage")
+    for stage, seconds in summary["stages"].items():
+        stage_seconds.observe(seconds, stage=stage)
+    node_seconds = metrics.histogram("node_seconds", "ComfyUI node execution time, by node type")
+    for node in summary["nodes"]:
+        if not node.get("cached"):
+            node_seconds.observe(node["duration"], class_type=node.get("class_type") or "unknown")
+
+
+def _record_error(e: BaseException) -> None:
+    metrics.counter("errors", "Errors by exception class").inc(type=type(e).__name__)
+
+
+class ExecutionTracker:
+    """
+    Turn a prompt's websocket events into timing spans: the wait in
+    ComfyUI's queue before execution_start, the execution itself, and one
+    entry per node (cached nodes with zero duration). Without events, e.g.
+    when polling, the queue wait and execution are taken from the status
+    messages in the prompt's history instead.
+    """
+
+    def __init__(self, workflow: Dict[str, Any], prompt_id: str, queued_at: float):
+        self.timings = _timings.get()
+        self.workflow = workflow
+        self.prompt_id = prompt_id
+        self.queued_at = queued_at
+        self.exec_start: Optional[float] = None
+        self.current: Optional[Tuple[str, float]] = None
+
+    def _close_node(self, now: float) -> None:
+        if self.current is not None:
+            node_id, start = self.current
+            self.timings.add_node(node_id, self.workflow.get(node_id, {}).get("class_type"), start, now,
+                                  cached=False, prompt_id=self.prompt_id)
+            self.current = None
+
+    def observe(self, event: Dict[str, Any]) -> None:
+        now = time.time()
+        event_type = event.get("type")
+        data = event.get("data") or {}
+        if event_type == "execution_start":
+            self.exec_start = now
+        if self.timings is None:
+            return
+        if event_type == "execution_start":
+            self.timings.add("queue_wait", self.queued_at, now, prompt_id=self.prompt_id)
+        elif event_type == "execution_cached":
+            for node_id in data.get("nodes", []):
+                node_id = str(node_id)
+                self.timings.add_node(node_id, self.workflow.get(node_id, {}).get("class_type"), now, now,
+                                      cached=True, prompt_id=self.prompt_id)
+        elif event_type == "executing":
+            self._close_node(now)
+            if data.get("node") is not None:
+                self.current = (str(data["node"]), now)
+        elif _is_final_event(event):
+            self._close_node(now)
+
+    def finish(self, history: Dict) -> Optional[float]:
+        """Record the remaining spans; returns the execution time in seconds when known."""
+        now = time.time()
+        if self.exec_start is not None:
+            if self.timings is not None:
+                self._close_node(now)
+                self.timings.add("execution", self.exec_start, now, prompt_id=self.prompt_id)
+            return now - self.exec_start
+        stamps = {name: data.get("timestamp", 0) / 1000 for name, data in history.get("status", {}).get("messages", [])
+                  if isinstance(data, dict)}
+        start = stamps.get("execution_start", 0)
+        end = stamps.get("execution_success") or stamps.get("execution_error") or now
+        duration = None
+        # ComfyUI runs on this host, so its clock is only trusted within the job's window
+        if self.queued_at - 1 <= start <= end <= now + 1:
+            start = max(start, self.queued_at)
+            duration = max(end, start) - start
+            if self.timings is not None:
+                self.timings.add("queue_wait", self.queued_at, start, prompt_id=self.prompt_id)
+                self.timings.add("execution", start, max(end, start), prompt_id=self.prompt_id)
+        if self.timings is None:
+            return duration
+        self._close_node(now)
+        for name, data in history.get("status", {}).get("messages", []):
+            if name == "execution_cached" and isinstance(data, dict):
+                for node_id in data.get("nodes", []):
+                    self.timings.add_node(str(node_id), self.workflow.get(str(node_id), {}).get("class_type"),
+                                          now, now, cached=True, prompt_id=self.prompt_id)
+        return duration
@@ -1,20 +1,29 @@
-import json
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
 import logging
-import os
-import time
-import uuid
-from pathlib import Path
-from typing import Any, Dict, List, Optional
-import requests
-
-# ── Configuration ────────────────────────────────────────────────────
-COMFYUI_PORT = int(os.environ.get("COMFYUI_PORT", "8188"))
-COMFYUI_URL = f"http://127.0.0.1:{COMFYUI_PORT}"
-COMFYUI_PATH = '/workspace/ComfyUI/'
-COMFYUI_INPUT_FOLDER = os.environ.get("COMFYUI_INPUT_FOLDER", "input")
-COMFYUI_OUTPUT_FOLDER = os.environ.get("COMFYUI_OUTPUT_FOLDER", "output")
+import queue
+import threading
+from typing import Any, AsyncIterator, Dict, Generator, Iterator, List, Optional, Set, Tuple
+
+from comfy_worker.config import (BATCH_MAX_ITEMS, COMFYUI_URL, HANDLER_MODE, JOB_CONCURRENCY, OUTPUT_NODE_TYPES,
+                                 SCHEDULER_LOOKAHEAD)
+from comfy_worker.metrics import start_metrics_exporters
+from comfy_worker.client import (AsyncComfyClient, ComfyClient, _build_image_results, active_prompts, get_async_client,
+                                 get_client, install_sigterm_handler)
+from comfy_worker.telemetry import Timings, _log_timings, _record_error, _timings, span
+from comfy_worker.scheduling import admission, comfy_ready, comfy_ready_async, health_monitor, scheduler
+from comfy_worker.inputs import ingest_url_inputs, ingest_url_inputs_async
+from comfy_worker.graph import expand_sweep, optimize_workflow
+from comfy_worker.caches import _cache_key, _cached_result, _capture_node_id, result_cache, workflow_fingerprint
+from comfy_worker.delivery import (_delivery_options, _job_response, _job_response_async, _output_id, _splat_options,
+                                   deliver_outputs, deliver_outputs_async)
+from comfy_worker.execution import (_collect, _collect_async, _execute, _execute_async, _submit, _submit_async,
+                                    run_coalesced, run_coalesced_async)
+
 
-#======================================================================
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -23,145 +32,468 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-#======================================================================
-class ComfyClient:
-    """Synchronous client for the ComfyUI REST API."""
+def _batch_options(workflow: Dict[str, Any], batch: Optional[Dict[str, Any]]) -> Optional[Tuple[str, List[str]]]:
+    """
+    Validate a job's "batch" options; None means a single-prompt job.
 
-    def __init__(self, server_url: str, timeout: int = 600):
-        self.server_url = server_url.rstrip("/")
-        self.timeout = timeout
-        self.client_id = str(uuid.uuid4())
+    Keys:
+        images: Filenames or URLs, one prompt each
+        node: LoadImage node to feed (default: the workflow's only LoadImage)
 
-    def _url(self, path: str) -> str:
-        return f"{self.server_url}/{path.lstrip('/')}"
+    Returns:
+        (LoadImage node id, images)
+    """
+    if not batch:
+        return None
+    images = batch.get("images")
+    if not isinstance(images, list) or not images:
+        raise ValueError("batch.images must be a non-empty list")
+    if len(images) > BATCH_MAX_ITEMS:
+        raise ValueError(f"batch.images has {len(images)} items, the limit is {BATCH_MAX_ITEMS}")
+
+    node_id = batch.get("node")
+    if node_id is None:
+        loaders = [n for n, node in workflow.items() if node.get("class_type") == "LoadImage"]
+        if len(loaders) != 1:
+            raise ValueError(f"batch.node is required, the workflow has {len(loaders)} LoadImage nodes")
+        node_id = loaders[0]
+    node_id = str(node_id)
+    if workflow.get(node_id, {}).get("class_type") != "LoadImage":
+        raise ValueError(f"batch.node {node_id} is not a LoadImage node")
+    return node_id, [str(image) for image in images]
+
+
+def expand_batch(workflow: Dict[str, Any], node_id: str, images: List[str]) -> Iterator[Dict[str, Any]]:
+    """One copy of the workflow per image, with `node_id` loading that image."""
+    for image in images:
+        item = copy.deepcopy(workflow)
+        item[node_id]["inputs"]["image"] = image
+        yield item
+
+
+def run_batch(client: ComfyClient, workflow: Dict[str, Any], node_id: str, images: List[str],
+              inp: Dict[str, Any], delivery_opts: Optional[Dict[str, Any]],
+              splat_opts: Optional[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Run a batch job and yield each item's response in input order.
+
+    Every item is ingested and queued before the first one is awaited, so
+    ComfyUI moves straight from one prompt to the next with its models
+    still loaded. Items already in the result cache are not queued, and
+    identical items within the batch share one prompt. A failing item is
+    reported in its own response and does not stop the others.
+    """
+    use_render_cache = inp.get("render_cache", inp.get("cache", True))
+    planned = []
+    jobs: Dict[str, Dict[str, Any]] = {}
+    for index, item in enumerate(expand_batch(workflow, node_id, images)):
+        plan: Dict[str, Any] = {"index": index, "image": images[index]}
+        try:
+            with span("ingest", item=index):
+                ingest_url_inputs(client, item)
+            with span("cache_lookup", item=index):
+                fingerprint = workflow_fingerprint(item)
+                plan["cache_key"] = _cache_key(fingerprint, inp)
+                plan["entry"] = result_cache.get(plan["cache_key"]) if plan["cache_key"] is not None else None
+            if plan["entry"] is None:
+                job_key = fingerprint or str(index)
+                if job_key not in jobs:
+                    jobs[job_key] = _submit(client, item, use_render_cache, splat_opts is not None)
+                plan["job"] = jobs[job_key]
+        except Exception as e:
+            plan["error"] = e
+        planned.append(plan)
+    logger.info("Batch: %d items, %d prompts queued", len(planned), len(jobs))
 
-    def check_connection(self) -> bool:
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for plan in planned:
+            response: Dict[str, Any] = {"index": plan["index"], "image": plan["image"]}
+            try:
+                if "error" in plan:
+                    raise plan["error"]
+                # Items sharing a prompt store its result once
+                fresh = False
+                if plan["entry"] is not None:
+                    result = _cached_result(plan["cache_key"], plan["entry"])
+                else:
+                    prompt_id = plan["job"]["prompt_id"]
+                    fresh = prompt_id not in results
+                    if fresh:
+                        results[prompt_id] = _collect(client, plan["job"], plan["cache_key"])
+                    result = results[prompt_id]
+                with span("delivery", item=plan["index"]):
+                    response.update(_job_response(client, result, plan["cache_key"], plan["entry"],
+                                                  delivery_opts, splat_opts, store=fresh))
+            except Exception as e:
+                logger.error("Batch item %d failed: %s", plan["index"], e)
+                _record_error(e)
+                response.update({"status": "error", "error": str(e)})
+            yield response
+    finally:
+        # Prompts still queued when the batch is abandoned part-way
+        for job in jobs.values():
+            if job["prompt_id"] in active_prompts:
+                client.cancel_prompt(job["prompt_id"])
+                active_prompts.discard(job["prompt_id"])
+
+
+async def run_batch_async(client: AsyncComfyClient, workflow: Dict[str, Any], node_id: str, images: List[str],
+                          inp: Dict[str, Any], delivery_opts: Optional[Dict[str, Any]],
+                          splat_opts: Optional[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Async counterpart of run_batch."""
+    use_render_cache = inp.get("render_cache", inp.get("cache", True))
+    planned = []
+    jobs: Dict[str, Dict[str, Any]] = {}
+    for index, item in enumerate(expand_batch(workflow, node_id, images)):
+        plan: Dict[str, Any] = {"index": index, "image": images[index]}
         try:
-            response = requests.get(self._url("/system_stats"), timeout=10)
-            response.raise_for_status()
-            stats = response.json()
-            devices = stats.get("devices", [])
-            if devices:
-                dev = devices[0]
-                vram = dev.get("vram_total", 0) / (1024 ** 3)
-                logger.info(
-                    "Client connected | GPU: %s | VRAM: %.1f GB",
-                    dev.get("name", "unknown"), vram,
+            with span("ingest", item=index):
+                await ingest_url_inputs_async(client, item)
+            with span("cache_lookup", item=index):
+                fingerprint = await asyncio.to_thread(workflow_fingerprint, item)
+                plan["cache_key"] = _cache_key(fingerprint, inp)
+                plan["entry"] = (
+                    await asyncio.to_thread(result_cache.get, plan["cache_key"]) if plan["cache_key"] is not None
+                    else None
                 )
-            return True
+            if plan["entry"] is None:
+                job_key = fingerprint or str(index)
+                if job_key not in jobs:
+                    jobs[job_key] = await _submit_async(client, item, use_render_cache, splat_opts is not None)
+                plan["job"] = jobs[job_key]
         except Exception as e:
-            logger.error("Connect failed: %s", e)
-            return False
+            plan["error"] = e
+        planned.append(plan)
+    logger.info("Batch: %d items, %d prompts queued", len(planned), len(jobs))
 
-    def upload_image(self, image_path: str, subfolder: str = "", overwrite: bool = True) -> str:
-        path = Path(image_path)
-        if not path.exists():
-            raise FileNotFoundError(f"Image not found: {path}")
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for plan in planned:
+            response: Dict[str, Any] = {"index": plan["index"], "image": plan["image"]}
+            try:
+                if "error" in plan:
+                    raise plan["error"]
+                fresh = False
+                if plan["entry"] is not None:
+                    result = _cached_result(plan["cache_key"], plan["entry"])
+                else:
+                    prompt_id = plan["job"]["prompt_id"]
+                    fresh = prompt_id not in results
+                    if fresh:
+                        results[prompt_id] = await _collect_async(client, plan["job"], plan["cache_key"])
+                    result = results[prompt_id]
+                with span("delivery", item=plan["index"]):
+                    response.update(await _job_response_async(client, result, plan["cache_key"], plan["entry"],
+                                                              delivery_opts, splat_opts, store=fresh))
+            except Exception as e:
+                logger.error("Batch item %d failed: %s", plan["index"], e)
+                _record_error(e)
+                response.update({"status": "error", "error": str(e)})
+            yield response
+    finally:
+        for job in jobs.values():
+            if job["prompt_id"] in active_prompts:
+                await client.cancel_prompt(job["prompt_id"])
+                active_prompts.discard(job["prompt_id"])
+
+
+def _batch_response(items: List[Dict[str, Any]], optimization: Dict[str, Any],
+                    admitted: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    failed = sum(1 for item in items if item.get("status") != "success")
+    response = {
+        "status": "success" if failed < len(items) else "error",
+        "items": items,
+        "batch": {"count": len(items), "succeeded": len(items) - failed, "failed": failed},
+        "optimization": optimization,
+    }
+    if admitted is not None:
+        response["admission"] = admitted
+    return response
 
-        files = {"image": (path.name, open(path, "rb"), "image/png")}
-        data = {"overwrite": str(overwrite).lower()}
-        if subfolder:
-            data["subfolder"] = subfolder
 
-        response = requests.post(self._url("/upload/image"), files=files, data=data, timeout=self.timeout)
-        response.raise_for_status()
-        result = response.json()
+#======================================================================
+_stream_pool = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="stream")
 
-        filename = result.get("name", path.name)
-        logger.info("Uploaded %s -> %s", path.name, filename)
-        return filename
 
-    def queue_prompt(self, workflow: Dict[str, Any]) -> str:
-        payload = {"prompt": workflow, "client_id": self.client_id}
+def _cached_render_messages(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Render messages for render-cache hits, which are known before the prompt runs."""
+    return [
+        {"type": "render", "node_id": node_id, "cached": True, "images": [{
+            "node_id": node_id, "filename": job["workflow"][node_id]["inputs"]["image"],
+            "subfolder": "", "type": "input",
+        }]}
+        for node_id in job["render_report"].get("hits", [])
+    ]
 
-        response = requests.post(self._url("/prompt"), json=payload, timeout=self.timeout)
-        if response.status_code != 200:
-            logger.error("ComfyUI /prompt error %s: %s", response.status_code, response.text)
-        response.raise_for_status()
-        result = response.json()
 
-        if "error" in result:
-            raise RuntimeError(f"ComfyUI queue error: {result['error']}")
+def _event_message(job: Dict[str, Any], event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Translate a ComfyUI websocket event into a stream message, or None.
 
-        prompt_id = result["prompt_id"]
-        logger.info("Queued prompt %s", prompt_id)
-        return prompt_id
+    `executed` events of SaveImage nodes become "output" messages and those
+    of render-cache captures or previews "render" messages (for the render
+    node they capture); they carry undelivered image references.
+    """
+    event_type = event.get("type")
+    data = event.get("data") or {}
+    workflow = job["workflow"]
+    if event_type == "progress":
+        return {"type": "progress", "node_id": data.get("node"), "value": data.get("value"), "max": data.get("max")}
+    if event_type == "executing" and data.get("node") is not None:
+        node_id = str(data["node"])
+        return {"type": "executing", "node_id": node_id,
+                "class_type": workflow.get(node_id, {}).get("class_type")}
+    if event_type == "execution_cached":
+        return {"type": "cached", "node_ids": data.get("nodes", [])}
+    if event_type != "executed":
+        return None
+
+    node_id = str(data.get("node"))
+    renders = {_capture_node_id(n): n for n in job["captures"]}
+    if node_id in renders:
+        kind, node_id = "render", renders[node_id]
+    elif workflow.get(node_id, {}).get("class_type") in OUTPUT_NODE_TYPES:
+        kind = "output"
+    else:
+        return None
+    images = (data.get("output") or {}).get("images", [])
+    return {"type": kind, "node_id": node_id, "images": _build_image_results({node_id: images})}
 
-    def get_history(self, prompt_id: str) -> Optional[Dict]:
-        response = requests.get(self._url(f"/history/{prompt_id}"), timeout=self.timeout)
-        response.raise_for_status()
-        data = response.json()
-        return data.get(prompt_id)
 
-    def wait_for_completion(self, prompt_id: str, poll_interval: float = 2.0) -> Dict:
-        start = time.time()
-        logger.info("Waiting for prompt %s …", prompt_id[:12])
+def _deliver_message(client: ComfyClient, message: Dict[str, Any], delivery_opts: Optional[Dict[str, Any]],
+                     prompt_id: str) -> Dict[str, Any]:
+    if "images" not in message or delivery_opts is None:
+        return message
+    images, delivery = deliver_outputs(message["images"], delivery_opts, client.fetch_output, prompt_id)
+    return {**message, "images": images, "delivery": delivery}
 
-        while True:
-            elapsed = time.time() - start
-            if elapsed > self.timeout:
-                raise TimeoutError(f"Prompt {prompt_id} timed out after {self.timeout}s")
-
-            history = self.get_history(prompt_id)
-            if history is not None:
-                status = history.get("status", {})
-                if status.get("status_str") == "error":
-                    msg = json.dumps(status, indent=2, ensure_ascii=False)
-                    raise RuntimeError(f"Execution failed:\n{msg}")
-                logger.info("Prompt %s completed in %.1fs", prompt_id[:12], elapsed)
-                return history
-
-            time.sleep(poll_interval)
-
-    def download_image(self, filename: str, subfolder: str = "", img_type: str = "output") -> bytes:
-        """Download image from ComfyUI."""
-        params = {"filename": filename, "type": img_type, "subfolder": subfolder}
-        response = requests.get(self._url("/view"), params=params, timeout=self.timeout)
-        response.raise_for_status()
-        return response.content
-
-    def get_output_images(self, history: Dict) -> Dict[str, List[Dict]]:
-        """Extract output image info from history."""
-        outputs: Dict[str, List[Dict]] = {}
-        for node_id, node_out in history.get("outputs", {}).items():
-            if "images" in node_out:
-                outputs[node_id] = node_out["images"]
-        return outputs
 
-#======================================================================
+async def _deliver_message_async(client: AsyncComfyClient, message: Dict[str, Any],
+                                 delivery_opts: Optional[Dict[str, Any]], prompt_id: str) -> Dict[str, Any]:
+    if "images" not in message or delivery_opts is None:
+        return message
+    images, delivery = await deliver_outputs_async(message["images"], delivery_opts, client.fetch_output, prompt_id)
+    return {**message, "images": images, "delivery": delivery}
+
 
-def download_image_from_url(url: str, subfolder: str = "") -> Path:
+def stream_execution(client: ComfyClient, workflow: Dict[str, Any], cache_key: Optional[str],
+                     use_render_cache: bool, need_plys: bool,
+                     delivery_opts: Optional[Dict[str, Any]],
+                     ) -> Generator[Dict[str, Any], None, Tuple[Dict[str, Any], Set[Tuple]]]:
     """
-    Download image from URL and save to ComfyUI input folder.
+    Run a prepared workflow, yielding messages while it executes.
 
-    Args:
-        url: URL of the image to download
-        subfolder: Optional subfolder within COMFYUI_INPUT_FOLDER
+    Yields "queued", then "progress"/"executing"/"cached" messages and a
+    "render" or "output" message, with images delivered per `delivery_opts`,
+    as soon as each render or SaveImage node finishes. The prompt is
+    awaited in a worker thread whose websocket events are relayed through
+    a queue. Without a websocket only the final result is available.
 
     Returns:
-        Path to the saved image file
+        (the job result, as _execute() would, ids of the images already
+         streamed; see _output_id)
     """
-    response = requests.get(url)
-    response.raise_for_status()
+    job = _submit(client, workflow, use_render_cache, need_plys, preview_renders=True)
+    prompt_id = job["prompt_id"]
+    streamed: Set[Tuple] = set()
+    events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    abort = threading.Event()
+    future = _stream_pool.submit(
+        contextvars.copy_context().run, _collect, client, job, cache_key, events.put, abort,
+    )
+    try:
+        yield {"type": "queued", "prompt_id": prompt_id}
+        for message in _cached_render_messages(job):
+            yield _deliver_message(client, message, delivery_opts, prompt_id)
 
-    if subfolder:
-        save_dir = Path(COMFYUI_PATH) / COMFYUI_INPUT_FOLDER / subfolder
-    else:
-        save_dir = Path(COMFYUI_PATH) / COMFYUI_INPUT_FOLDER
+        while True:
+            try:
+                event = events.get(timeout=0.1)
+            except queue.Empty:
+                if future.done():
+                    break
+                continue
+            message = _event_message(job, event)
+            if message is not None:
+                streamed.update(_output_id(i) for i in message.get("images", []))
+                yield _deliver_message(client, message, delivery_opts, prompt_id)
+    finally:
+        # Closed early by the consumer: the waiting thread gives up within
+        # WAIT_ABORT_CHECK_INTERVAL and cancels the prompt; it is awaited so
+        # it no longer reads the shared websocket when the next job starts
+        if not future.done():
+            abort.set()
+            concurrent.futures.wait([future])
+    return future.result(), streamed
+
+
+async def stream_execution_async(client: AsyncComfyClient, workflow: Dict[str, Any], cache_key: Optional[str],
+                                 use_render_cache: bool, need_plys: bool,
+                                 delivery_opts: Optional[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async counterpart of stream_execution. An async generator cannot return
+    a value, so the job result is yielded last as
+    {"type": "done", "result": ..., "streamed": ...}.
+    """
+    job = await _submit_async(client, workflow, use_render_cache, need_plys, preview_renders=True)
+    prompt_id = job["prompt_id"]
+    streamed: Set[Tuple] = set()
+    events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    task = asyncio.ensure_future(_collect_async(client, job, cache_key, events.put_nowait))
+    try:
+        yield {"type": "queued", "prompt_id": prompt_id}
+        for message in _cached_render_messages(job):
+            yield await _deliver_message_async(client, message, delivery_opts, prompt_id)
+
+        while True:
+            getter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if events.empty():
+                    break
+                continue
+            message = _event_message(job, getter.result())
+            if message is not None:
+                streamed.update(_output_id(i) for i in message.get("images", []))
+                yield await _deliver_message_async(client, message, delivery_opts, prompt_id)
+    finally:
+        if not task.done():
+            task.cancel()
+    yield {"type": "done", "result": await task, "streamed": streamed}
 
-    save_dir.mkdir(parents=True, exist_ok=True)
 
-    image_filename = f"downloaded_{uuid.uuid4().hex[:8]}.png"
-    image_path = save_dir / image_filename
+#======================================================================
 
-    with open(image_path, "wb") as f:
-        f.write(response.content)
+def _admit() -> Optional[Dict[str, Any]]:
+    """Run admission control for a job about to queue work (None when disabled)."""
+    if admission is None:
+        return None
+    with span("admission"):
+        return admission.admit()
 
-    logger.info("Downloaded image from %s to %s", url, image_path)
-    return image_path
 
+async def _admit_async() -> Optional[Dict[str, Any]]:
+    """Async counterpart of _admit."""
+    if admission is None:
+        return None
+    with span("admission"):
+        return await admission.admit_async()
+
+
+def _rejected(admitted: Optional[Dict[str, Any]]) -> bool:
+    return admitted is not None and admitted["decision"] == "reject"
+
+
+def prepare_job(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Everything a job does before its prompt is queued, shared by handler()
+    and stream_handler(): validate the input, optimise the workflow, then
+    for a single job ingest URL inputs, look it up in the result cache and,
+    on a miss, run admission control. Batch jobs are admitted as a whole
+    and planned item by item in run_batch().
+
+    Returns:
+        The job ("client", "workflow", "delivery_opts", "splat_opts",
+        "optimization", "batch", "admitted" and, for single jobs,
+        "fingerprint", "cache_key", "entry"), or the error response
+    """
+    # Validate required fields
+    workflow = inp.get("workflow")
+    if not workflow:
+        return {"error": "No workflow provided"}
+
+    # Reuse the process-wide ComfyUI client
+    client = get_client()
+    with span("connect"):
+        connected = comfy_ready(client)
+    if not connected:
+        return {"error": "Cannot connect to ComfyUI"}
+
+    # Validate output options before any GPU work
+    job: Dict[str, Any] = {"client": client, "workflow": workflow, "admitted": None,
+                           "delivery_opts": _delivery_options(inp.get("output")),
+                           "splat_opts": _splat_options(inp.get("splat"))}
+
+    # Drop nodes that cannot reach a returned output
+    with span("optimize"):
+        job["optimization"] = optimize_workflow(workflow, inp)
+
+        # Seed/prompt sweep: fan out samplers and decoders, share the rest
+        if inp.get("sweep"):
+            job["optimization"]["sweep"] = expand_sweep(workflow, inp["sweep"])
+
+    # Batch job: one prompt per image, queued back to back
+    job["batch"] = _batch_options(workflow, inp.get("batch"))
+    if job["batch"] is None:
+        # Scan LoadImage nodes — download URLs and upload to ComfyUI
+        with span("ingest"):
+            ingest_url_inputs(client, workflow)
+
+        # Identical workflow + inputs -> identical images (explicit seeds)
+        with span("cache_lookup"):
+            job["fingerprint"] = workflow_fingerprint(workflow)
+            job["cache_key"] = _cache_key(job["fingerprint"], inp)
+            job["entry"] = result_cache.get(job["cache_key"]) if job["cache_key"] is not None else None
+        if job["entry"] is not None:
+            return job
+
+    # Hold or turn away the job while ComfyUI's queue is too deep
+    job["admitted"] = _admit()
+    if _rejected(job["admitted"]):
+        return {"error": job["admitted"]["reason"], "admission": job["admitted"]}
+    return job
+
+
+async def prepare_job_async(inp: Dict[str, Any]) -> Dict[str, Any]:
+    """Async counterpart of prepare_job; URL inputs are ingested concurrently."""
+    workflow = inp.get("workflow")
+    if not workflow:
+        return {"error": "No workflow provided"}
+
+    client = get_async_client()
+    with span("connect"):
+        connected = await comfy_ready_async(client)
+    if not connected:
+        return {"error": "Cannot connect to ComfyUI"}
+
+    job: Dict[str, Any] = {"client": client, "workflow": workflow, "admitted": None,
+                           "delivery_opts": _delivery_options(inp.get("output")),
+                           "splat_opts": _splat_options(inp.get("splat"))}
+    with span("optimize"):
+        job["optimization"] = optimize_workflow(workflow, inp)
+        if inp.get("sweep"):
+            job["optimization"]["sweep"] = expand_sweep(workflow, inp["sweep"])
+
+    job["batch"] = _batch_options(workflow, inp.get("batch"))
+    if job["batch"] is None:
+        with span("ingest"):
+            await ingest_url_inputs_async(client, workflow)
+
+        with span("cache_lookup"):
+            job["fingerprint"] = await asyncio.to_thread(workflow_fingerprint, workflow)
+            job["cache_key"] = _cache_key(job["fingerprint"], inp)
+            job["entry"] = (
+                await asyncio.to_thread(result_cache.get, job["cache_key"]) if job["cache_key"] is not None
+                else None
+            )
+        if job["entry"] is not None:
+            return job
+
+    job["admitted"] = await _admit_async()
+    if _rejected(job["admitted"]):
+        return {"error": job["admitted"]["reason"], "admission": job["admitted"]}
+    return job
+
+
+def _flight_key(job: Dict[str, Any]) -> Optional[str]:
+    """Coalescing key of a prepared job."""
+    # Without splats a render-cache hit skips SHARP, so splat jobs only share with each other
+    if job["splat_opts"] is not None and job["fingerprint"]:
+        return f"{job['fingerprint']}:splat"
+    return job["fingerprint"]
 
-#======================================================================
 
 def handler(event: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -173,68 +505,287 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
     Expected input format:
     {
         "input": {
-            "workflow": { ... full ComfyUI API-format workflow ... }
+            "workflow": { ... full ComfyUI API-format workflow ... },
+            "optimize": true,             # optional, see optimize_workflow()
+            "output_nodes": ["127"],      # optional, default: all SaveImage nodes
+            "variants": ["2511"],         # optional, run only these pipeline branches
+            "cache": true,                # optional, use the result cache
+            "render_cache": true,         # optional, reuse cached GaussianViewer renders (default: "cache")
+            "output": {                   # optional, return images instead of filenames only
+                "delivery": "base64",     #   "base64" | "store" | "none"
+                "format": "webp",         #   "original" | "png" | "webp" | "jpeg" | "avif"
+                "quality": 85,
+                "max_bytes": 10000000     #   size budget for all images of the job
+            },
+            "splat": {                    # optional, return SharpPredict PLYs in compact form
+                "delivery": "base64",     #   "base64" | "store"
+                "sh_degree": 0
+            },
+            "sweep": {                    # optional, one branch per seed x prompt in a single prompt
+                "seeds": [1, 2, 3],
+                "prompts": ["..."]
+            },
+            "batch": {                    # optional, one prompt per image; results in "items"
+                "images": ["a.png", "https://example.com/b.png"],
+                "node": "102"             #   LoadImage to feed, default: the only one
+            }
         }
     }
 
     LoadImage nodes can have:
       - A local filename: "image": "r_0001.png"  (used as-is)
       - A URL: "image": "https://example.com/image.png"  (auto-downloaded)
+
+    Every response carries "timings": per-stage totals, the individual
+    spans (downloads, uploads, queueing, queue wait, execution, ...) and
+    per-node execution times, also logged as one JSON line per job.
+
+    Jobs that queue a prompt also carry "admission": the queue depth and
+    estimated wait seen before queueing, and how long the job was held
+    back. When the estimated wait is too long the job fails fast with an
+    "error" and this report instead of being queued.
     """
+    timings = Timings()
+    token = _timings.set(timings)
     try:
         inp = event.get("input", {})
+        job = prepare_job(inp)
+        if "error" in job:
+            return _log_timings(timings, job)
+        client, workflow, admitted = job["client"], job["workflow"], job["admitted"]
+        delivery_opts, splat_opts = job["delivery_opts"], job["splat_opts"]
+
+        if job["batch"] is not None:
+            items = list(run_batch(client, workflow, *job["batch"], inp, delivery_opts, splat_opts))
+            return _log_timings(timings, _batch_response(items, job["optimization"], admitted))
+
+        cache_key, entry = job["cache_key"], job["entry"]
+        if entry is not None:
+            result = _cached_result(cache_key, entry)
+        else:
+            # Queue, wait and collect; identical in-flight jobs share one prompt
+            use_render_cache = inp.get("render_cache", inp.get("cache", True))
+            need_plys = splat_opts is not None
+            result = run_coalesced(
+                _flight_key(job), lambda: _execute(client, workflow, cache_key, use_render_cache, need_plys),
+                client.timeout,
+            )
+
+        # Optionally return the images themselves, re-encoded
+        with span("delivery"):
+            response = _job_response(client, result, cache_key, entry, delivery_opts, splat_opts,
+                                     store=not result.get("coalesced"))
+        response["optimization"] = job["optimization"]
+        if admitted is not None:
+            response["admission"] = admitted
+        return _log_timings(timings, response)
 
-        # Validate required fields
-        workflow = inp.get("workflow")
-        if not workflow:
-            return {"error": "No workflow provided"}
+    except Exception as e:
+        logger.error("Handler error: %s", e, exc_info=True)
+        _record_error(e)
+        return _log_timings(timings, {"error": str(e)})
+    finally:
+        _timings.reset(token)
 
-        # Initialize ComfyUI client
-        client = ComfyClient(COMFYUI_URL)
-        if not client.check_connection():
-            return {"error": "Cannot connect to ComfyUI"}
 
-        # Scan LoadImage nodes — download URLs and upload to ComfyUI
-        for node_id, node in workflow.items():
-            if node.get("class_type") == "LoadImage":
-                image_value = node.get("inputs", {}).get("image", "")
-                if image_value.startswith("http"):
-                    logger.info("LoadImage node %s has URL: %s", node_id, image_value)
-                    image_path = download_image_from_url(image_value)
-                    uploaded_name = client.upload_image(str(image_path))
-                    node["inputs"]["image"] = uploaded_name
-                    logger.info("Replaced URL with uploaded filename: %s", uploaded_name)
-
-        # Queue workflow
-        prompt_id = client.queue_prompt(workflow)
-
-        # Wait for completion
-        history = client.wait_for_completion(prompt_id)
-
-        # Collect output filenames
-        output_images = client.get_output_images(history)
-        results = []
-        for node_id, images in output_images.items():
-            for img_info in images:
-                results.append({
-                    "node_id": node_id,
-                    "filename": img_info["filename"],
-                })
-
-        return {
-            "status": "success",
-            "prompt_id": prompt_id,
-            "images": results,
-        }
+async def async_handler(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Asyncio variant of handler() with the same input and output format.
+    URL-valued LoadImage inputs are downloaded and uploaded concurrently,
+    and each distinct URL is fetched only once.
+    """
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        inp = event.get("input", {})
+        job = await prepare_job_async(inp)
+        if "error" in job:
+            return _log_timings(timings, job)
+        client, workflow, admitted = job["client"], job["workflow"], job["admitted"]
+        delivery_opts, splat_opts = job["delivery_opts"], job["splat_opts"]
+
+        if job["batch"] is not None:
+            items = [item async for item in run_batch_async(client, workflow, *job["batch"], inp, delivery_opts,
+                                                            splat_opts)]
+            return _log_timings(timings, _batch_response(items, job["optimization"], admitted))
+
+        cache_key, entry = job["cache_key"], job["entry"]
+        if entry is not None:
+            result = _cached_result(cache_key, entry)
+        else:
+            use_render_cache = inp.get("render_cache", inp.get("cache", True))
+            need_plys = splat_opts is not None
+            result = await run_coalesced_async(
+                _flight_key(job), lambda: _execute_async(client, workflow, cache_key, use_render_cache, need_plys),
+                client.timeout,
+            )
+
+        with span("delivery"):
+            response = await _job_response_async(client, result, cache_key, entry, delivery_opts, splat_opts,
+                                                 store=not result.get("coalesced"))
+        response["optimization"] = job["optimization"]
+        if admitted is not None:
+            response["admission"] = admitted
+        return _log_timings(timings, response)
+
+    except Exception as e:
+        logger.error("Handler error: %s", e, exc_info=True)
+        _record_error(e)
+        return _log_timings(timings, {"error": str(e)})
+    finally:
+        _timings.reset(token)
+
+
+def stream_handler(event: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Generator variant of handler() for RunPod streaming, same input format.
+
+    Yields messages with a "type": "queued", "progress", "executing",
+    "cached", "render" (GaussianViewer image, as soon as it is rendered),
+    "output" (each SaveImage as soon as its branch finishes; images
+    delivered per the "output" option), "item" (batch jobs), then a final
+    "result" with the usual response, or "error". Images already streamed
+    are referenced, not re-sent, in the result. Streamed jobs are not
+    coalesced with identical in-flight jobs.
+    """
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        inp = event.get("input", {})
+        job = prepare_job(inp)
+        if "error" in job:
+            yield _log_timings(timings, {"type": "error", **job})
+            return
+        client, workflow, admitted = job["client"], job["workflow"], job["admitted"]
+        delivery_opts, splat_opts = job["delivery_opts"], job["splat_opts"]
+
+        if job["batch"] is not None:
+            items = []
+            for item in run_batch(client, workflow, *job["batch"], inp, delivery_opts, splat_opts):
+                items.append(item)
+                yield {"type": "item", **item}
+            summary = _batch_response(items, job["optimization"], admitted)
+            del summary["items"]
+            yield _log_timings(timings, {"type": "result", **summary})
+            return
+
+        cache_key, entry = job["cache_key"], job["entry"]
+        streamed: Set[Tuple] = set()
+        if entry is not None:
+            result = _cached_result(cache_key, entry)
+        else:
+            if admitted is not None:
+                yield {"type": "admission", **admitted}
+            use_render_cache = inp.get("render_cache", inp.get("cache", True))
+            result, streamed = yield from stream_execution(client, workflow, cache_key, use_render_cache,
+                                                          splat_opts is not None, delivery_opts)
+
+        # Images already streamed are referenced; the rest (e.g. no websocket) are delivered now
+        with span("delivery"):
+            response = _job_response(client, result, cache_key, entry, delivery_opts, splat_opts, store=True,
+                                     streamed=streamed)
+        yield _log_timings(timings, {"type": "result", **response, "optimization": job["optimization"]})
 
     except Exception as e:
         logger.error("Handler error: %s", e, exc_info=True)
-        return {"error": str(e)}
+        _record_error(e)
+        yield _log_timings(timings, {"type": "error", "error": str(e)})
+    finally:
+        # A generator may be closed from another context
+        with contextlib.suppress(ValueError):
+            _timings.reset(token)
+
+
+async def async_stream_handler(event: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """Async generator counterpart of stream_handler()."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        inp = event.get("input", {})
+        job = await prepare_job_async(inp)
+        if "error" in job:
+            yield _log_timings(timings, {"type": "error", **job})
+            return
+        client, workflow, admitted = job["client"], job["workflow"], job["admitted"]
+        delivery_opts, splat_opts = job["delivery_opts"], job["splat_opts"]
+
+        if job["batch"] is not None:
+            items = []
+            async for item in run_batch_async(client, workflow, *job["batch"], inp, delivery_opts, splat_opts):
+                items.append(item)
+                yield {"type": "item", **item}
+            summary = _batch_response(items, job["optimization"], admitted)
+            del summary["items"]
+            yield _log_timings(timings, {"type": "result", **summary})
+            return
+
+        cache_key, entry = job["cache_key"], job["entry"]
+        streamed: Set[Tuple] = set()
+        if entry is not None:
+            result = _cached_result(cache_key, entry)
+        else:
+            if admitted is not None:
+                yield {"type": "admission", **admitted}
+            use_render_cache = inp.get("render_cache", inp.get("cache", True))
+            async for message in stream_execution_async(client, workflow, cache_key, use_render_cache,
+                                                      splat_opts is not None, delivery_opts):
+                if message["type"] == "done":
+                    result, streamed = message["result"], message["streamed"]
+                else:
+                    yield message
+
+        with span("delivery"):
+            response = await _job_response_async(client, result, cache_key, entry, delivery_opts, splat_opts,
+                                                 store=True, streamed=streamed)
+        yield _log_timings(timings, {"type": "result", **response, "optimization": job["optimization"]})
+
+    except Exception as e:
+        logger.error("Handler error: %s", e, exc_info=True)
+        _record_error(e)
+        yield _log_timings(timings, {"type": "error", "error": str(e)})
+    finally:
+        # A generator may be closed from another context
+        with contextlib.suppress(ValueError):
+            _timings.reset(token)
+
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """
+    Number of jobs RunPod may hand this worker at once in "concurrent"
+    mode. While one job's prompt runs on the GPU the others download,
+    upload and prepare their inputs and queue their prompts behind it, so
+    ComfyUI starts the next prompt as soon as the previous one ends.
+
+    With affinity scheduling on, at most `scheduler.depth` of these jobs
+    have a prompt in ComfyUI and the rest wait for a turn; the scheduler
+    can only reorder those waiting jobs, so at least SCHEDULER_LOOKAHEAD
+    are admitted on top of the depth. Drops to one job while ComfyUI is
+    unhealthy.
+    """
+    snapshot = health_monitor.snapshot() if health_monitor is not None else None
+    if snapshot is not None and not snapshot["healthy"]:
+        return 1
+    if scheduler is not None:
+        return max(JOB_CONCURRENCY, scheduler.depth + SCHEDULER_LOOKAHEAD)
+    return JOB_CONCURRENCY
 
 
 if __name__ == "__main__":
     import runpod
 
-    logger.info("Starting RunPod serverless handler")
+    logger.info("Starting RunPod serverless handler (%s mode)", HANDLER_MODE)
     logger.info("ComfyUI endpoint: %s", COMFYUI_URL)
-    runpod.serverless.start({"handler": handler})
+    start_metrics_exporters()
+    if health_monitor is not None:
+        health_monitor.start()
+    install_sigterm_handler()
+    if HANDLER_MODE == "async":
+        runpod.serverless.start({"handler": async_handler})
+    elif HANDLER_MODE == "concurrent":
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
+    elif HANDLER_MODE == "stream":
+        runpod.serverless.start({"handler": stream_handler, "return_aggregate_stream": True})
+    elif HANDLER_MODE == "async_stream":
+        runpod.serverless.start({"handler": async_stream_handler, "return_aggregate_stream": True})
+    else:
+        runpod.serverless.start({"handler": handler})
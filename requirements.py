@@ -1,3 +1,4 @@
 requests>=2.28.0
-aiohttp>=3.9.0
+aiohttp>=3.10.0
+websocket-client>=1.6.0
 tqdm>=4.64.0
@@ -653,6 +653,33 @@ CUSTOM_WORKFLOW_PAYLOAD = {
   }
 }
 
+# ── Pipeline Variants ────────────────────────────────────────────────
+# SaveImage node of each diffusion branch
+VARIANT_OUTPUT_NODES = {
+    "2511": "127",  # KSampler 110
+    "2509": "156",  # QwenImageIntegratedKSampler 157
+}
+
+
+def strip_to_variants(wf: dict, variants: list) -> dict:
+    """Keep only the nodes needed by the SaveImage outputs of the given variants."""
+    unknown = [v for v in variants if v not in VARIANT_OUTPUT_NODES]
+    if unknown:
+        raise ValueError(f"Unknown variant(s) {unknown}; available: {list(VARIANT_OUTPUT_NODES)}")
+
+    keep = set()
+    stack = [VARIANT_OUTPUT_NODES[v] for v in variants]
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep or node_id not in wf:
+            continue
+        keep.add(node_id)
+        for value in wf[node_id]["inputs"].values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                stack.append(str(value[0]))
+    return {k: v for k, v in wf.items() if k in keep}
+
+
 # ── Workflow Builder ─────────────────────────────────────────────────
 def update_workflow_from_input(test_input: dict) -> dict:
     """Update CUSTOM_WORKFLOW_PAYLOAD with values from a test input payload.
@@ -709,6 +736,10 @@ def update_workflow_from_input(test_input: dict) -> dict:
     if "shift" in inp:
         wf["157"]["inputs"]["auraflow_shift"] = inp["shift"]
 
+    # Pipeline variants - e.g. ["2511"] drops the 2509 branch and its loaders
+    if "variants" in inp:
+        wf = strip_to_variants(wf, inp["variants"])
+
     return wf
 
 
@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from comfy_worker import client  # noqa: E402
+
+
+@pytest.fixture
+def comfy_root(tmp_path, monkeypatch):
+    """A ComfyUI folder with empty input/output folders, used for every local file reference."""
+    for folder in ("input", "output"):
+        (tmp_path / folder).mkdir()
+    monkeypatch.setattr(client, "COMFYUI_PATH", str(tmp_path))
+    return tmp_path
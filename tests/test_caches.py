@@ -0,0 +1,181 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from comfy_worker import caches
+from comfy_worker.caches import ResultCache, workflow_fingerprint
+from comfy_worker.inputs import InputCache, _rename_by_content, write_input_atomic
+
+IMAGE = {"node_id": "9", "filename": "out_00001_.png", "subfolder": "", "type": "output"}
+PLY = {"filename": "scene_0001.ply", "subfolder": "sharp", "type": "output"}
+
+
+def _sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+#======================================================================
+def test_result_cache_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put("k1", "prompt-1", [IMAGE], [b"png-bytes"], [PLY], [b"ply-bytes"])
+    entry = cache.get("k1")
+    assert entry["prompt_id"] == "prompt-1"
+    assert cache.read("k1", entry["images"][0]) == b"png-bytes"
+    assert cache.read("k1", entry["ply_files"][0]) == b"ply-bytes"
+    assert cache.stats == {"hits": 1, "misses": 0}
+
+
+def test_result_cache_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get("absent") is None
+    assert cache.stats == {"hits": 0, "misses": 1}
+
+
+@pytest.mark.parametrize("damage", ["delete", "truncate"])
+def test_result_cache_ignores_incomplete_entries(tmp_path, damage):
+    cache = ResultCache(str(tmp_path))
+    cache.put("k1", "prompt-1", [IMAGE], [b"png-bytes"])
+    cached = tmp_path / "k1"[:2] / "k1" / cache.get("k1")["images"][0]["cached_file"]
+    if damage == "delete":
+        cached.unlink()
+    else:
+        cached.write_bytes(b"png")
+    assert cache.get("k1") is None
+
+
+def test_result_cache_lookup_waits_for_a_reserved_write(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.reserve("k1")
+
+    def write():
+        time.sleep(0.2)
+        cache.put("k1", "prompt-1", [IMAGE], [b"png-bytes"])
+        cache.release("k1")
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    assert cache.get("k1") is not None
+    writer.join()
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 9)
+    for n, key in enumerate(("old", "new")):
+        cache.put(key, key, [IMAGE], [b"x" * 1000])
+        manifest = tmp_path / key[:2] / key / "manifest.json"
+        os.utime(manifest, (1000 + n, 1000 + n))
+    cache.max_bytes = 1500
+    cache.evict()
+    assert not (tmp_path / "ol" / "old").exists()
+    assert (tmp_path / "ne" / "new").exists()
+
+
+def test_cached_result_hides_cache_files(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    monkeypatch.setattr(caches, "result_cache", cache)
+    cache.put("k1-splat", "prompt-1", [IMAGE], [b"png"], [PLY], [b"ply"])
+    result = caches._cached_result("k1-splat", cache.get("k1-splat"))
+    assert result["images"] == [IMAGE]
+    assert result["ply_files"][0]["type"] == "result_cache"
+    assert result["ply_files"][0]["key"] == "k1-splat"
+
+
+#======================================================================
+@pytest.fixture
+def input_cache(comfy_root, monkeypatch):
+    cache = InputCache(ttl=60, max_bytes=10 ** 9, min_age=0)
+    monkeypatch.setattr(caches, "input_cache", cache)
+    return cache
+
+
+def _ingest(comfy_root, data: bytes) -> str:
+    """Write `data` the way a local ingest does: unique name, then renamed after the content."""
+    input_dir = comfy_root / "input"
+    name = write_input_atomic(input_dir, [data], "downloaded_tmp.png")
+    return _rename_by_content(input_dir, name, _sha(data))
+
+
+def test_ingested_files_are_named_by_content(comfy_root):
+    name = _ingest(comfy_root, b"image-a")
+    assert name == f"downloaded_{_sha(b'image-a')[:32]}.png"
+    assert (comfy_root / "input" / name).read_bytes() == b"image-a"
+    assert [p.name for p in (comfy_root / "input").iterdir()] == [name]
+
+
+def test_input_cache_hit_and_dedupe(comfy_root, input_cache):
+    first = _ingest(comfy_root, b"image-a")
+    assert input_cache.store("http://a/1.png", first, _sha(b"image-a"), {"ETag": '"v1"'}) == first
+
+    # Same bytes behind another URL, uploaded under another name: the existing file wins
+    duplicate = "downloaded_other.png"
+    (comfy_root / "input" / duplicate).write_bytes(b"image-a")
+    assert input_cache.store("http://b/2.png", duplicate, _sha(b"image-a"), {}) == first
+    assert not (comfy_root / "input" / duplicate).exists()
+
+    assert input_cache.lookup("http://b/2.png") == (first, {})
+    assert input_cache.digest_for(first) == _sha(b"image-a")
+    assert input_cache.stats["deduplicated"] == 1
+
+
+def test_input_cache_revalidates_stale_entries(comfy_root, input_cache):
+    name = _ingest(comfy_root, b"image-a")
+    input_cache.store("http://a/1.png", name, _sha(b"image-a"), {"ETag": '"v1"', "Last-Modified": "yesterday"})
+    input_cache.ttl = 0
+    assert input_cache.lookup("http://a/1.png") == (None, {"If-None-Match": '"v1"', "If-Modified-Since": "yesterday"})
+    assert input_cache.revalidated("http://a/1.png") == name
+
+
+def test_input_cache_forgets_evicted_files(comfy_root, input_cache):
+    name = _ingest(comfy_root, b"image-a")
+    input_cache.store("http://a/1.png", name, _sha(b"image-a"), {})
+    input_cache.max_bytes = 0
+    input_cache.evict()
+    assert not (comfy_root / "input" / name).exists()
+    assert input_cache.lookup("http://a/1.png") == (None, {})
+    assert input_cache.revalidated("http://a/1.png") is None
+    assert input_cache.digest_for(name) is None
+
+
+def test_input_cache_keeps_recently_used_files(comfy_root, input_cache):
+    name = _ingest(comfy_root, b"image-a")
+    input_cache.store("http://a/1.png", name, _sha(b"image-a"), {})
+    input_cache.max_bytes, input_cache.min_age = 0, 3600
+    input_cache.evict()
+    assert (comfy_root / "input" / name).exists()
+
+
+#======================================================================
+def _fingerprint_workflow(image: str = "scene.png", seed: int = 1):
+    return {
+        "1": {"class_type": "LoadImage", "inputs": {"image": image}, "_meta": {"title": "Load"}},
+        "2": {"class_type": "KSampler", "inputs": {"image": ["1", 0], "seed": seed}},
+        "3": {"class_type": "Image Comparer (rgthree)", "inputs": {"rgthree_comparer": {"images": []}}},
+    }
+
+
+def test_fingerprint_hashes_input_content(comfy_root, input_cache):
+    (comfy_root / "input" / "scene.png").write_bytes(b"image-a")
+    (comfy_root / "input" / "copy.png").write_bytes(b"image-a")
+    base = workflow_fingerprint(_fingerprint_workflow())
+    assert base == workflow_fingerprint(_fingerprint_workflow("copy.png"))
+    assert base != workflow_fingerprint(_fingerprint_workflow(seed=2))
+
+    # Another size too, since digests are memoised by path, mtime and size
+    (comfy_root / "input" / "scene.png").write_bytes(b"image-bb")
+    assert base != workflow_fingerprint(_fingerprint_workflow())
+
+
+def test_fingerprint_ignores_meta_and_ui_state(comfy_root, input_cache):
+    (comfy_root / "input" / "scene.png").write_bytes(b"image-a")
+    workflow = _fingerprint_workflow()
+    base = workflow_fingerprint(workflow)
+    workflow["1"]["_meta"]["title"] = "Renamed"
+    workflow["3"]["inputs"]["rgthree_comparer"] = {"images": ["a"]}
+    assert workflow_fingerprint(workflow) == base
+
+
+def test_fingerprint_needs_every_input(comfy_root, input_cache):
+    assert workflow_fingerprint(_fingerprint_workflow("missing.png")) is None
@@ -0,0 +1,116 @@
+import pytest
+import requests
+
+from comfy_worker import client
+from comfy_worker.client import (ComfyClient, _backoff_delay, _build_image_results, _check_history_status,
+                                 _is_final_event, _local_file, _multipart_stream, _queue_state, request_with_retry)
+
+
+def test_final_events():
+    assert _is_final_event({"type": "executing", "data": {"node": None, "prompt_id": "p"}})
+    assert not _is_final_event({"type": "executing", "data": {"node": "3", "prompt_id": "p"}})
+    assert _is_final_event({"type": "execution_error", "data": {}})
+    assert _is_final_event({"type": "execution_interrupted", "data": {}})
+    assert not _is_final_event({"type": "progress", "data": {"value": 1, "max": 4}})
+
+
+def test_queue_state():
+    queue_info = {"queue_running": [[0, "p1", {}]], "queue_pending": [[1, "p2", {}], [2, "p3", {}]]}
+    assert _queue_state(queue_info, "p1") == "running"
+    assert _queue_state(queue_info, "p3") == "pending"
+    assert _queue_state(queue_info, "p4") == "done"
+    assert _queue_state({}, "p1") == "done"
+
+
+def test_history_errors_raise():
+    _check_history_status({"status": {"status_str": "success"}})
+    with pytest.raises(RuntimeError, match="Execution failed"):
+        _check_history_status({"status": {"status_str": "error", "messages": []}})
+
+
+def test_output_images():
+    history = {"outputs": {
+        "9": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]},
+        "12": {"text": ["not an image"]},
+        "15": {"images": [{"filename": "b.png"}]},
+    }}
+    outputs = ComfyClient.get_output_images(history)
+    assert list(outputs) == ["9", "15"]
+    assert _build_image_results(outputs) == [
+        {"node_id": "9", "filename": "a.png", "subfolder": "", "type": "output"},
+        {"node_id": "15", "filename": "b.png", "subfolder": "", "type": "output"},
+    ]
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(client, "HTTP_BACKOFF_BASE", 0.2)
+    monkeypatch.setattr(client, "HTTP_BACKOFF_MAX", 1.0)
+    assert 0.1 <= _backoff_delay(0) <= 0.2
+    assert all(0.5 <= _backoff_delay(10) <= 1.0 for _ in range(20))
+
+
+def test_local_files_stay_inside_their_folder(comfy_root):
+    assert _local_file("output", "a.png", "sharp") == (comfy_root / "output" / "sharp" / "a.png").resolve()
+    assert _local_file("input", "../output/a.png") is None
+    assert _local_file("input", "/etc/passwd") is None
+
+
+def test_multipart_stream():
+    body = b"".join(_multipart_stream("XX", {"overwrite": "true"}, "image", "a.png", "image/png",
+                                      iter([b"ab", b"cd"])))
+    assert body == (b'--XX\r\nContent-Disposition: form-data; name="overwrite"\r\n\r\ntrue\r\n'
+                    b'--XX\r\nContent-Disposition: form-data; name="image"; filename="a.png"\r\n'
+                    b"Content-Type: image/png\r\n\r\nabcd\r\n--XX--\r\n")
+
+
+#======================================================================
+class _Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class _Session:
+    """Plays back a list of responses or exceptions, one per request."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, timeout, **kwargs):
+        self.calls.append(method)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(client.time, "sleep", lambda delay: None)
+
+
+def test_retries_idempotent_requests():
+    busy = _Response(503)
+    session = _Session(requests.ConnectionError("reset"), busy, _Response(200))
+    assert request_with_retry("GET", "http://comfy/queue", 5, session=session).status_code == 200
+    assert session.calls == ["GET"] * 3
+    assert busy.closed
+
+
+def test_does_not_retry_posts_by_default():
+    session = _Session(requests.ConnectionError("reset"), _Response(200))
+    with pytest.raises(requests.ConnectionError):
+        request_with_retry("POST", "http://comfy/prompt", 5, session=session)
+    assert session.calls == ["POST"]
+
+
+def test_returns_the_last_response_when_retries_run_out(monkeypatch):
+    monkeypatch.setattr(client, "HTTP_RETRIES", 1)
+    session = _Session(_Response(502), _Response(504))
+    assert request_with_retry("GET", "http://comfy/view", 5, session=session).status_code == 504
+    assert request_with_retry("POST", "http://comfy/free", 5, retry=True,
+                              session=_Session(_Response(503), _Response(200))).status_code == 200
@@ -0,0 +1,96 @@
+import json
+import struct
+
+import pytest
+
+from comfy_worker.delivery import SPLAT_MAGIC, _splat_options, compact_splat, read_ply_vertices
+
+np = pytest.importorskip("numpy")
+
+GAUSSIAN = ["x", "y", "z", "f_dc_0", "f_dc_1", "f_dc_2", "opacity",
+            "scale_0", "scale_1", "scale_2", "rot_0", "rot_1", "rot_2", "rot_3"]
+
+
+def _ply(count: int, properties=GAUSSIAN, sh_rest: int = 45, seed: int = 0) -> bytes:
+    """A binary little-endian splat PLY with random float properties."""
+    names = list(properties) + [f"f_rest_{i}" for i in range(sh_rest)]
+    header = (f"ply\nformat binary_little_endian 1.0\nelement vertex {count}\n"
+              + "".join(f"property float {n}\n" for n in names) + "end_header\n")
+    values = np.random.default_rng(seed).normal(size=(count, len(names))).astype("<f4")
+    return header.encode() + values.tobytes()
+
+
+def _decode(encoded: bytes):
+    assert encoded[:4] == SPLAT_MAGIC
+    version, degree, _, header_len = struct.unpack("<BBHI", encoded[4:12])
+    header = json.loads(encoded[12:12 + header_len])
+    return version, degree, header, encoded[12 + header_len:]
+
+
+def test_read_ply_vertices():
+    vertices = read_ply_vertices(_ply(3))
+    assert len(vertices) == 3
+    assert vertices.dtype.names[:3] == ("x", "y", "z")
+
+
+def test_read_ply_rejects_ascii_and_garbage():
+    with pytest.raises(ValueError, match="Unsupported PLY format"):
+        read_ply_vertices(b"ply\nformat ascii 1.0\nelement vertex 0\nend_header\n")
+    with pytest.raises(ValueError, match="Not a PLY"):
+        read_ply_vertices(b"not a ply")
+
+
+@pytest.mark.parametrize("sh_degree, rest_per_gaussian", [(0, 0), (1, 9), (3, 45)])
+def test_compact_splat_layout(sh_degree, rest_per_gaussian):
+    count = 50
+    encoded, header = compact_splat(_ply(count), sh_degree=sh_degree)
+    version, degree, decoded, body = _decode(encoded)
+    assert (version, degree) == (1, sh_degree)
+    assert decoded == header
+    assert header["count"] == count
+    assert header["layout"][-1] == f"sh_rest:i8x{rest_per_gaussian}"
+    # u16x3 position, u8x3 scale, u8x4 rotation, u8x4 colour, int8 SH rest
+    assert len(body) == count * (6 + 3 + 4 + 4 + rest_per_gaussian)
+
+
+def test_compact_splat_positions_stay_in_their_bounding_box():
+    data = _ply(200, sh_rest=0)
+    encoded, header = compact_splat(data)
+    xyz = np.stack([read_ply_vertices(data)[k] for k in ("x", "y", "z")], axis=1)
+    assert header["bbox_min"] == pytest.approx(xyz.min(axis=0).tolist())
+    assert header["bbox_max"] == pytest.approx(xyz.max(axis=0).tolist())
+
+    body = _decode(encoded)[3]
+    positions = np.frombuffer(body, dtype="<u2", count=200 * 3).reshape(200, 3).astype(np.float64)
+    lo, hi = np.array(header["bbox_min"]), np.array(header["bbox_max"])
+    restored = lo + positions / 65535 * (hi - lo)
+    # Gaussians are reordered along a Morton curve; compare them sorted by x
+    np.testing.assert_allclose(restored[np.argsort(restored[:, 0])], xyz[np.argsort(xyz[:, 0])],
+                               atol=float((hi - lo).max()) / 65535)
+
+
+def test_compact_splat_degree_is_capped_by_the_file():
+    encoded, header = compact_splat(_ply(10, sh_rest=9), sh_degree=3)
+    assert header["sh_degree"] == 1
+    assert _decode(encoded)[1] == 1
+
+
+def test_compact_splat_of_an_empty_ply():
+    encoded, header = compact_splat(_ply(0), sh_degree=3)
+    assert header["count"] == 0
+    assert header["bbox_min"] == header["bbox_max"] == [0.0, 0.0, 0.0]
+    assert _decode(encoded)[3] == b""
+
+
+def test_compact_splat_needs_gaussian_properties():
+    with pytest.raises(ValueError, match="opacity"):
+        compact_splat(_ply(5, [p for p in GAUSSIAN if p != "opacity"]))
+
+
+def test_splat_options():
+    assert _splat_options(None) is None
+    assert _splat_options({"sh_degree": 2}) == {"delivery": "base64", "sh_degree": 2}
+    with pytest.raises(ValueError, match="sh_degree"):
+        _splat_options({"sh_degree": 4})
+    with pytest.raises(ValueError, match="delivery"):
+        _splat_options({"delivery": "email"})
@@ -0,0 +1,135 @@
+import pytest
+
+from comfy_worker.graph import (expand_sweep, merge_duplicate_nodes, optimize_workflow, prune_workflow,
+                                select_variant_outputs, topological_order)
+
+
+def _edit_workflow():
+    """Two pipeline variants sharing a VAE file, plus a preview-only branch."""
+    return {
+        "1": {"class_type": "LoadImage", "inputs": {"image": "scene.png"}},
+        "2": {"class_type": "VAELoader", "inputs": {"vae_name": "qwen_vae.safetensors"}},
+        "3": {"class_type": "VAELoader", "inputs": {"vae_name": "qwen_vae.safetensors"}},
+        "4": {"class_type": "UNETLoader", "inputs": {"unet_name": "qwen_edit_2511.safetensors"}},
+        "5": {"class_type": "UNETLoader", "inputs": {"unet_name": "qwen_edit_2509.safetensors"}},
+        "6": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "vae": ["2", 0], "image": ["1", 0],
+                                                   "seed": 1}},
+        "7": {"class_type": "KSampler", "inputs": {"model": ["5", 0], "vae": ["3", 0], "image": ["1", 0],
+                                                   "seed": 1}},
+        "8": {"class_type": "SaveImage", "inputs": {"images": ["6", 0]}},
+        "9": {"class_type": "SaveImage", "inputs": {"images": ["7", 0]}},
+        "10": {"class_type": "PreviewImage", "inputs": {"images": ["6", 0]}},
+    }
+
+
+def test_prune_removes_nodes_that_feed_no_output():
+    workflow = _edit_workflow()
+    assert prune_workflow(workflow, ["8"]) == ["10", "3", "5", "7", "9"]
+    assert sorted(workflow, key=int) == ["1", "2", "4", "6", "8"]
+
+
+def test_prune_defaults_to_save_nodes():
+    workflow = _edit_workflow()
+    assert prune_workflow(workflow) == ["10"]
+
+
+def test_prune_rejects_unknown_output_nodes():
+    with pytest.raises(ValueError, match="Unknown output node"):
+        prune_workflow(_edit_workflow(), ["42"])
+
+
+def test_prune_keeps_everything_without_outputs():
+    workflow = {"1": {"class_type": "LoadImage", "inputs": {"image": "a.png"}}}
+    assert prune_workflow(workflow) == []
+    assert "1" in workflow
+
+
+def test_merge_rewires_consumers_to_the_surviving_node():
+    workflow = _edit_workflow()
+    assert merge_duplicate_nodes(workflow) == {"3": "2"}
+    assert "3" not in workflow
+    assert workflow["7"]["inputs"]["vae"] == ["2", 0]
+
+
+def test_merge_follows_upstream_merges():
+    workflow = {
+        "1": {"class_type": "LoadImage", "inputs": {"image": "a.png"}},
+        "2": {"class_type": "LoadImage", "inputs": {"image": "a.png"}},
+        "3": {"class_type": "ImageScaleBy", "inputs": {"image": ["1", 0], "scale_by": 0.5}},
+        "4": {"class_type": "ImageScaleBy", "inputs": {"image": ["2", 0], "scale_by": 0.5}},
+        "5": {"class_type": "SaveImage", "inputs": {"images": ["4", 0]}},
+    }
+    assert merge_duplicate_nodes(workflow) == {"2": "1", "4": "3"}
+    assert workflow["5"]["inputs"]["images"] == ["3", 0]
+
+
+def test_merge_leaves_other_node_types_alone():
+    workflow = _edit_workflow()
+    merge_duplicate_nodes(workflow, mergeable={"UNETLoader"})
+    assert {"2", "3", "6", "7"} <= set(workflow)
+
+
+def test_topological_order_rejects_cycles():
+    workflow = {
+        "1": {"class_type": "A", "inputs": {"x": ["2", 0]}},
+        "2": {"class_type": "B", "inputs": {"x": ["1", 0]}},
+    }
+    with pytest.raises(ValueError, match="cycle"):
+        topological_order(workflow)
+
+
+def test_select_variant_outputs():
+    workflow = _edit_workflow()
+    assert select_variant_outputs(workflow, ["2511"]) == ["8"]
+    assert select_variant_outputs(workflow, ["2511", "2509"]) == ["8", "9"]
+    with pytest.raises(ValueError, match="Unknown pipeline variant"):
+        select_variant_outputs(workflow, ["1234"])
+
+
+def test_optimize_workflow_prunes_the_unselected_variant():
+    workflow = _edit_workflow()
+    report = optimize_workflow(workflow, {"variants": ["2509"]})
+    assert report["variants"]["output_nodes"] == ["9"]
+    assert sorted(workflow, key=int) == ["1", "3", "5", "7", "9"]
+
+
+def _sweep_workflow():
+    return {
+        "1": {"class_type": "LoadImage", "inputs": {"image": "scene.png"}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat"}},
+        "3": {"class_type": "KSampler", "inputs": {"image": ["1", 0], "positive": ["2", 0], "seed": 0}},
+        "4": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+    }
+
+
+def test_sweep_fans_out_seeded_nodes_only():
+    workflow = _sweep_workflow()
+    report = expand_sweep(workflow, {"seeds": [11, 22, 33]})
+    assert [r["output_nodes"] for r in report] == [["4"], ["4_1"], ["4_2"]]
+    assert [workflow[n]["inputs"]["seed"] for n in ("3", "3_1", "3_2")] == [11, 22, 33]
+    assert workflow["4_2"]["inputs"]["images"] == ["3_2", 0]
+    # The input image and the prompt encoder are shared by every variant
+    assert workflow["3_1"]["inputs"]["image"] == ["1", 0]
+    assert workflow["3_1"]["inputs"]["positive"] == ["2", 0]
+    assert len(workflow) == 8
+
+
+def test_sweep_shares_a_prompt_encoder_between_seeds():
+    workflow = _sweep_workflow()
+    report = expand_sweep(workflow, {"seeds": [1, 2], "prompts": ["a dog", "a fox"]})
+    assert [(r["seed"], r["prompt"]) for r in report] == [(1, "a dog"), (2, "a dog"), (1, "a fox"), (2, "a fox")]
+    encoders = {n: node["inputs"]["text"] for n, node in workflow.items() if node["class_type"] == "CLIPTextEncode"}
+    assert sorted(encoders.values()) == ["a dog", "a fox"]
+    samplers = [node for node in workflow.values() if node["class_type"] == "KSampler"]
+    assert len(samplers) == 4
+    assert len({tuple(s["inputs"]["positive"]) for s in samplers}) == 2
+
+
+def test_sweep_validates_its_options():
+    with pytest.raises(ValueError, match="needs seeds"):
+        expand_sweep(_sweep_workflow(), {})
+    with pytest.raises(ValueError, match="limit"):
+        expand_sweep(_sweep_workflow(), {"seeds": list(range(100))})
+    no_sampler = {"1": {"class_type": "SaveImage", "inputs": {}}}
+    with pytest.raises(ValueError, match="no sampler"):
+        expand_sweep(no_sampler, {"seeds": [1]})
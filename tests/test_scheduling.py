@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from comfy_worker import scheduling
+from comfy_worker.scheduling import AffinityScheduler, VramPolicy, workflow_models
+
+GB = 1024 ** 3
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    """Sparse model files under a temporary ComfyUI models folder."""
+    monkeypatch.setattr(scheduling, "COMFYUI_PATH", str(tmp_path))
+    monkeypatch.setattr(scheduling, "_model_sizes", {})
+
+    def add(folder: str, name: str, size: int) -> None:
+        path = tmp_path / "models" / folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+    return add
+
+
+def _workflow(unet: str, clip: str = "qwen_vl.safetensors"):
+    return {
+        "1": {"class_type": "UNETLoader", "inputs": {"unet_name": unet, "weight_dtype": "default"}},
+        "2": {"class_type": "CLIPLoader", "inputs": {"clip_name": clip, "type": "qwen_image"}},
+        "3": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "clip": ["2", 0]}},
+    }
+
+
+@pytest.fixture
+def two_pipelines(models):
+    models("diffusion_models", "edit_a.safetensors", 12 * GB)
+    models("diffusion_models", "edit_b.safetensors", 12 * GB)
+    models("diffusion_models", "other.safetensors", 12 * GB)
+    models("text_encoders", "qwen_vl.safetensors", 8 * GB)
+    models("text_encoders", "t5.safetensors", 8 * GB)
+
+
+def test_workflow_models_sizes_and_signatures(two_pipelines):
+    found = workflow_models(_workflow("edit_a.safetensors"))
+    assert sorted(m["bytes"] for m in found.values()) == [8 * GB, 12 * GB]
+    # The same file loaded with another CLIPLoader type is another model in memory
+    other_type = _workflow("edit_a.safetensors")
+    other_type["2"]["inputs"]["type"] = "wan"
+    assert set(workflow_models(other_type)) != set(found)
+
+
+def test_unknown_models_count_as_free(models):
+    assert [m["bytes"] for m in workflow_models(_workflow("missing.safetensors")).values()] == [0, 0]
+
+
+#======================================================================
+def test_vram_keeps_models_that_fit(two_pipelines):
+    policy = VramPolicy(headroom=2 * GB)
+    assert policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 40 * GB})["action"] == "keep"
+    decision = policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 0})
+    assert decision["action"] == "keep"
+    assert decision["load_bytes"] == 0
+
+
+def test_vram_never_frees_models_the_job_reuses(two_pipelines):
+    policy = VramPolicy(headroom=2 * GB)
+    policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 40 * GB})
+    # edit_b does not fit, but /free would also unload the text encoder it shares
+    decision = policy.plan(_workflow("edit_b.safetensors"), {"vram_free": 4 * GB})
+    assert decision["action"] == "keep"
+    assert decision["load_bytes"] == 12 * GB
+    assert set(policy.resident) == set(workflow_models(_workflow("edit_b.safetensors")))
+
+
+def test_vram_unloads_when_nothing_is_reused(two_pipelines):
+    policy = VramPolicy(headroom=2 * GB)
+    policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 40 * GB})
+    needed = _workflow("other.safetensors", "t5.safetensors")
+    decision = policy.plan(needed, {"vram_free": 10 * GB})
+    assert decision == {"action": "unload", "load_bytes": 20 * GB, "unload_bytes": 20 * GB,
+                        "vram_free": 10 * GB, "pending": 0}
+    assert set(policy.resident) == set(workflow_models(needed))
+    assert VramPolicy._free_body("unload") == {"unload_models": True, "free_memory": False}
+
+
+def test_vram_frees_memory_when_unloading_is_not_enough(two_pipelines):
+    policy = VramPolicy(headroom=2 * GB)
+    policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 40 * GB})
+    decision = policy.plan(_workflow("other.safetensors", "t5.safetensors"), {"vram_free": 0})
+    assert decision["action"] == "free"
+    assert VramPolicy._free_body("free") == {"unload_models": True, "free_memory": True}
+
+
+def test_vram_keeps_behind_pending_prompts(two_pipelines):
+    policy = VramPolicy(headroom=2 * GB)
+    policy.plan(_workflow("edit_a.safetensors"), {"vram_free": 40 * GB})
+    decision = policy.plan(_workflow("other.safetensors", "t5.safetensors"), {"vram_free": 0}, pending=1)
+    assert decision["action"] == "keep"
+    assert len(policy.resident) == 4
+    assert VramPolicy._pending(None) == 1
+    assert VramPolicy._pending({"queue_pending": []}) == 0
+
+
+def test_vram_without_a_reading_keeps(two_pipelines):
+    policy = VramPolicy()
+    assert policy.plan(_workflow("edit_a.safetensors"), {})["action"] == "keep"
+
+
+#======================================================================
+def _run_jobs(scheduler, jobs):
+    """Queue every job at once and return the order in which they got their turn."""
+    order = []
+
+    async def job(name, workflow, hold):
+        async with scheduler.turn(workflow):
+            order.append(name)
+            await hold.wait()
+
+    async def main():
+        holds = {name: asyncio.Event() for name, _ in jobs}
+        tasks = [asyncio.ensure_future(job(name, workflow, holds[name])) for name, workflow in jobs]
+        for _ in jobs:
+            await asyncio.sleep(0)
+        while len(order) < len(jobs):
+            holds[order[-1]].set()
+            await asyncio.sleep(0.01)
+        holds[order[-1]].set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    return order
+
+
+def test_scheduler_runs_jobs_that_reuse_loaded_models_first(two_pipelines):
+    jobs = [("a1", _workflow("edit_a.safetensors")), ("b1", _workflow("edit_b.safetensors")),
+            ("a2", _workflow("edit_a.safetensors")), ("b2", _workflow("edit_b.safetensors"))]
+    assert _run_jobs(AffinityScheduler(depth=1, max_skips=5), jobs) == ["a1", "a2", "b1", "b2"]
+
+
+def test_scheduler_bounds_how_often_a_job_is_passed_over(two_pipelines):
+    jobs = [("a1", _workflow("edit_a.safetensors")), ("b1", _workflow("edit_b.safetensors"))]
+    jobs += [(f"a{n}", _workflow("edit_a.safetensors")) for n in range(2, 6)]
+    assert _run_jobs(AffinityScheduler(depth=1, max_skips=2), jobs) == ["a1", "a2", "a3", "b1", "a4", "a5"]
+
+
+def test_scheduler_limits_prompts_in_flight(two_pipelines):
+    scheduler = AffinityScheduler(depth=2)
+    peak = 0
+
+    async def job():
+        nonlocal peak
+        async with scheduler.turn(_workflow("edit_a.safetensors")):
+            peak = max(peak, scheduler.running)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(job() for _ in range(5)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert scheduler.running == 0